@@ -3,6 +3,8 @@ from . import mcfostParameterTemplate
 from . import fm_klip
 from . import lnlike
 from . import mcfostRun
+from . import mcfostCache
+from . import asyncPool
 from . import lnpost
 from . import dependencies
 from . import anadisk_sum_mask_MMB
@@ -10,7 +12,7 @@ from . import anadisk_sum_mask_MMBog
 
 
 
-from .lnlike import lnlike_hd191089
+from .lnlike import lnlike_hd191089, data_input_hd191089
 from .mcfostRun import run_hd191089
 from .lnpost import lnpost_hd191089
 
@@ -0,0 +1,90 @@
+import asyncio                      # run MCFOST as asynchronous subprocesses
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import mcfostRun
+
+class async_pool:
+    """An emcee-compatible pool (i.e., with a `map` method) that overlaps the MCFOST calculations with the forward modeling in one process.
+    The walkers are evaluated in threads (the observations, e.g., a lnlike.data_input_hd191089 object, are held only once in memory),
+    and their MCFOST commands are run as asyncio subprocesses (asyncio.create_subprocess_exec) by an event loop in another thread.
+    While MCFOST renders the models of some walkers, the forward modeling (FITS reading, convolution, KLIP, chi2) of the others runs.
+    The likelihood is not changed: the lnpost functions are called as they are, only mcfostRun.run_mcfost_jobs() hands its commands to launch().
+    Input:
+        max_mcfost: maximum number of MCFOST processes running at the same time. If None, the available cores divided by `n_threads`.
+        n_threads: integer, number of OpenMP threads for each MCFOST process, if not given to the runners. If None, the available cores 
+                    divided by `max_mcfost` (at least 1), so that the MCFOST processes running at the same time do not oversubscribe the cores.
+        n_workers: number of walkers evaluated at the same time. If None, 2 * `max_mcfost`, so that walkers in the forward modeling
+                    phase do not leave the cores idle.
+    Example:
+        with async_pool(max_mcfost = 4, n_threads = 8) as pool:
+            sampler = emcee.EnsembleSampler(n_walkers, n_dim, lnpost_hd191089, args = [var_names, path_obs, path_model],
+                                            kwargs = {'data_input_info': data_input}, pool = pool)
+            sampler.run_mcmc(values_ball, step)
+    Note: use `hash_address = True` (default of the lnpost functions), so that the walkers write to different folders.
+    """
+    def __init__(self, max_mcfost = None, n_threads = None, n_workers = None):
+        if max_mcfost is None:
+            max_mcfost = max(1, mcfostRun.available_cores() // (1 if n_threads is None else int(n_threads)))
+        if n_workers is None:
+            n_workers = 2 * max_mcfost
+        self.max_mcfost = max_mcfost
+        self.n_threads = n_threads
+        if n_threads is None:
+            self.n_threads = max(1, mcfostRun.available_cores() // max_mcfost)
+        self.n_workers = n_workers
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+        self.semaphore = asyncio.run_coroutine_threadsafe(self._create_semaphore(), self.loop).result()
+        self.executor = ThreadPoolExecutor(max_workers = n_workers, initializer = mcfostRun.set_launcher,
+                                           initargs = (self.launch, ))
+
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(self.max_mcfost)   # created in the event loop that uses it
+
+    async def _run(self, command, log, cwd, env):
+        """Run one MCFOST command when fewer than `max_mcfost` are running, and return its exit code."""
+        async with self.semaphore:
+            with open(os.path.join(cwd, log), 'a') as f:
+                process = await asyncio.create_subprocess_exec(*command, cwd = cwd, stdout = f, env = env)
+                return await process.wait()
+
+    async def _run_jobs(self, commands, logs, cwd, parallel, env):
+        if parallel:
+            return list(await asyncio.gather(*[self._run(command, log, cwd, env) for command, log in zip(commands, logs)]))
+        flags = []
+        for command, log in zip(commands, logs):
+            flags.append(await self._run(command, log, cwd, env))
+        return flags
+
+    def launch(self, commands, logs, cwd = None, parallel = False, n_threads = None):
+        """Run MCFOST commands in the event loop, and wait for them in the calling (worker) thread.
+        The inputs and output are the same as mcfostRun.run_mcfost_jobs()."""
+        if cwd is None:
+            cwd = os.getcwd()
+        if n_threads is None:
+            n_threads = self.n_threads
+        env = None
+        if n_threads is not None:
+            env = dict(os.environ, OMP_NUM_THREADS = str(int(n_threads)))
+        future = asyncio.run_coroutine_threadsafe(self._run_jobs(commands, logs, cwd, parallel, env), self.loop)
+        return future.result()
+
+    def map(self, func, iterable):
+        """Evaluate `func` for each element of `iterable` in the worker threads, and return the results in order (as the built-in map)."""
+        return list(self.executor.map(func, iterable))
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,8 +1,15 @@
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import threading
+import time
 import numpy as np
 from scipy.ndimage.interpolation import rotate
-from scipy.interpolate import interp2d
+from scipy.interpolate import RectBivariateSpline
+from scipy.ndimage import affine_transform, convolve, spline_filter1d
+from scipy import fft, sparse, special
 
-def annulusMask(width, r_in, r_out = None, width_x = None, cen_y = None, cen_x = None):
+def annulusMask(width, r_in, r_out = None, width_x = None, cen_y = None, cen_x = None, inc = 0, pa = 0):
     """Creat a width*width all-0 mask; for r_in <= r <= r_out, 1.
     If r_out = 0, it means you are not constraining r_out, i.e., if r >= r_int, all ones.
     Default is a square mask centering at the center.
@@ -13,8 +20,11 @@ def annulusMask(width, r_in, r_out = None, width_x = None, cen_y = None, cen_x =
         r_out: where 1 ends. Default is None, i.e., r_out = +infinity;
         cen_y: center of the annulus in y-direction. Default is None, i.e., cen_y = (width-1)/2.0;
         cen_x: center of the annulus in x-direction. Default is None, i.e., cen_x = (width_x-1)/2.0;
+        inc: inclination of the annulus in degrees, 0 (face-on) by default. If not 0, r is the deprojected radius, 
+            i.e., the annulus is an ellipse with semi-major axes r_in and r_out, and semi-minor axes r_in*cos(inc) and r_out*cos(inc);
+        pa: position angle of the major axis in degrees, east of north (north up, east left), 0 by default.
     Output:
-        result.
+        result, read-only (the masks are cached), use np.copy(result) if you would like to modify it.
     """
     if width_x is None:
         width_x = width
@@ -23,18 +33,25 @@ def annulusMask(width, r_in, r_out = None, width_x = None, cen_y = None, cen_x =
     if cen_x is None:
         cen_x = (width_x-1)/2.0
     
-    result = np.zeros((width, width_x))
-    
-    r_in = np.max([0, r_in])
+    return _annulusMask(int(width), int(width_x), float(np.max([0, r_in])), None if r_out is None else float(r_out), 
+                        float(cen_y), float(cen_x), float(inc), float(pa))
+
+@lru_cache(maxsize = 64)
+def _annulusMask(width, width_x, r_in, r_out, cen_y, cen_x, inc, pa):
+    """Cached calculation for annulusMask()."""
+    y, x = np.ogrid[:width, :width_x]
+    if inc == 0:
+        r2 = (y - cen_y)**2 + (x - cen_x)**2
+    else:
+        major = -np.sin(np.deg2rad(pa))*(x - cen_x) + np.cos(np.deg2rad(pa))*(y - cen_y)
+        minor = np.cos(np.deg2rad(pa))*(x - cen_x) + np.sin(np.deg2rad(pa))*(y - cen_y)
+        r2 = major**2 + (minor/np.cos(np.deg2rad(inc)))**2
     
-    for i in range(width):
-        for j in range(width_x):
-            if r_out is None:
-                if (i - cen_y)**2 + (j - cen_x)**2 >= r_in**2:
-                    result[i, j] = 1
-            else:
-                if (i - cen_y)**2 + (j - cen_x)**2 >= r_in**2 and (i - cen_y)**2 + (j - cen_x)**2 <= r_out**2:
-                    result[i, j] = 1
+    inside = r2 >= r_in**2
+    if r_out is not None:
+        inside &= r2 <= r_out**2
+    result = inside.astype('float64')
+    result.flags.writeable = False
     return result
 
 
@@ -85,7 +102,8 @@ def addplanet(image, planet, orientat = None, starflux = 1, radius = None, angle
     y_range = np.arange(-(planet.shape[0]-1)/2.0++y_planet, 
                         -(planet.shape[0]-1)/2.0+y_planet + planet.shape[0] - 0.001,
                         1)
-    planetfunc = interp2d(x_range, y_range, planet, kind='cubic') #Interpolation Part, (x_planet,y_planet) is maximum
+    planet_x_range = x_range
+    planet_y_range = y_range
     planetonly = np.zeros(image.shape) #This image contains only the planet
     x_range = np.arange( max(0, round(min(x_range)), 0), 
                         min(image.shape[1]-1, round(max(x_range), 0)) + 1
@@ -95,7 +113,7 @@ def addplanet(image, planet, orientat = None, starflux = 1, radius = None, angle
                         , 1)
     if surroundingReplace is not None:
         planetonly[:,:] = surroundingReplace
-    planetonly[int(min(y_range)):int(max(y_range))+1, int(min(x_range)):int(max(x_range))+1] = planetfunc(x_range, y_range)*starflux*contrast*exptime
+    planetonly[int(min(y_range)):int(max(y_range))+1, int(min(x_range)):int(max(x_range))+1] = _interpGrid(planet, x_range - planet_x_range[0], y_range - planet_y_range[0], order = 3)*starflux*contrast*exptime #Interpolation Part, (x_planet,y_planet) is maximum
     
     if nan_flag == 1:
         planetonly[np.where(palnet_nans_added == 1)] = np.nan
@@ -104,6 +122,44 @@ def addplanet(image, planet, orientat = None, starflux = 1, radius = None, angle
         return planetonly
     return planetonly+image
     
+def _interpGrid(image, x_range, y_range, order = 1):
+    """Interpolate an image (or a cube of images) on the grid of the pixel coordinates x_range * y_range (1D arrays),
+    for addplanet() and cutImage(). Outside the image, the nearest values are used (the extrapolation of interp2d).
+    When the coordinates are integers (e.g., centered crops), the pixels are only copied (plain slicing if inside the image).
+    Input:
+        image: 2D (or 3D, the same grid for each image) array;
+        x_range, y_range: the column and row coordinates (in pixels, increasing, with a constant fractional part);
+        order: 1 (bilinear, as the default interp2d) or 3 (bicubic spline, as interp2d(kind = 'cubic')).
+    Output:
+        the interpolated image(s), of shape (len(y_range), len(x_range))."""
+    image = np.asarray(image, dtype = 'float64')
+    height, width = image.shape[-2:]
+    x_range = np.clip(np.asarray(x_range, dtype = 'float64'), 0, width - 1)
+    y_range = np.clip(np.asarray(y_range, dtype = 'float64'), 0, height - 1)
+    x_index = np.round(x_range).astype(int)
+    y_index = np.round(y_range).astype(int)
+    
+    if np.allclose(x_range, x_index, rtol = 0, atol = 1e-6) and np.allclose(y_range, y_index, rtol = 0, atol = 1e-6):
+        if np.all(np.diff(x_index) == 1) and np.all(np.diff(y_index) == 1):
+            return np.copy(image[..., y_index[0]:y_index[-1]+1, x_index[0]:x_index[-1]+1])
+        return image[..., y_index[:, np.newaxis], x_index]
+    
+    if order == 1: #separable linear interpolation
+        y_lower = np.minimum(np.floor(y_range).astype(int), height - 1)
+        x_lower = np.minimum(np.floor(x_range).astype(int), width - 1)
+        y_upper = np.minimum(y_lower + 1, height - 1)
+        x_upper = np.minimum(x_lower + 1, width - 1)
+        y_weight = (y_range - y_lower)[:, np.newaxis]
+        x_weight = x_range - x_lower
+        rows = image[..., y_lower, :]*(1 - y_weight) + image[..., y_upper, :]*y_weight
+        return rows[..., x_lower]*(1 - x_weight) + rows[..., x_upper]*x_weight
+    
+    # interpolating bicubic spline through the pixels, the replacement of interp2d(kind = 'cubic') on a regular grid
+    if len(image.shape) == 3:
+        return np.array([_interpGrid(image_i, x_range, y_range, order = order) for image_i in image])
+    spline = RectBivariateSpline(np.arange(height), np.arange(width), image, kx = min(order, height - 1), ky = min(order, width - 1))
+    return spline(y_range, x_range)
+
 def cutImage(image, halfSize, x_cen = None, y_cen = None, halfSizeX = None, halfSizeY = None, mask = None, relative_shift = False, dx = None, dy = None):
     """Cut the given image"""
     
@@ -126,6 +182,7 @@ def cutImage(image, halfSize, x_cen = None, y_cen = None, halfSizeX = None, half
     
     if mask is None:
         mask = np.ones(image.shape)
+    mask = np.copy(mask)
     mask[np.where(mask < 0.9)] = 0
     mask[np.where(mask != 0)] = 1    
     
@@ -137,16 +194,9 @@ def cutImage(image, halfSize, x_cen = None, y_cen = None, halfSizeX = None, half
     image[np.isnan(image)] = 0
     
     
-    image_interp = interp2d(np.arange(image.shape[1]), np.arange(image.shape[0]), image)
-    mask_interp = interp2d(np.arange(image.shape[1]), np.arange(image.shape[0]), mask)
-    
-    
-
-    newImage = np.zeros((int(2*halfSizeY+1), int(2*halfSizeX+1)))
     x_range = np.round(np.arange(x_cen - halfSizeX, x_cen + halfSizeX + 0.1, 1), decimals = 2)
     y_range = np.round(np.arange(y_cen - halfSizeY, y_cen + halfSizeY + 0.1, 1), decimals = 2)
-    newImage = image_interp(x_range, y_range)
-    maskInterped = mask_interp(x_range, y_range) #Interpolate the image and mask
+    newImage, maskInterped = _interpGrid(np.array([image, mask]), x_range, y_range, order = 1) #Interpolate the image and mask
     
     maskInterped[np.where(maskInterped < 0.9)] = 0
     maskInterped[np.where(maskInterped == 0)] = np.nan
@@ -160,22 +210,25 @@ def bin_data(data, bin_size = 3, data_type = 'data', bin_method = 'average', mas
     
     The bin_method can be assigned with 'average' or 'sum':
         if 'sum', the raw binned data will be returned;
-        if 'average', the raw binned data will be divided by bin_size^2 then returned. If your data is already in unit of /arcsec^2, please use this option.
+        if 'average', the raw binned data will be divided by the number of non-NaN pixels in the box then returned. If your data is already in unit of /arcsec^2, please use this option.
+    
+    The data can be an image or a cube (binned image by image). The NaN's are ignored, and the data is padded with NaN's
+    (the extra pixel is on the top/right when an odd number is needed) to a multiple of bin_size before binning.
     """
+    data = np.array(data, dtype = 'float64')
     if data_type == 'uncertainty':
         data = data**2
-    if len(data.shape) == 3: # a cube
-        result = np.array([bin_data(data[i], bin_size = bin_size, data_type = data_type, bin_method = bin_method) for i in range(data.shape[0])])
-        return result
-                
-    total_size = np.ceil(data.shape[0] / bin_size) * bin_size
-    half_size = (total_size - 1)/2.0
-    data_extended = cutImage(data, halfSize=half_size)
-    data_extended[np.isnan(data_extended)] = 0
-    bin_matrix = np.zeros((int(total_size), int(total_size//bin_size)))
-    for i in range(int(total_size//bin_size)):
-        bin_matrix[bin_size*i:bin_size*(i+1), i] = 1
-    data_binned = np.dot(bin_matrix.T, np.dot(data_extended, bin_matrix))
+    
+    shape_binned = [int(np.ceil(size / bin_size)) for size in data.shape[-2:]]
+    padding = [(0, 0)] * (len(data.shape) - 2)
+    for size, size_binned in zip(data.shape[-2:], shape_binned):
+        pad = size_binned * bin_size - size
+        padding.append((pad//2, pad - pad//2))
+    data_extended = np.pad(data, padding, mode = 'constant', constant_values = np.nan)
+    blocks = data_extended.reshape(data.shape[:-2] + (shape_binned[0], bin_size, shape_binned[1], bin_size))
+    
+    data_binned = np.nansum(blocks, axis = (-3, -1))
+    counts = np.sum(~np.isnan(blocks), axis = (-3, -1))
     
     if bin_method == 'sum':
         if data_type == 'uncertainty':
@@ -183,18 +236,61 @@ def bin_data(data, bin_size = 3, data_type = 'data', bin_method = 'average', mas
         elif data_type == 'mask':
             raise Exception('Please use `average` for the bin_method option for a mask!')
     elif bin_method == 'average':
-        if data_type == 'data':
-            data_binned /= bin_size**2
-        elif data_type == 'uncertainty':
-            data_binned = np.sqrt(data_binned)
-            data_binned/= bin_size**2 #the extra power of 2 is because the raw data is squared for the uncertainty map
-        elif data_type == 'mask':
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if data_type == 'data':
+                data_binned /= counts  # NaN if there is no data in the box
+            elif data_type == 'uncertainty':
+                data_binned = np.sqrt(data_binned)/counts
+        if data_type == 'mask':
             data_binned[np.where(data_binned <= mask_thresh)] = 0
             data_binned[np.where(data_binned != 0)] = 1
     return data_binned
     
-def rotateImage(cube, mask = None, angle = None, reshape = False, new_width = None, new_height = None, thresh = 0.9, maskedNaN = False, outputMask = True, instrument = None):
-    """Rotate an image with 1 mask and 1 angle."""
+def rotateImage(cube, mask = None, angle = None, reshape = False, new_width = None, new_height = None, thresh = 0.9, maskedNaN = False, outputMask = True, instrument = None, method = 'scipy', order = 3):
+    """Rotate an image with 1 mask and 1 angle.
+    method: 'scipy' (default), rotate the image and the mask with scipy.ndimage.rotate();
+            'sparse', rotate them together with a cached rotation_operator, see rotationOperator();
+            'numba', rotate them together with the compiled kernel in rotationNumba (order = 1 or 3 only).
+    order: the spline order of the interpolation, 3 (bicubic) by default, or 1 (bilinear)."""
+    cube, mask = _prepareRotation(cube, mask = mask, reshape = reshape, new_width = new_width, new_height = new_height, thresh = thresh)
+              
+    #2. Rotate
+    if angle is None:
+        angle = 0
+    if method == 'numba':
+        from . import rotationNumba # imported only when used
+        results, rotatedMasks = rotationNumba.rotateStack(cube, mask, [angle], order = order, thresh = thresh, maskedNaN = maskedNaN, instrument = instrument)
+        if outputMask:
+            return results[0], rotatedMasks[0]
+        else:
+            return results[0]
+    if instrument == "GPI":
+        angle -= 66.5 #IFS rotation
+    if method == 'sparse':
+        result, rotatedMask = rotationOperator(cube.shape, angle, order = order).apply(np.array([cube, mask]))
+    else:
+        result = rotate(cube, angle, reshape = False, order = order)
+        rotatedMask = rotate(mask, angle, reshape = False, order = order)
+    
+    rotatedMask[np.where(rotatedMask < thresh)] = 0
+    rotatedMask[np.where(rotatedMask != 0)] = 1
+    
+    result *= rotatedMask
+        
+    if maskedNaN:
+        result[np.where(rotatedMask == 0)] = np.nan
+    
+    if instrument == "GPI":
+        result = np.fliplr(result)
+        rotatedMask = np.fliplr(rotatedMask)
+    
+    if outputMask:
+        return result, rotatedMask
+    else:
+        return result
+
+def _prepareRotation(cube, mask = None, reshape = False, new_width = None, new_height = None, thresh = 0.9):
+    """Step 1 of rotateImage(): return the image without NaN's and the binary mask to be rotated."""
     cube0 = np.copy(cube)
     cube0[np.where(np.isnan(cube0))] = 0
     
@@ -229,46 +325,72 @@ def rotateImage(cube, mask = None, angle = None, reshape = False, new_width = No
             mask2[np.where(mask == 0)] = 0
             mask = np.copy(mask2)
             cube = cube0
-            
-              
-    #2. Rotate
-    if angle is None:
-        angle = 0
+    return cube, mask
+
+def _rotateStack(cubes, masks, angles, thresh = 0.9, maskedNaN = False, instrument = None, order = 3):
+    """Step 2 of rotateImage() with method = 'sparse' for many frames: the images and masks of the frames with the same angle are 
+    rotated together in one sparse matrix product.
+    Input:
+        cubes, masks: outputs of _prepareRotation(), either 3D (one for each angle), or 2D (the same image and mask for all the angles);
+        angles: 1D array of the angles.
+    Output:
+        results, rotatedMasks: 3D arrays."""
+    angles = np.asarray(angles, dtype = 'float64')
     if instrument == "GPI":
-        angle -= 66.5 #IFS rotation
-    result = rotate(cube, angle, reshape = False)
-    rotatedMask = rotate(mask, angle, reshape = False)
+        angles = angles - 66.5 #IFS rotation
+    shape = cubes.shape[-2:]
+    n_frames = angles.shape[0]
+    # the spline prefilters only depend on the shape, so all the frames are filtered at once
+    if len(cubes.shape) == 2:
+        coefficients = rotationOperator(shape, angles[0], order = order).prefilter(np.array([cubes, masks]))
+    else:
+        coefficients = rotationOperator(shape, angles[0], order = order).prefilter(np.concatenate([cubes, masks]))
     
-    rotatedMask[np.where(rotatedMask < thresh)] = 0
-    rotatedMask[np.where(rotatedMask != 0)] = 1
+    results = np.zeros((n_frames, ) + tuple(shape))
+    rotatedMasks = np.zeros(results.shape)
+    angles_unique, angle_index = np.unique(angles, return_inverse = True)
+    for j, angle in enumerate(angles_unique):
+        frames = np.where(angle_index == j)[0]
+        if len(cubes.shape) == 2:
+            rotated = rotationOperator(shape, angle, order = order).apply(coefficients, prefiltered = True)
+            results[frames] = rotated[0]
+            rotatedMasks[frames] = rotated[1]
+        else:
+            rotated = rotationOperator(shape, angle, order = order).apply(coefficients[np.concatenate([frames, frames + n_frames])], prefiltered = True)
+            results[frames] = rotated[:frames.shape[0]]
+            rotatedMasks[frames] = rotated[frames.shape[0]:]
     
-    result *= rotatedMask
-        
+    rotatedMasks[np.where(rotatedMasks < thresh)] = 0
+    rotatedMasks[np.where(rotatedMasks != 0)] = 1
+    results *= rotatedMasks
     if maskedNaN:
-        result[np.where(rotatedMask == 0)] = np.nan
-    
+        results[np.where(rotatedMasks == 0)] = np.nan
     if instrument == "GPI":
-        result = np.fliplr(result)
-        rotatedMask = np.fliplr(rotatedMask)
-    
-    if outputMask:
-        return result, rotatedMask
-    else:
-        return result
+        results = results[:, :, ::-1]
+        rotatedMasks = rotatedMasks[:, :, ::-1]
+    return results, rotatedMasks
 
-def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = None, new_height = None, thresh = 0.9, maskedNaN = False, outputMask = True, instrument = None):
+def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = None, new_height = None, thresh = 0.9, maskedNaN = False, outputMask = True, instrument = None, method = 'scipy', order = 3):
     """Rotation function for a cube.
     =======
     Input:
             cube (2- or 3-D array): either an image or an image cube
             mask (2- or 3-D array): either a mask or a mask cube
             angle (float number or 1-D array): either an angle or an angle array
+                (for a single image and mask, the repeated angles are rotated only once)
             reshape (boolean): change the size? If yes,
                 new_width (integer): new width of the output (can be larger or smaller than before)
                 new_height (integer): new height of the output (can be larger or smaller then before)
             thresh (float, 0 to 1): if the mask is smaller than 0.9 then it will be regarded as 0
             maskedNaN (boolean): put the masked pixels as NaN value?
             outputMask (boolean): output the rotated mask(s)?
+            method (string): 'scipy' (default), rotate each image and mask with scipy.ndimage.rotate();
+                'sparse', use the cached sparse rotation operators (see rotationOperator()), the images and masks of all the frames 
+                with the same angle are rotated together in one matrix product. The results are the same to rounding errors,
+                and the operators are reused when the same angles are used again, e.g., the parallactic angles in an MCMC.
+                'numba', use the compiled kernel in rotationNumba, all the frames are rotated in parallel threads in one call,
+                without building operators, e.g., when the angles change for each call.
+            order (integer): the spline order of the interpolation, 3 (bicubic) by default, or 1 (bilinear).
     Output:
             first one: results
             second one: rotatedMasks (only when outputMask == True)
@@ -288,6 +410,29 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
         angle = [angle]
     angle = np.asarray(angle)  
     
+    if method in ('sparse', 'numba') and (len(angle) > 1 or len(cube0.shape) == 3) and not (len(cube0.shape) == 2 and (mask is not None) and len(mask.shape) == 3):
+        angle_sparse = np.array([0 if angle_i is None else angle_i for angle_i in angle], dtype = 'float64')
+        if len(cube0.shape) == 2:
+            #single image and mask: filtered once, rotated for each unique angle
+            cubes, masks = _prepareRotation(cube0, mask = mask0, reshape = reshape, new_width = new_width, new_height = new_height, thresh = thresh)
+        else:
+            if (mask is None) or (len(mask.shape) == 2):
+                mask = [mask0] * cube0.shape[0]
+            if len(angle_sparse) == 1:
+                angle_sparse = np.asarray([angle_sparse[0]] * cube0.shape[0])
+            prepared = [_prepareRotation(cube0[i], mask = mask[i], reshape = reshape, new_width = new_width, new_height = new_height, thresh = thresh) for i in range(cube0.shape[0])]
+            cubes = np.array([prepared_i[0] for prepared_i in prepared])
+            masks = np.array([prepared_i[1] for prepared_i in prepared])
+        if method == 'numba':
+            from . import rotationNumba # imported only when used
+            results, rotatedMasks = rotationNumba.rotateStack(cubes, masks, angle_sparse, order = order, thresh = thresh, maskedNaN = maskedNaN, instrument = instrument)
+        else:
+            results, rotatedMasks = _rotateStack(cubes, masks, angle_sparse, thresh = thresh, maskedNaN = maskedNaN, instrument = instrument, order = order)
+        if outputMask:
+            return results, rotatedMasks
+        else:
+            return results
+    
     if len(cube0.shape) == 2:
         # print("\tJust one input image, look easy.")
         #single image
@@ -298,33 +443,38 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
                 # print("\t\t\t Just one input mask (or none), duplicating to make a mask cube.")
                 #if single mask, then make multiple masks
                 mask = np.asarray([mask0] * len(angle))
+                #the same image and mask for all the angles: rotate only once for each unique angle, then copy the result to the repeated ones
+                angle_unique, frames_unique, angle_index = np.unique(angle, return_index = True, return_inverse = True)
+            else:
+                frames_unique = np.arange(len(angle))
+                angle_index = np.arange(len(angle))
                 
             #calculation
             if outputMask:
                 #need rotated masks
                 # print("\t\t\t\t Rotating...")
-                for i in range(len(angle)):
+                for j, i in enumerate(frames_unique):
                     results_temp, rotatedMask_temp = rotateImage(cube, mask = mask[i], angle = angle[i], reshape = reshape,
                                                              new_width = new_width, new_height = new_height, thresh = thresh,
-                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
-                    if i == 0:
+                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
+                    if j == 0:
                         results = np.zeros((mask.shape[0], ) + results_temp.shape)
                         rotatedMasks = np.zeros(results.shape)
-                    results[i] = results_temp
-                    rotatedMasks[i] = rotatedMask_temp
+                    results[angle_index == j] = results_temp
+                    rotatedMasks[angle_index == j] = rotatedMask_temp
                 # print("\t\t\t\t\t Done. Returning.")
                 return results, rotatedMasks
             else:
                 #don't need rotated masks
                 # print("\t\t\t\t Rotating...")
-                for i in range(len(angle)):
+                for j, i in enumerate(frames_unique):
                     # print(i, cube.shape, mask, angle[i])
                     results_temp = rotateImage(cube, mask = mask[i], angle = angle[i], reshape = reshape,
                                              new_width = new_width, new_height = new_height, thresh = thresh,
-                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
-                    if i == 0:
+                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
+                    if j == 0:
                         results = np.zeros((mask.shape[0], ) + results_temp.shape)
-                    results[i] = results_temp
+                    results[angle_index == j] = results_temp
                 # print("\t\t\t\t\t Done. Returning.")
                 return results
         else:
@@ -337,14 +487,14 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
                     pass # print("\t\t\t\t Returning results.")
                 return rotateImage(cube, mask = mask, angle = angle[0], reshape = reshape,
                                    new_width = new_width, new_height = new_height, thresh = thresh,
-                                   maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
+                                   maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
             else:
                 # print("\t\t\t Hmmmmm, several masks, working on that...")
                 if outputMask:
                     for i in range(mask.shape[0]):
                         results_temp, rotatedMask_temp = rotateImage(cube, mask = mask[i], angle = angle[0], reshape = reshape,
                                                                      new_width = new_width, new_height = new_height, thresh = thresh,
-                                                                     maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
+                                                                     maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
                         if i == 0:
                             results = np.zeros((mask.shape[0], ) + results_temp.shape)
                             rotatedMasks = np.zeros(results.shape)
@@ -356,7 +506,7 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
                     for i in range(mask.shape[0]):
                         results_temp = rotateImage(cube, mask = mask[i], angle = angle[0], reshape = reshape,
                                                                      new_width = new_width, new_height = new_height, thresh = thresh,
-                                                                     maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
+                                                                     maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
                         if i == 0:
                             results = np.zeros((mask.shape[0], ) + results_temp.shape)
                         results[i] = results_temp
@@ -377,7 +527,7 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
             for i in range(cube0.shape[0]):
                 results_temp, rotatedMask_temp = rotateImage(cube0[i], mask = mask[i], angle = angle[i], reshape = reshape,
                                                              new_width = new_width, new_height = new_height, thresh = thresh,
-                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
+                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
                 if i == 0:
                     results = np.zeros((mask.shape[0], ) + results_temp.shape)
                     rotatedMasks = np.zeros(results.shape)
@@ -389,9 +539,237 @@ def rotateCube(cube, mask = None, angle = None, reshape = False, new_width = Non
             for i in range(cube0.shape[0]):
                 results_temp = rotateImage(cube0[i], mask = mask[i], angle = angle[i], reshape = reshape,
                                                              new_width = new_width, new_height = new_height, thresh = thresh,
-                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument)
+                                                             maskedNaN = maskedNaN, outputMask = outputMask, instrument = instrument, method = method, order = order)
                 if i == 0:
                     results = np.zeros((mask.shape[0], ) + results_temp.shape)
                 results[i] = results_temp
             # print("\t\t\t\t Returning results.")
-            return results     
+            return results
+
+
+# Cache of the rotation operators used by rotateImage() and rotateCube() with method = 'sparse', the least recently used ones are deleted
+# beyond `rotation_operators_max` operators. Each operator takes about 200 bytes per pixel, e.g., 5 MB for 161*161 images.
+rotation_operators_max = 128
+_rotation_operators = OrderedDict()
+_rotation_operators_lock = threading.Lock()
+
+def rotationOperator(shape, angle, order = 3):
+    """Return the rotation_operator for (shape, angle, order), built only once and cached.
+    Input:
+        shape: the shape of the images, (width_y, width_x);
+        angle: the rotation angle in degrees, the same as in rotate();
+        order: the spline order, the same as in rotate(), 3 by default.
+    Output:
+        a rotation_operator object."""
+    key = (tuple(int(n) for n in shape), float(angle), int(order))
+    with _rotation_operators_lock:
+        if key in _rotation_operators:
+            _rotation_operators.move_to_end(key)
+            return _rotation_operators[key]
+    operator = rotation_operator(key[0], key[1], order = key[2])
+    with _rotation_operators_lock:
+        _rotation_operators[key] = operator
+        while len(_rotation_operators) > rotation_operators_max:
+            _rotation_operators.popitem(last = False)
+    return operator
+
+@lru_cache(maxsize = 16)
+def _splineFilterMatrix(n, order):
+    """The spline prefilter of scipy.ndimage (mode = 'constant') along an axis of length n, as a matrix."""
+    result = spline_filter1d(np.eye(n), order = order, axis = 0, mode = 'constant')
+    result.flags.writeable = False
+    return result
+
+class rotation_operator:
+    """The rotation of scipy.ndimage.rotate(image, angle, reshape = False) (i.e., the one in rotateImage()) for a fixed image shape and angle,
+    as a linear operator: the spline prefilter is a dense matrix for each axis, and the interpolation is a sparse matrix.
+    Build it once, then apply it to many images (e.g., the models in an MCMC) without redoing the interpolation weights.
+    Input:
+        shape: the shape of the images, (width_y, width_x);
+        angle: the rotation angle in degrees, the same as in rotate();
+        order: the spline order, the same as in rotate(), 3 by default.
+    Example:
+        rotator = rotation_operator(image.shape, angle = 30)
+        result = rotator.apply(image)     # equal to rotate(image, 30, reshape = False) to rounding errors
+    """
+    def __init__(self, shape, angle, order = 3):
+        self.shape = tuple(shape)
+        self.angle = angle
+        self.order = order
+        if order > 1:       # the same prefilter as rotate() in its default 'constant' mode
+            self.filters = [_splineFilterMatrix(n, order) for n in self.shape]
+        else:
+            self.filters = None
+        
+        cos = special.cosdg(angle)                      # exact for multiples of 90 degrees, the same as in rotate()
+        sin = special.sindg(angle)
+        rot_matrix = np.array([[cos, sin], [-sin, cos]])
+        center = (np.asarray(self.shape) - 1)/2.0
+        offset = center - np.dot(rot_matrix, center)
+        
+        # The interpolation weights are found by interpolating the impulses on a grid with spacing `step`: each output pixel
+        # uses at most (order + 1)**2 neighboring input pixels, hence it responds to only one impulse in each probe image.
+        step = order + 5
+        y_in, x_in = np.dot(rot_matrix, np.indices(self.shape).reshape(2, -1)) + offset[:, np.newaxis]
+        rows, cols, values = [], [], []
+        for dy in range(step):
+            for dx in range(step):
+                probe = np.zeros(self.shape)
+                probe[dy::step, dx::step] = 1
+                response = affine_transform(probe, rot_matrix, offset, order = order, mode = 'constant', prefilter = False).flatten()
+                pixels = np.where(response != 0)[0]
+                source_y = dy + step*np.round((y_in[pixels] - dy)/step).astype(int)
+                source_x = dx + step*np.round((x_in[pixels] - dx)/step).astype(int)
+                rows.append(pixels)
+                cols.append(np.ravel_multi_index((np.clip(source_y, 0, self.shape[0] - 1), np.clip(source_x, 0, self.shape[1] - 1)), self.shape))
+                values.append(response[pixels])
+        size = self.shape[0]*self.shape[1]
+        self.matrix = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape = (size, size))
+        
+    def prefilter(self, images):
+        """Return the spline coefficients of an image, or of an image cube (then all the images are filtered at once)."""
+        images = np.asarray(images, dtype = 'float64')
+        if self.filters is None:
+            return images
+        return np.matmul(np.matmul(self.filters[0], images), self.filters[1].T)
+    
+    def apply(self, images, pixels = None, prefiltered = False):
+        """Rotate an image, or an image cube (then all the images are rotated by the same angle).
+        Input:
+            images: 2D or 3D array, without NaN's;
+            pixels: 1D array of the flattened indices of the output pixels. If given, only these pixels are returned (flattened);
+            prefiltered: if True, `images` are already the output of prefilter() (e.g., to rotate them by several angles).
+        Output:
+            The rotated image(s), or the values at `pixels`."""
+        coefficients = images if prefiltered else self.prefilter(images)
+        matrix = self.matrix if pixels is None else self.matrix[pixels]
+        if coefficients.ndim == 2:
+            result = matrix.dot(coefficients.flatten())
+            return result if pixels is not None else result.reshape(self.shape)
+        result = matrix.dot(coefficients.reshape(coefficients.shape[0], -1).T).T
+        return result if pixels is not None else result.reshape(coefficients.shape)
+
+# The psf_convolution objects are cached by the content of the PSF, see psfConvolution(): the PSFs are fixed during a run,
+# so their Fourier transforms are calculated only once for each image shape.
+psf_convolutions_max = 16
+_psf_convolutions = OrderedDict()
+_psf_convolutions_lock = threading.Lock()
+
+def psfConvolution(psf):
+    """Return the psf_convolution for `psf`, built only once and cached (the PSF is identified by its values).
+    Input:
+        psf: 2D array, the centered PSF.
+    Output:
+        a psf_convolution object.
+    Example:
+        convolved = psfConvolution(psf).apply(cube)     # equal to image_registration.fft_tools.convolve_nd.convolvend(image, psf) for each image"""
+    psf = np.ascontiguousarray(psf, dtype = 'float64')
+    key = (psf.shape, hashlib.sha1(psf.tobytes()).hexdigest())
+    with _psf_convolutions_lock:
+        if key in _psf_convolutions:
+            _psf_convolutions.move_to_end(key)
+            return _psf_convolutions[key]
+    convolution = psf_convolution(psf)
+    with _psf_convolutions_lock:
+        _psf_convolutions[key] = convolution
+        while len(_psf_convolutions) > psf_convolutions_max:
+            _psf_convolutions.popitem(last = False)
+    return convolution
+
+def cropSupport(psf):
+    """Crop a centered PSF to the smallest box around its non-zero pixels, keeping the center of the PSF (pixel (psf.shape[0]//2, psf.shape[1]//2))
+    at the center of the box, e.g., a 315*315 PSF that is zero outside a 19*19 region becomes a 19*19 one.
+    Input:
+        psf: 2D array, the centered PSF, NaN's are treated as 0.
+    Output:
+        The cropped PSF, of odd sizes, the convolutions with it are the same as with `psf`."""
+    psf = np.nan_to_num(np.asarray(psf, dtype = 'float64'))
+    center_y, center_x = psf.shape[0]//2, psf.shape[1]//2
+    rows = np.where(np.any(psf != 0, axis = 1))[0]
+    columns = np.where(np.any(psf != 0, axis = 0))[0]
+    if len(rows) == 0:
+        return np.zeros((1, 1))
+    half_y = max(center_y - rows[0], rows[-1] - center_y)
+    half_x = max(center_x - columns[0], columns[-1] - center_x)
+    psf_padded = np.pad(psf, ((half_y, half_y), (half_x, half_x))) # in case the box is not inside the PSF array
+    return psf_padded[center_y:center_y + 2*half_y + 1, center_x:center_x + 2*half_x + 1]
+
+class psf_convolution:
+    """Convolution of images with a fixed PSF, the same as image_registration.fft_tools.convolve_nd.convolvend(image, psf)
+    with its default options (the images are zero outside their boundaries, the NaN's are treated as 0, and the PSF is centered at pixel
+    (psf.shape[0]//2, psf.shape[1]//2)). The PSF is cropped to its non-zero region first (see cropSupport()).
+    The convolution is either direct (scipy.ndimage.convolve, for small PSFs), or through real FFTs, where the transform of the PSF is 
+    calculated once for each image shape and reused. With method = 'auto', the faster one is measured for each image shape.
+    Input:
+        psf: 2D array, the centered PSF;
+        method: 'auto' (default), 'fft' or 'direct'.
+    Example:
+        convolution = psf_convolution(psf)
+        result = convolution.apply(cube)                # convolve each image in the cube
+    """
+    def __init__(self, psf, method = 'auto'):
+        if method not in ('auto', 'fft', 'direct'):
+            raise ValueError("The method should be 'auto', 'fft' or 'direct'!")
+        self.psf = cropSupport(psf)
+        self.psf.flags.writeable = False
+        self.method = method
+        self._transforms = {}
+        self._methods = {}
+        self._transforms_lock = threading.Lock()
+        
+    def choose_method(self, shape, repeats = 3):
+        """Return the faster method ('fft' or 'direct') for images of the given shape, (width_y, width_x), timed once and cached."""
+        if self.method != 'auto':
+            return self.method
+        shape = tuple(int(n) for n in shape)
+        with self._transforms_lock:
+            if shape in self._methods:
+                return self._methods[shape]
+        image = np.ones(shape)
+        costs = {}
+        for method in ('fft', 'direct'):
+            self._convolve(image, method)                   # the FFT transform of the PSF is calculated here, not timed
+            cost = np.inf
+            for i in range(repeats):
+                start = time.perf_counter()
+                self._convolve(image, method)
+                cost = min(cost, time.perf_counter() - start)
+            costs[method] = cost
+        result = min(costs, key = costs.get)
+        with self._transforms_lock:
+            self._methods[shape] = result
+        return result
+        
+    def transform(self, shape):
+        """Return the padded shape and the real FFT of the PSF for images of the given shape, (width_y, width_x).
+        The images are zero-padded to at least image + PSF sizes (no wrap-around) with fast FFT lengths."""
+        shape = tuple(int(n) for n in shape)
+        with self._transforms_lock:
+            if shape in self._transforms:
+                return self._transforms[shape]
+        shape_fft = tuple(fft.next_fast_len(n + m - 1, real = True) for n, m in zip(shape, self.psf.shape))
+        psf_padded = np.zeros(shape_fft)
+        psf_padded[:self.psf.shape[0], :self.psf.shape[1]] = self.psf
+        psf_padded = np.roll(psf_padded, (-(self.psf.shape[0]//2), -(self.psf.shape[1]//2)), axis = (0, 1)) # the PSF center at pixel (0, 0)
+        result = (shape_fft, fft.rfft2(psf_padded))
+        with self._transforms_lock:
+            self._transforms[shape] = result
+        return result
+    
+    def apply(self, images, workers = None):
+        """Convolve an image, or a cube of images (along the last two axes), with the PSF.
+        Input:
+            images: 2D or 3D array;
+            workers: number of threads for scipy.fft, None for the scipy default (see scipy.fft.set_workers()), not used by the direct method.
+        Output:
+            The convolved image(s), of the same shape as `images`."""
+        images = np.array(images, dtype = 'float64')
+        images[np.isnan(images)] = 0
+        return self._convolve(images, self.choose_method(images.shape[-2:]), workers = workers)
+    
+    def _convolve(self, images, method, workers = None):
+        if method == 'direct':    # the cropped PSF has odd sizes, then scipy.ndimage.convolve has the same center
+            return convolve(images, self.psf.reshape((1, ) * (len(images.shape) - 2) + self.psf.shape), mode = 'constant', cval = 0)
+        shape_fft, psf_fft = self.transform(images.shape[-2:])
+        result = fft.irfft2(fft.rfft2(images, s = shape_fft, workers = workers) * psf_fft, s = shape_fft, workers = workers)
+        return np.ascontiguousarray(result[..., :images.shape[-2], :images.shape[-1]])
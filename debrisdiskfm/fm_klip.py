@@ -1,8 +1,9 @@
 from astropy.io import fits
 import numpy as np
+from scipy.linalg import eigh
+from scipy.sparse.linalg import svds
 
 from . import dependencies
-import image_registration
 
 # returns the KLIPped model
 
@@ -52,7 +53,7 @@ def flattenAndNormalize(image, mask = None, onlyMasked = True):
             result[i], std[i] = flattenAndNormalize(image_slice, mask = mask, onlyMasked = onlyMasked)
         return result, std
 
-def pcaImageCube(ref, mask = None, pcNum = None, cube=True, ref3D=True, outputEval = False):
+def pcaImageCube(ref, mask = None, pcNum = None, cube=True, ref3D=True, outputEval = False, method = 'eigh'):
     """Principal Component Analysis, 
     Input: 
         ref: Cube of references, 3D; 
@@ -62,6 +63,9 @@ def pcaImageCube(ref, mask = None, pcNum = None, cube=True, ref3D=True, outputEv
         cube: output as a cube? Otherwise a flattend 2D component array will be returned.
         ref3D: Ture by default.
         outputEval: whether to return the eigen values, False by default.
+        method: 'eigh' (default), only the largest pcNum eigenvectors of the (symmetric) covariance matrix of the references are calculated;
+            'svd', singular value decomposition of the references (truncated when pcNum is small), 
+            more accurate for nearly degenerate references, but slower when there are much fewer references than pixels.
     Output:
         The principal components, either cube (3D) or flattend (2D)."""
     if mask is None:
@@ -70,40 +74,44 @@ def pcaImageCube(ref, mask = None, pcNum = None, cube=True, ref3D=True, outputEv
         pcNum = ref.shape[0]
     if ref3D:
         mask_flat = mask.flatten()
-        ref_flat = np.zeros((ref.shape[0], np.where(mask_flat == 1)[0].shape[0]))
-        for i in range(ref_flat.shape[0]):
-            ref_flat[i], std = flattenAndNormalize(ref[i], mask)
+        ref_flat = np.asarray(ref, dtype = 'float64').reshape(ref.shape[0], -1)[:, np.where(mask_flat == 1)[0]]
+        ref_flat = ref_flat - np.nanmean(ref_flat, axis = 1)[:, np.newaxis] # the same as flattenAndNormalize() for each reference
+        ref_flat /= np.nanstd(ref_flat, axis = 1)[:, np.newaxis]
     else:
         ref_flat = ref
         if np.shape(mask.shape)[0] == 1: #1D mask, already flattened
             mask_flat = mask
         elif np.shape(mask.shape)[0] == 2: #2D mask, need flatten
             mask_flat = mask.flatten()
-        
-    covMatrix = np.dot(ref_flat, np.transpose(ref_flat))
-    eVal, eVec = np.linalg.eig(covMatrix)
-    index = (-eVal).argsort()[:pcNum]
-    eVec = eVec[:,index]
-    components_flatten = np.dot(np.transpose(eVec), ref_flat)
     
-    pc_flat = np.zeros((pcNum, mask_flat.shape[0]))
+    if method == 'svd':
+        if pcNum < min(ref_flat.shape) - 1:
+            u, singular, components_flatten = svds(ref_flat, k = pcNum)
+        else:
+            u, singular, components_flatten = np.linalg.svd(ref_flat, full_matrices = False)
+        index = (-singular).argsort()[:pcNum]
+        eVal = singular[index]**2
+        components_flatten = components_flatten[index]
+    else:
+        covMatrix = np.dot(ref_flat, np.transpose(ref_flat))
+        eVal, eVec = eigh(covMatrix, subset_by_index = [covMatrix.shape[0] - pcNum, covMatrix.shape[0] - 1])
+        eVal = eVal[::-1]
+        eVec = eVec[:, ::-1]
+        components_flatten = np.dot(np.transpose(eVec), ref_flat)
     
-    for i in range(pc_flat.shape[0]):
-        pc_flat[i][np.where(mask_flat==1)] = components_flatten[i]/np.sqrt(np.dot(components_flatten[i], np.transpose(components_flatten[i])))
+    pc_flat = np.zeros((pcNum, mask_flat.shape[0]))
+    pc_flat[:, np.where(mask_flat==1)[0]] = components_flatten/np.sqrt(np.sum(components_flatten**2, axis = 1))[:, np.newaxis]
     if cube == False:
         return pc_flat
     
-    pc_cube = np.zeros((pcNum, mask.shape[0], mask.shape[1]))
-    width = mask.shape[0]
-    for i in range(pc_flat.shape[0]):
-        pc_cube[i] = np.array(np.split(pc_flat[i], width))
+    pc_cube = pc_flat.reshape(pcNum, mask.shape[0], mask.shape[1])
         
     if not outputEval:
         return pc_cube
     else:
-        return pc_cube, eVal[index]
+        return pc_cube, eVal
            
-def klip(trg, pcs, mask = None, klipK = None, cube = True, trg2D=True):
+def klip(trg, pcs, mask = None, klipK = None, cube = True, trg2D=True, klipKs = None):
     """KLIP Algorithm. 
     Input:
         trg: target image, 2D; 
@@ -113,6 +121,8 @@ def klip(trg, pcs, mask = None, klipK = None, cube = True, trg2D=True):
             Requirement: For the 2D cube, components are on rows.
         klipK: the truncation value.
         trg2D: is the target a 2D image?
+        klipKs: the truncation values (numbers of KL modes, from 1 to klipK) of the output slices when cube == True, 
+            e.g., [5, 10, 20]. Default is None, i.e., all the truncations 1, 2, ..., klipK.
     Output:
         Image, if cube == False;
         Cube Image of all the slices, if cube == True.
@@ -152,35 +162,229 @@ def klip(trg, pcs, mask = None, klipK = None, cube = True, trg2D=True):
         temp_result = result_flat
         return temp_result.reshape(width, width_x) * std
     else:
-        result_flat = np.dot(np.ones((klipK, 1)), 
-                        trg_flat[np.newaxis]) - np.dot(np.tril(np.ones((klipK, klipK))),
-                                                   coef * pcs_flat)
-        result = np.zeros((klipK, width, width_x))
-        for i in range(klipK):
-            temp_result =  result_flat[i]
-            result[i] = temp_result.reshape(width, width_x)
-        return result*std
+        if klipKs is None:
+            # the projections onto the first 1, 2, ..., klipK components are the cumulative sums
+            result_flat = coef * pcs_flat
+            np.cumsum(result_flat, axis = 0, out = result_flat)
+        else:
+            # only the requested truncations: sum the projections between consecutive truncations, then accumulate
+            klipKs = np.asarray(klipKs, dtype = 'int')
+            truncations, index = np.unique(klipKs, return_inverse = True)
+            bounds = np.concatenate([[0], truncations])
+            result_flat = np.array([np.dot(coef[bounds[i]:bounds[i+1], 0], pcs_flat[bounds[i]:bounds[i+1]]) for i in range(truncations.shape[0])])
+            np.cumsum(result_flat, axis = 0, out = result_flat)
+            result_flat = result_flat[index]
+        result_flat = trg_flat[np.newaxis] - result_flat
+        return result_flat.reshape(result_flat.shape[0], width, width_x)*std
+
+
+def klip_batch(trgs, pcs, mask = None, klipK = None):
+    """KLIP Algorithm for a cube of targets at once, the same as klip(trg, pcs, mask, cube = False) for each target.
+    The masked pixels are compacted only once, and the projections of all the targets are done with matrix products.
+    Input:
+        trgs: target images, 3D;
+        pcs: principal components from PCA, either shared by all the targets (3D, n_modes*width*width_x),
+            or one set for each target (4D, n_targets*n_modes*width*width_x);
+        mask: 0-1 mask, either shared (2D) or one for each target (3D); the NaN pixels of each target are excluded. It is not modified.
+        klipK: the truncation value.
+    Output:
+        Cube of the KLIP results, one for each target.
+    """
+    trgs = np.asarray(trgs, dtype = 'float64')
+    pcs = np.asarray(pcs, dtype = 'float64')
+    if mask is None:
+        mask = np.ones(trgs.shape[1:])
+    if klipK is None:
+        klipK = pcs.shape[-3]
+    n_trgs = trgs.shape[0]
+    
+    trgs_flat = trgs.reshape(n_trgs, -1)
+    masks_flat = np.broadcast_to(np.asarray(mask), trgs.shape).reshape(n_trgs, -1) == 1
+    masks_flat = masks_flat & ~np.isnan(trgs_flat)
+    pixels = np.where(np.any(masks_flat, axis = 0))[0]         # the masked pixels of at least one target
+    
+    weights = masks_flat[:, pixels]
+    trgs_masked = np.where(weights, trgs_flat[:, pixels], 0)
+    trgs_masked -= (np.sum(trgs_masked, axis = 1)/np.sum(weights, axis = 1))[:, np.newaxis]
+    trgs_masked *= weights
+    
+    if len(pcs.shape) == 3:
+        pcs_flat = pcs[:klipK].reshape(klipK, -1)
+        coef = np.dot(trgs_masked, pcs_flat[:, pixels].T)
+        results = - np.dot(coef, pcs_flat)
+    else:
+        pcs_flat = pcs[:, :klipK].reshape(n_trgs, klipK, -1)
+        coef = np.matmul(pcs_flat[:, :, pixels], trgs_masked[:, :, np.newaxis])     # batched matrix products
+        results = - np.matmul(coef.transpose(0, 2, 1), pcs_flat)[:, 0]
+    results[:, pixels] += trgs_masked
+    return results.reshape(trgs.shape)
+
+
+def klip_model_subtracted(obs_flat, model_flat, pcNum, obs_gram = None):
+    """KLIP of the observation minus a model (e.g., negative injection in ADI), with the KL modes of the model subtracted observation itself.
+    The same as pcaImageCube(obs - model, mask, pcNum) followed by klip_batch() with these modes, but the covariance matrix is updated
+    from the one of the observation with the low-rank model terms, which only involve the pixels where the model is not 0:
+        (X - M)(X - M)^T = X X^T - X M^T - M X^T + M M^T, for the mean subtracted frames X and M.
+    The KLIP results are then (X - M) - D V V^T D^{-1} (X - M), with D the standard deviations of the frames, 
+    and V the first pcNum eigenvectors of the normalized covariance matrix.
+    Input:
+        obs_flat: 2D array, n_frames * n_pixels, the masked pixels of the observation, without NaN's;
+        model_flat: 2D array, n_frames * n_pixels, the masked pixels of the model;
+        pcNum: how many principal components are needed;
+        obs_gram: the covariance matrix of the mean subtracted observation, i.e., gram_centered(obs_flat).
+            Calculate it only once for the same observation, if None, it is calculated here.
+    Output:
+        2D array, n_frames * n_pixels, the KLIP results on the masked pixels.
+    """
+    obs_flat = np.asarray(obs_flat, dtype = 'float64')
+    n_pixels = obs_flat.shape[1]
+    obs_centered = obs_flat - np.mean(obs_flat, axis = 1)[:, np.newaxis]
+    if obs_gram is None:
+        obs_gram = gram_centered(obs_flat)
+    
+    support = np.where(np.any(model_flat != 0, axis = 0))[0]
+    model_support = np.asarray(model_flat, dtype = 'float64')[:, support]
+    model_mean = np.sum(model_support, axis = 1)/n_pixels
+    cross = np.dot(obs_centered[:, support], model_support.T)   # the mean of the model does not matter, since obs_centered sums to 0
+    gram = obs_gram - cross - cross.T + np.dot(model_support, model_support.T) - n_pixels*np.outer(model_mean, model_mean)
+    
+    std = np.sqrt(np.diag(gram)/n_pixels)
+    eVal, eVec = eigh(gram/np.outer(std, std), subset_by_index = [gram.shape[0] - pcNum, gram.shape[0] - 1])
+    
+    residual = obs_centered - model_flat + model_mean[:, np.newaxis]
+    return residual - np.dot(std[:, np.newaxis]*eVec, np.dot(eVec.T/std, residual))
+
+def gram_centered(obs_flat):
+    """The covariance matrix (without normalization) of the mean subtracted frames, for klip_model_subtracted().
+    Input:
+        obs_flat: 2D array, n_frames * n_pixels, the masked pixels of the observation, without NaN's.
+    Output:
+        2D array, n_frames * n_frames."""
+    obs_centered = obs_flat - np.mean(obs_flat, axis = 1)[:, np.newaxis]
+    return np.dot(obs_centered, obs_centered.T)
+
+
+class klip_fm_operator:
+    """The KLIP forward modeling of klip_fm_main() (rotation to the roll angles, masking, projection onto the KL modes of each frame, 
+    derotation, and the nan-mean), precomputed as a linear operator for fixed angles, KL modes and mask.
+    All the steps are linear in the (convolved) model image, and depend on it only through 
+        - the rotations: dependencies.rotation_operator(), i.e., dense spline prefilters and a sparse interpolation matrix for each unique angle;
+        - the KLIP of the frames with the same angle: x - mean(x) - Z^T (C (x - mean(x))), with C and Z the KL modes on the masked and on the kept pixels.
+    Build it once (e.g., in lnlike.data_input_hd191089 with `nicmos_operator = True`), then apply() it to each model.
+    Input:
+        components: the KL modes, shape (n_frames, n_modes, width, width), same as in klip_fm_main();
+        mask: the KLIP mask, same as in klip_fm_main();
+        angles: the roll angles, default are the ones for the HD 191089 NICMOS observations;
+        pipeline_input: the pipeline used for the reduction, 'ALICE' by default;
+        alice_size: the image size of the ALICE pipeline, 140 by default.
+    Example:
+        fm_operator = klip_fm_operator(components, mask)
+        result = klip_fm_main(path_model, psf = psf, fm_operator = fm_operator)
+    """
+    def __init__(self, components, mask, angles = None, pipeline_input = 'ALICE', alice_size = None):
+        if angles is None:
+            angles = np.concatenate([[19.5699]*4, [49.5699]*4]) # The values are hard coded for HD 191089 NICMOS observations, pelase change it for other targets.
+        angles = np.asarray(angles, dtype = 'float64')
+        components = np.asarray(components, dtype = 'float64')
+        mask = np.asarray(mask)
+        if pipeline_input == 'ALICE':
+            if alice_size is None:
+                alice_size = 140
+            mask = mask[1:, 1:]
+            components = components[..., 1:, 1:]
+        self.pipeline_input = pipeline_input
+        self.alice_size = alice_size
+        self.shape = mask.shape
+        
+        self.terms = []
+        count = np.zeros(self.shape)
+        for angle in np.unique(angles):
+            frames = np.where(angles == angle)[0]
+            rotator = dependencies.rotationOperator(self.shape, angle)
+            derotator = dependencies.rotationOperator(self.shape, -angle)
+            
+            mask_rotated = rotator.apply(np.ones(self.shape))               # the masks in rotateImage()
+            mask_rotated = np.where(mask_rotated < 0.9, 0, 1) * mask
+            pixels_klip = np.where(mask_rotated.flatten() == 1)[0]          # used in the KLIP, see flattenAndNormalize()
+            pixels_kept = np.where(mask_rotated.flatten() != 0)[0]          # not NaN after the KLIP
+            
+            mask_derotated = derotator.apply(np.where(mask_rotated != 0, 1.0, 0.0))
+            pixels_derotated = np.where(mask_derotated.flatten() >= 0.9)[0]
+            count.flat[pixels_derotated] += frames.shape[0]
+            
+            pcs = components[frames].reshape(frames.shape[0]*components.shape[1], -1)
+            self.terms.append({'rotation_klip': rotator.matrix[pixels_klip], 'derotation': derotator.matrix[pixels_derotated], 'n_frames': frames.shape[0],
+                               'pixels_klip': pixels_klip, 'pixels_kept': pixels_kept, 'pixels_derotated': pixels_derotated,
+                               'klip_in_kept': np.isin(pixels_kept, pixels_klip),
+                               'pcs_klip': np.ascontiguousarray(pcs[:, pixels_klip]), 'pcs_kept': np.ascontiguousarray(pcs[:, pixels_kept])})
+        self.count = count
+        self.prefilter = rotator.prefilter                                  # the same spline prefilters for all the angles
+        
+    def apply(self, disk_model):
+        """Return the KLIP forward modeled image of a (convolved, star removed) model, the same as klip_fm_main() to rounding errors.
+        Input:
+            disk_model: 2D array without NaN's, the same shape as the mask (139*139 for the ALICE pipeline).
+        Output:
+            The KLIP forward modeled image."""
+        disk_model = np.asarray(disk_model, dtype = 'float64')
+        results = np.zeros(self.count.size)
+        coefficients = self.prefilter(disk_model).flatten()
+        for term in self.terms:
+            x = term['rotation_klip'].dot(coefficients)
+            x -= np.mean(x)
+            residual = - np.dot(term['pcs_kept'].T, np.dot(term['pcs_klip'], x)) # summed over the frames of this angle
+            residual[term['klip_in_kept']] += term['n_frames'] * x
+            
+            residual_image = np.zeros(self.count.size)
+            residual_image[term['pixels_kept']] = residual
+            results[term['pixels_derotated']] += term['derotation'].dot(self.prefilter(residual_image.reshape(self.shape)).flatten())
+        
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            result_klip = results.reshape(self.shape)/np.where(self.count == 0, np.nan, self.count)
+        
+        if self.pipeline_input == 'ALICE':
+            result_klip_alice = np.zeros((self.alice_size, self.alice_size))
+            result_klip_alice[1:, 1:] = result_klip
+            result_klip = result_klip_alice
+        return result_klip
 
 
-def klip_fm_main(path = './test/', path_obs = None, angles = None, psf = None, pipeline_input = 'ALICE', alice_size = None):
+def klip_fm_main(path = './test/', path_obs = None, angles = None, psf = None, pipeline_input = 'ALICE', alice_size = None, components = None, mask = None, fm_operator = None):
+    """Forward model the NICMOS observation of the MCFOST model in `path` with KLIP.
+    Input:
+        path: the path to the MCFOST model;
+        path_obs: the path to the observed data;
+        angles: the roll angles, default are the ones for the HD 191089 NICMOS observations;
+        psf: the PSF to convolve the model with;
+        pipeline_input: the pipeline used for the reduction, 'ALICE' by default;
+        alice_size: the image size of the ALICE pipeline, 140 by default;
+        components, mask: the KL modes and the KLIP mask, if None, they are read from `path_obs`;
+        fm_operator: a klip_fm_operator object, if given, it is used for the KLIP (then `angles`, `components` and `mask` are not used).
+    Output:
+        The KLIP forward modeled image."""
     disk_model = fits.getdata(path + 'data_1.12/RT.fits.gz')[0, 0, 0]
     disk_model[int((disk_model.shape[0]-1)/2)-2:int((disk_model.shape[0]-1)/2)+3, int((disk_model.shape[0]-1)/2)-2:int((disk_model.shape[0]-1)/2)+3] = 0
     # Exclude the star in the above line
     if psf is not None:
         if len(psf.shape) != 2:
             raise  valueError('The input PSF is not 2D, please pass a 2D one here!')
-        psf /= np.nansum(psf)               #Normalize the PSF (planet PSF) in case the input is not equal to 1
-        convolved0 = image_registration.fft_tools.convolve_nd.convolvend(disk_model, psf)
+        psf = psf / np.nansum(psf)          #Normalize the PSF (planet PSF) in case the input is not equal to 1
+        convolved0 = dependencies.psfConvolution(psf).apply(disk_model)
         disk_model = convolved0
     
+    if fm_operator is not None:
+        return fm_operator.apply(disk_model)
+    
     if path_obs is None:
         path_obs = './data_observation/'
-    components = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_KLmodes.fits')
-    mask = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_Mask.fits')
+    if components is None:
+        components = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_KLmodes.fits')
+    if mask is None:
+        mask = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_Mask.fits')
     if angles is None:
         angles = np.concatenate([[19.5699]*4, [49.5699]*4]) # The values are hard coded for HD 191089 NICMOS observations, pelase change it for other targets.
 
-    disk_rotated = dependencies.rotateCube(disk_model, angle = angles, maskedNaN=True, outputMask=False)
+    disk_rotated = dependencies.rotateCube(disk_model, angle = angles, maskedNaN=True, outputMask=False, method = 'sparse')
     masks_rotated = np.ones(disk_rotated.shape)
     masks_rotated[np.where(np.isnan(disk_rotated))] = 0
     if pipeline_input == 'ALICE':
@@ -203,10 +407,7 @@ def klip_fm_main(path = './test/', path_obs = None, angles = None, psf = None, p
         masks_rotated = mask_rotated_140
         del mask_rotated_140
         
-    results_rotated = np.zeros(disk_rotated.shape)    
-    
-    for i, data_slice in enumerate(disk_rotated):
-        results_rotated[i] = klip(data_slice, pcs = components[i], mask = masks_rotated[i], cube=False)
+    results_rotated = klip_batch(disk_rotated, pcs = components, mask = masks_rotated)
 
     mask_rotated_nan = np.ones(masks_rotated.shape)    
     mask_rotated_nan[np.where(masks_rotated==0)] = np.nan
@@ -219,9 +420,14 @@ def klip_fm_main(path = './test/', path_obs = None, angles = None, psf = None, p
         mask_rotated_nan = mask_rotated_nan_old
         del mask_rotated_nan_old
 
-    results = dependencies.rotateCube(results_rotated*mask_rotated_nan, mask = None, angle = -angles, maskedNaN=True, outputMask=False)
+    # The frames with the same angle have the same mask: sum them, then derotate the sum only once for each unique angle
+    angles_unique, frames_unique, angle_index = np.unique(angles, return_index = True, return_inverse = True)
+    results_summed = np.array([np.sum(results_rotated[angle_index == j], axis = 0) for j in range(angles_unique.shape[0])])
+    results = dependencies.rotateCube(results_summed*mask_rotated_nan[frames_unique], mask = None, angle = -angles_unique, maskedNaN=True, outputMask=False, method = 'sparse')
+    if len(results.shape) == 2:
+        results = results[np.newaxis]
 
-    mask_detorated_nan = np.ones(results.shape)
+    mask_detorated_nan = np.ones(results.shape)*np.bincount(angle_index)[:, np.newaxis, np.newaxis] # number of frames for each unique angle
     mask_detorated_nan[np.where(np.isnan(results))] = np.nan
 
     result_klip = np.nansum(results, axis = 0)/np.nansum(mask_detorated_nan, axis = 0)
@@ -1,12 +1,16 @@
 from astropy.io import fits
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, cho_solve_banded, cholesky_banded
+from scipy.signal import fftconvolve
+from scipy.special import log_ndtr
 from . import fm_klip
 from . import diskmodeling_Qr
 from . import dependencies
-import image_registration
 import astropy.units as units
 from . import lnprior
 import shutil
+import hashlib
+import pickle
 
 def convertMCFOSTdataToJy(data, wavelength, spatialUnit = 'arcsec', spatialResolution = None):
     """Convert data in MCFOST units into Jansky/pixel or Jansky/arcsec^2:
@@ -25,11 +29,12 @@ def convertMCFOSTdataToJy(data, wavelength, spatialUnit = 'arcsec', spatialResol
     
 def chi2(data, data_unc, model, lnlike = True):
     """Calculate the chi-squared value or log-likelihood for given data and model. 
-    Note: if data_unc has values <= 0, they will be ignored and replaced by NaN.
+    Note: if data_unc has values <= 0, they will be ignored (treated as NaN).
     Input:  data: 2D array, observed data.
             data_unc: 2D array, uncertainty/noise map of the observed data.
             lnlike: boolean, if True, then the log-likelihood is returned.
     Output: chi2: float, chi-squared or log-likelihood value."""
+    data_unc = np.array(data_unc, dtype = 'float64')      # do not modify the input
     data_unc[np.where(data_unc <= 0)] = np.nan
     chi2 = np.nansum(((data-model)/data_unc)**2)
     if lnlike:
@@ -38,9 +43,231 @@ def chi2(data, data_unc, model, lnlike = True):
         return loglikelihood
     return chi2
     
+def chi2_scale_terms(data, data_unc, model):
+    """Terms of the log-likelihood for a model with a free linear flux scale factor alpha, i.e., data = alpha * model + noise.
+    Note: as in chi2(), the pixels with positive uncertainties are in the normalization term, and the ones where the data and the model
+          are also not NaN are in the other terms (the NaN's contribute 0). The inputs are not modified.
+    Input:  data: 2D array, observed data.
+            data_unc: 2D array, uncertainty/noise map of the observed data.
+            model: 2D array, model.
+    Output: dictionary with 
+            'A': sum(model**2/data_unc**2), 
+            'B': sum(data*model/data_unc**2), 
+            'C': sum(data**2/data_unc**2), 
+            'lnnorm': -n/2*log(2pi) - sum_i(log sigma_i), 
+            then lnnorm - (C - 2*alpha*B + alpha**2*A)/2 is equal to chi2(data, data_unc, alpha*model, lnlike = True)."""
+    data_unc = np.asarray(data_unc, dtype = 'float64')
+    with np.errstate(invalid = 'ignore'):
+        valid_unc = data_unc > 0
+    valid = valid_unc & np.isfinite(data) & np.isfinite(model)
+    weight = 1/data_unc[valid]**2
+    terms = {'A': np.sum(model[valid]**2 * weight),
+             'B': np.sum(data[valid] * model[valid] * weight),
+             'C': np.sum(data[valid]**2 * weight),
+             'lnnorm': -0.5*np.log(2*np.pi)*np.count_nonzero(valid_unc) - np.sum(np.log(data_unc[valid_unc]))}
+    return terms
+
+def lnlike_flux_scale(terms, method = 'profile'):
+    """Log-likelihood with the flux scale factor alpha (data = alpha * model + noise, alpha >= 0 since the flux is not negative) solved analytically.
+    Input:  terms: a list of outputs of chi2_scale_terms(), the data sets in the list share the same scale factor.
+            method: 'profile': alpha = max(B/A, 0) (non-negative weighted least-squares), 
+                                lnlike = lnnorm - (C - B**2/A)/2 if B > 0, and lnnorm - C/2 (alpha = 0) otherwise;
+                    'marginalize': alpha is integrated out over alpha >= 0 with an improper uniform prior (density 1, not normalized), 
+                                lnlike = lnnorm - (C - B**2/A)/2 + log(2pi/A)/2 + log(Phi(B/sqrt(A))), where Phi is the standard normal CDF.
+    Output: log-likelihood value, 
+            the best-fit scale factor max(B/A, 0)."""
+    A = sum(term['A'] for term in terms)
+    B = sum(term['B'] for term in terms)
+    C = sum(term['C'] for term in terms)
+    lnnorm = sum(term['lnnorm'] for term in terms)
+    if not A > 0:                       # zero model: nothing to scale
+        if method == 'marginalize':
+            return -np.inf, 0
+        return lnnorm - 0.5*C, 0
+    if method == 'marginalize':
+        loglikelihood = lnnorm - 0.5*(C - B**2/A) + 0.5*np.log(2*np.pi/A) + log_ndtr(B/np.sqrt(A))
+        return loglikelihood, max(B/A, 0)
+    if B <= 0:                          # the best non-negative scale factor is 0
+        return lnnorm - 0.5*C, 0
+    return lnnorm - 0.5*(C - B**2/A), B/A
+    
+class gaussian_likelihood:
+    """The log-likelihood of chi2() (and the terms of chi2_scale_terms()) for fixed observations: the observations are compacted
+    to their valid pixels once, then each evaluation is a gather of the model on these pixels and a dot product.
+    As in chi2(), the pixels with positive uncertainties are in the normalization term, and the ones that also have non-NaN data are in chi-squared
+    (where the NaN's in the model are ignored).
+    Input:  data: array, observed data.
+            data_unc: array of the same shape, uncertainty/noise map of the observed data, the values <= 0 or NaN are ignored. 
+            The inputs are not modified.
+    Attributes:
+            pixels: the flattened indices of the pixels in chi-squared
+            data, inv_unc: the data and 1/data_unc on `pixels`
+            lnnorm: -n/2*log(2pi) - sum_i(log sigma_i), for the n pixels with positive uncertainties
+    Example:
+            likelihood = gaussian_likelihood(data, data_unc)
+            likelihood.lnlike(model)            # equal to chi2(data, data_unc, model, lnlike = True)
+    """
+    def __init__(self, data, data_unc):
+        data = np.asarray(data, dtype = 'float64').flatten()
+        data_unc = np.asarray(data_unc, dtype = 'float64').flatten()
+        with np.errstate(invalid = 'ignore'):
+            valid_unc = data_unc > 0
+        self.lnnorm = -0.5*np.log(2*np.pi)*np.count_nonzero(valid_unc) - np.sum(np.log(data_unc[valid_unc]))
+        self.pixels = np.where(valid_unc & ~np.isnan(data))[0]
+        self.data = data[self.pixels]
+        self.inv_unc = 1/data_unc[self.pixels]
+        self.data_weighted = self.data*self.inv_unc
+        
+    def chi2(self, model):
+        """Return the chi-squared value of `model` (the same shape as the data)."""
+        residual = self.data_weighted - np.take(model, self.pixels)*self.inv_unc
+        result = np.dot(residual, residual)
+        if np.isnan(result):                # NaN's in the model
+            result = np.nansum(residual**2)
+        return result
+    
+    def lnlike(self, model):
+        """Return the log-likelihood of `model`, -n/2*log(2pi) - 1/2 * chi2 - sum_i(log sigma_i)."""
+        return self.lnnorm - 0.5*self.chi2(model)
+    
+    def scale_terms(self, model):
+        """Return the terms of chi2_scale_terms(data, data_unc, model) for lnlike_flux_scale()."""
+        model = np.take(model, self.pixels)
+        model_weighted = model*self.inv_unc
+        if not np.all(np.isfinite(model_weighted)):     # NaN's in the model
+            terms = chi2_scale_terms(self.data, 1/self.inv_unc, model)
+            terms['lnnorm'] = self.lnnorm
+            return terms
+        return {'A': np.dot(model_weighted, model_weighted),
+                'B': np.dot(self.data_weighted, model_weighted),
+                'C': np.dot(self.data_weighted, self.data_weighted),
+                'lnnorm': self.lnnorm}
+    
+def psf_correlation(psf, half_width = None):
+    """Correlation coefficients of white noise convolved with the PSF, i.e., the normalized autocorrelation of the PSF, for correlated_likelihood().
+    Input:  psf: 2D array, the PSF (NaN's are treated as 0).
+            half_width: integer, if given, the correlations are limited to a (2*half_width + 1) * (2*half_width + 1) box,
+                        which sets the band width of the covariance matrix (about half_width * the image width).
+                        The PSF is then cropped to half_width//2 around its center (pixel (psf.shape[0]//2, psf.shape[1]//2)) before the
+                        autocorrelation, so that the correlation matrix stays positive definite (cutting the correlations themselves does not).
+    Output: 2D array of odd sizes, 1 at the center."""
+    psf = dependencies.cropSupport(psf)
+    if half_width is not None:
+        center_y, center_x = psf.shape[0]//2, psf.shape[1]//2
+        half_y, half_x = min(half_width//2, center_y), min(half_width//2, center_x)
+        psf = psf[center_y - half_y:center_y + half_y + 1, center_x - half_x:center_x + half_x + 1]
+    correlation = fftconvolve(psf, psf[::-1, ::-1], mode = 'full')       # centered at (psf.shape[0] - 1, psf.shape[1] - 1)
+    return correlation/correlation[psf.shape[0] - 1, psf.shape[1] - 1]
+
+class correlated_likelihood:
+    """The Gaussian log-likelihood with correlated noise, -n/2*log(2pi) - 1/2 * log(det(C)) - 1/2 * r^T C^-1 r, for fixed observations.
+    The covariance C on the valid pixels (the same as in gaussian_likelihood) is
+        C = S R S + U U^T,
+    where S = diag(data_unc), R is the correlation matrix of the pixels given by a `correlation` kernel (e.g., from psf_correlation()), 
+    and the columns of U are the `modes` (e.g., KLIP residuals, in the units of the data).
+    S R S is banded (row-major pixels) and factorized once with a banded Cholesky decomposition, U U^T is added with the Woodbury identity,
+    then each evaluation is a banded triangular solve on the valid pixels.
+    Input:  data: 2D array, observed data.
+            data_unc: 2D array, uncertainty/noise map of the observed data, the values <= 0 or NaN are ignored.
+            correlation: 2D array of odd sizes, centered and symmetric, the correlation coefficients between a pixel and its neighbors (1 at the center). 
+                        If None, the pixels are independent (R = I).
+            modes: 3D array, (k, data.shape[0], data.shape[1]), the low-rank part of the covariance. If None, U = 0.
+            The inputs are not modified.
+    Attributes:
+            pixels: the flattened indices of the valid pixels
+            data: the data on `pixels`
+            lnnorm: -n/2*log(2pi) - 1/2 * log(det(C))
+    Example:
+            likelihood = correlated_likelihood(data, data_unc, correlation = psf_correlation(psf, half_width = 3))
+            likelihood.lnlike(model)
+    Note: the NaN's in the model are treated as 0.
+    """
+    def __init__(self, data, data_unc, correlation = None, modes = None):
+        data = np.asarray(data, dtype = 'float64')
+        width = data.shape[1]
+        data = data.flatten()
+        data_unc = np.asarray(data_unc, dtype = 'float64').flatten()
+        with np.errstate(invalid = 'ignore'):
+            self.pixels = np.where((data_unc > 0) & ~np.isnan(data))[0]
+        self.data = data[self.pixels]
+        unc = data_unc[self.pixels]
+        n = len(self.pixels)
+        
+        self.cholesky = None            # banded Cholesky factor of S R S (upper form), None if S R S is diagonal
+        self.variance = unc**2
+        if correlation is not None:
+            correlation = np.nan_to_num(np.asarray(correlation, dtype = 'float64'))
+            center_y, center_x = correlation.shape[0]//2, correlation.shape[1]//2
+            index_compact = np.full(data.shape[0], -1)
+            index_compact[self.pixels] = np.arange(n)
+            rows, columns = np.divmod(self.pixels, width)
+            entries = []                # (i, j, covariance) with i < j
+            for dy in range(0, correlation.shape[0] - center_y):
+                for dx in range(-center_x, correlation.shape[1] - center_x):
+                    if (dy == 0 and dx <= 0) or correlation[center_y + dy, center_x + dx] == 0:
+                        continue
+                    rows_neighbor, columns_neighbor = rows + dy, columns + dx
+                    inside = (rows_neighbor*width + columns_neighbor < data.shape[0]) & (columns_neighbor >= 0) & (columns_neighbor < width)
+                    i = np.where(inside)[0]
+                    j = index_compact[(rows_neighbor*width + columns_neighbor)[inside]]
+                    i, j = i[j >= 0], j[j >= 0]
+                    entries.append((i, j, correlation[center_y + dy, center_x + dx]*unc[i]*unc[j]))
+            band = max([np.max(j - i) for i, j, covariance in entries if len(i) > 0] + [0])
+            if band > 0:
+                banded = np.zeros((band + 1, n))
+                banded[band] = self.variance
+                for i, j, covariance in entries:
+                    banded[band + i - j, j] = covariance
+                self.cholesky = cholesky_banded(banded)
+        if self.cholesky is None:
+            logdet = np.sum(np.log(self.variance))
+        else:
+            logdet = 2*np.sum(np.log(self.cholesky[-1]))
+        
+        self.modes = None               # U, and the Cholesky factor of I + U^T (S R S)^-1 U
+        if modes is not None:
+            self.modes = np.nan_to_num(np.asarray(modes, dtype = 'float64').reshape(len(modes), -1)[:, self.pixels].T)
+            self.modes_solved = self._solve_base(self.modes)
+            self.capacitance = cho_factor(np.identity(self.modes.shape[1]) + np.dot(self.modes.T, self.modes_solved))
+            logdet += 2*np.sum(np.log(np.diag(self.capacitance[0])))
+        
+        self.lnnorm = -0.5*np.log(2*np.pi)*n - 0.5*logdet
+        self.data_solved = self.solve(self.data)
+        self.data_chi2 = np.dot(self.data, self.data_solved)
+        
+    def _solve_base(self, vector):
+        if self.cholesky is None:
+            return vector/(self.variance if len(vector.shape) == 1 else self.variance[:, np.newaxis])
+        return cho_solve_banded((self.cholesky, False), vector)
+        
+    def solve(self, vector):
+        """Return C^-1 * vector, for a vector on the valid pixels."""
+        result = self._solve_base(vector)
+        if self.modes is not None:
+            result = result - np.dot(self.modes_solved, cho_solve(self.capacitance, np.dot(self.modes.T, result)))
+        return result
+    
+    def chi2(self, model):
+        """Return the generalized chi-squared value, r^T C^-1 r with r = data - model, of `model` (the same shape as the data)."""
+        residual = self.data - np.nan_to_num(np.take(model, self.pixels))
+        return np.dot(residual, self.solve(residual))
+    
+    def lnlike(self, model):
+        """Return the log-likelihood of `model`."""
+        return self.lnnorm - 0.5*self.chi2(model)
+    
+    def scale_terms(self, model):
+        """Return the terms of the log-likelihood with a free flux scale factor for lnlike_flux_scale(), as chi2_scale_terms() for correlated noise:
+        'A': m^T C^-1 m, 'B': d^T C^-1 m, 'C': d^T C^-1 d, 'lnnorm': -n/2*log(2pi) - 1/2 * log(det(C))."""
+        model = np.nan_to_num(np.take(model, self.pixels))
+        return {'A': np.dot(model, self.solve(model)),
+                'B': np.dot(self.data_solved, model),
+                'C': self.data_chi2,
+                'lnnorm': self.lnnorm}
+    
 def chi2_1dinterp(angles, data, data_unc, model, lnlike = True):
     """Calculate the chi-squared value or log-likelihood for given data and model. 
-    Note: if data_unc has values <= 0, they will be ignored and replaced by NaN.
+    Note: if data_unc has values <= 0, they will be ignored (treated as NaN).
     Input:  
             angles: 1D array, observed SPF angles.
             data: 1D array, observed SPF (normalized).
@@ -54,6 +281,7 @@ def chi2_1dinterp(angles, data, data_unc, model, lnlike = True):
     func_spf = interp1d(np.arange(0, 181, 1), model_mcfost[:, 0])
     model = func_spf(angles)
     
+    data_unc = np.array(data_unc, dtype = 'float64')      # do not modify the input
     data_unc[np.where(data_unc <= 0)] = np.nan
     chi2 = np.nansum(((data-model)/data_unc)**2)
     
@@ -63,7 +291,139 @@ def chi2_1dinterp(angles, data, data_unc, model, lnlike = True):
         return loglikelihood
     return chi2
 
-def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw = None, hash_address = False, delete_model = True, hash_string = None, return_model_only = False, STIS = True, NICMOS = True, GPI = True):
+class data_input_hd191089:
+    """Observations of the HD 191089 system for lnlike_hd191089(), read from `path_obs` only once.
+    Build it once per worker (e.g., before the MCMC starts) and pass it as `data_input_info` to save the repeated FITS reads.
+    Input:  path_obs: the path to the observed data
+            psfs: the point spread functions for forward modeling to simulate instrument response, [psf_stis, psf_nicmos]
+            psf_cut_hw: the half-width of the PSFs if you would like to cut them to smaller sizes (size = 2*hw + 1)
+            STIS, NICMOS, GPI: boolean, which instruments to load.
+            nicmos_operator: boolean, precompute the NICMOS KLIP forward modeling as a fm_klip.klip_fm_operator object? False by default.
+            noise_models: dictionary of correlated noise models, e.g., {'NICMOS': {'correlation': psf_correlation(psf_nicmos, half_width = 4)}},
+                        the keys are 'STIS', 'NICMOS', or 'GPI', and the values are the keyword arguments of correlated_likelihood().
+                        The likelihood of the other instruments assumes independent pixels. None by default (all independent).
+    Attributes:
+            stis_obs, stis_obs_unc, mask_stis: STIS data, masked uncertainty and mask (0 where the noise is not positive), in Jy/arcsec^2
+            nicmos_obs, nicmos_obs_unc, mask_nicmos: NICMOS data, masked uncertainty and mask, in Jy/arcsec^2
+            nicmos_components, nicmos_mask_klip: the NICMOS KL modes and KLIP mask for fm_klip.klip_fm_main()
+            nicmos_fm_operator: the fm_klip.klip_fm_operator object if `nicmos_operator == True`, None otherwise
+            gpi_obs, gpi_obs_unc, mask_gpi: GPI data and uncertainty (both multiplied by the mask) and mask, in Jy/arcsec^2
+            stis_likelihood, nicmos_likelihood, gpi_likelihood: gaussian_likelihood (or correlated_likelihood, see `noise_models`) objects 
+                                                                of the above data and uncertainties
+            psfs: the normalized PSFs, [psf_stis, psf_nicmos]
+    """
+    def __init__(self, path_obs = None, psfs = None, psf_cut_hw = None, STIS = True, NICMOS = True, GPI = True,
+                 nicmos_operator = False, noise_models = None):
+        if path_obs is None:
+            path_obs = './data_observation/'
+        self._init_args = (path_obs, psfs, psf_cut_hw, STIS, NICMOS, GPI, nicmos_operator, noise_models)
+        if noise_models is None:
+            noise_models = {}
+        self.path_obs = path_obs
+        self.STIS = STIS
+        self.NICMOS = NICMOS
+        self.GPI = GPI
+        
+        if STIS:
+            self.stis_obs = fits.getdata(path_obs + 'STIS/calibrated/HD-191089_Signal_Jy_arcsec-2_oddSize.fits')
+            stis_obs_unc = fits.getdata(path_obs + 'STIS/calibrated/HD-191089_NoiseMap_Jy_arcsec-2_oddSize.fits')
+            stis_obs_unc[np.where(stis_obs_unc <=0)] = np.nan
+            self.mask_stis = fits.getdata(path_obs + 'STIS/calibrated/mask_stis.fits')
+            # mask_stis = np.copy(dependencies.annulusMask(stis_obs.shape[0], r_in = 0, r_out=30)) #define your own mask here
+            self.mask_stis[np.isnan(stis_obs_unc)] = 0
+            self.stis_obs_unc = stis_obs_unc*self.mask_stis
+            if 'STIS' in noise_models:
+                self.stis_likelihood = correlated_likelihood(self.stis_obs, self.stis_obs_unc, **noise_models['STIS'])
+            else:
+                self.stis_likelihood = gaussian_likelihood(self.stis_obs, self.stis_obs_unc)
+        if NICMOS:
+            self.nicmos_obs = fits.getdata(path_obs + 'NICMOS/calibrated/HD-191089_NICMOS_F110W_Lib-84_KL-19_Signal-Jy_arcsec-2.fits')
+            nicmos_obs_unc = fits.getdata(path_obs + 'NICMOS/calibrated/HD-191089_NICMOS_F110W_Lib-84_KL-19_NoiseMap-Jy_arcsec-2.fits')
+            nicmos_obs_unc[np.where(nicmos_obs_unc <=0)] = np.nan
+            self.mask_nicmos = fits.getdata(path_obs + 'NICMOS/calibrated/mask_nicmos.fits')
+            # mask_nicmos = np.copy(dependencies.annulusMask(nicmos_obs.shape[0], r_in = 0, r_out = 20)) #define your own mask here
+            self.mask_nicmos[np.isnan(nicmos_obs_unc)] = 0
+            self.nicmos_obs_unc = nicmos_obs_unc*self.mask_nicmos
+            if 'NICMOS' in noise_models:
+                self.nicmos_likelihood = correlated_likelihood(self.nicmos_obs, self.nicmos_obs_unc, **noise_models['NICMOS'])
+            else:
+                self.nicmos_likelihood = gaussian_likelihood(self.nicmos_obs, self.nicmos_obs_unc)
+            self.nicmos_components = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_KLmodes.fits')
+            self.nicmos_mask_klip = fits.getdata(path_obs + 'NICMOS/HD-191089_NICMOS_F110W_Lib-84_KL-19_Mask.fits')
+        self.nicmos_fm_operator = None
+        if NICMOS and nicmos_operator:
+            self.nicmos_fm_operator = fm_klip.klip_fm_operator(self.nicmos_components, self.nicmos_mask_klip)
+        if GPI:
+            gpi_obs = fits.getdata(path_obs + 'GPI/calibrated/hd191089_gpi_smooth_mJy_arcsec2.fits')/1e3 #Turn it to Jy/arcsec^2
+            gpi_obs_unc = fits.getdata(path_obs + 'GPI/calibrated/hd191089_gpi_smooth_mJy_arcsec2_noisemap.fits')/1e3 #Turn it to Jy/arcsec^2
+            gpi_obs_unc[np.where(gpi_obs_unc <=0)] = np.nan
+            self.mask_gpi = fits.getdata(path_obs + 'GPI/calibrated/mask_gpi.fits')
+            # mask_gpi = np.copy(dependencies.annulusMask(gpi_obs.shape[0], r_in = 15, r_out = 85))   #define your own mask here
+            self.gpi_obs = gpi_obs*self.mask_gpi
+            self.gpi_obs_unc = gpi_obs_unc*self.mask_gpi
+            if 'GPI' in noise_models:
+                self.gpi_likelihood = correlated_likelihood(self.gpi_obs, self.gpi_obs_unc, **noise_models['GPI'])
+            else:
+                self.gpi_likelihood = gaussian_likelihood(self.gpi_obs, self.gpi_obs_unc)
+
+        try:
+            if psfs is None:
+                psfs = [None, None]
+                psf_stis_raw = fits.getdata(path_obs + 'STIS/calibrated/STIS_6440K_tinyTIM_oddSize.fits')
+                psf_stis = np.zeros(psf_stis_raw.shape)
+                psf_stis[148:167, 148:167] = psf_stis_raw[148:167, 148:167] #focus only on the 19x19 PSF region as done in calculating the STIS BAR5 contrast.
+                psf_nicmos_raw = fits.getdata(path_obs + 'NICMOS/calibrated/NICMOS_Era2_F110W_oddSize.fits')
+                psf_nicmos = np.zeros(psf_nicmos_raw.shape)
+                psf_nicmos[60:79, 60:79] = psf_nicmos_raw[60:79, 60:79] #focus only on the 19x19 PSF region as for the STIS data.
+            
+                if psf_cut_hw is not None:
+                    psfs[0] = dependencies.cutImage(psf_stis, psf_cut_hw)   # a 7*7 PSF would need psf_cut_hw = 3 (then 3*2+1 = 7).
+                    psfs[1] = dependencies.cutImage(psf_nicmos, psf_cut_hw) # a 7*7 PSF would need psf_cut_hw = 3
+                else:
+                    psfs[0] = psf_stis
+                    psfs[1] = psf_nicmos
+                psfs[0] /= np.nansum(psfs[0])
+                psfs[1] /= np.nansum(psfs[1])
+        except:
+            pass
+        self.psfs = psfs
+        
+    def __reduce__(self):
+        # Only the arguments are pickled: the MPI/multiprocessing workers then read the observations once per process,
+        # instead of receiving all the arrays with every task.
+        return (load_data_input_hd191089, self._init_args)
+    
+    def check_instruments(self, STIS = True, NICMOS = True, GPI = True):
+        """Raise a ValueError if one of the requested instruments is not loaded in this object."""
+        missing = [name for name, requested in zip(['STIS', 'NICMOS', 'GPI'], [STIS, NICMOS, GPI]) 
+                   if requested and not hasattr(self, name.lower() + '_likelihood')]
+        if len(missing) > 0:
+            raise ValueError('The observations of ' + ', '.join(missing) + ' are not loaded in `data_input_info`, '
+                             'please create it with ' + ' = True, '.join(missing) + ' = True!')
+
+_data_input_loaded = {}
+
+def load_data_input_hd191089(path_obs = None, psfs = None, psf_cut_hw = None, STIS = True, NICMOS = True, GPI = True,
+                             nicmos_operator = False, noise_models = None):
+    """Return a data_input_hd191089 object, the observations are read only once per process for the same input."""
+    psf_key = None                      # the given PSFs are identified by their values
+    if psfs is not None:
+        digest = hashlib.sha1()
+        for psf in psfs:
+            psf = np.ascontiguousarray(psf, dtype = 'float64')
+            digest.update(str(psf.shape).encode())
+            digest.update(psf.tobytes())
+        psf_key = digest.hexdigest()
+    noise_key = None if noise_models is None else hashlib.sha1(pickle.dumps(noise_models)).hexdigest() # the covariances are factorized once too
+    key = ('hd191089', path_obs, psf_key, psf_cut_hw, STIS, NICMOS, GPI, nicmos_operator, noise_key)
+    if key not in _data_input_loaded:
+        _data_input_loaded[key] = data_input_hd191089(path_obs = path_obs, psfs = psfs, psf_cut_hw = psf_cut_hw, STIS = STIS, NICMOS = NICMOS, GPI = GPI, 
+                                                      nicmos_operator = nicmos_operator, noise_models = noise_models)
+    return _data_input_loaded[key]
+
+def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw = None, hash_address = False,
+                    delete_model = True, hash_string = None, return_model_only = False, STIS = True, NICMOS = True,
+                    GPI = True, data_input_info = None, mass_scale = 1, flux_scale = None, flux_scale_shared = False):
     """Return the log-likelihood for observed data and modelled data.
     Input:  path_obs: the path to the observed data
             path_model: the path to the (forwarded) models
@@ -72,26 +432,25 @@ def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw
             hash_address: whether to hash the address based on the values, if True, then the address should be provided by `hash_string'
             delete_model: whether to delete the models. True by default.
             return_model_only: only return the forwarded models for debug/grid-modeling purpose
+            data_input_info: a data_input_hd191089 object containing the observations, if None, they are read from `path_obs'.
+                        It should have the instruments in `STIS`, `NICMOS` and `GPI` loaded, otherwise a ValueError is raised.
+                        Its `noise_models` set the correlated noise likelihood for each instrument (independent pixels by default).
+            mass_scale: the models are multiplied by this factor. For optically thin disks, the scattered light is proportional to the dust mass,
+                        so models rendered at a reference mass `m_ref` are scaled to `m_disk` with mass_scale = 10**(m_disk - m_ref).
+            flux_scale: None (default), 'profile', or 'marginalize'. If not None, the models are multiplied by a free non-negative scale factor 
+                        for each instrument, which is profiled or marginalized analytically, see lnlike_flux_scale().
+                        The returned models (`return_model_only`) are then multiplied by the best-fit scale factor(s).
+            flux_scale_shared: if True, the instruments share the same scale factor.
     Output: log-likelihood
             """
     ### Observations:
-    if path_obs is None:
-        path_obs = './data_observation/'
-    if STIS:
-        stis_obs = fits.getdata(path_obs + 'STIS/calibrated/HD-191089_Signal_Jy_arcsec-2_oddSize.fits')
-        stis_obs_unc = fits.getdata(path_obs + 'STIS/calibrated/HD-191089_NoiseMap_Jy_arcsec-2_oddSize.fits')
-        stis_obs_unc[np.where(stis_obs_unc <=0)] = np.nan
-        mask_stis = fits.getdata(path_obs + 'STIS/calibrated/mask_stis.fits')
-    if NICMOS:
-        nicmos_obs = fits.getdata(path_obs + 'NICMOS/calibrated/HD-191089_NICMOS_F110W_Lib-84_KL-19_Signal-Jy_arcsec-2.fits')
-        nicmos_obs_unc = fits.getdata(path_obs + 'NICMOS/calibrated/HD-191089_NICMOS_F110W_Lib-84_KL-19_NoiseMap-Jy_arcsec-2.fits')
-        nicmos_obs_unc[np.where(nicmos_obs_unc <=0)] = np.nan
-        mask_nicmos = fits.getdata(path_obs + 'NICMOS/calibrated/mask_nicmos.fits')
-    if GPI:
-        gpi_obs = fits.getdata(path_obs + 'GPI/calibrated/hd191089_gpi_smooth_mJy_arcsec2.fits')/1e3 #Turn it to Jy/arcsec^2
-        gpi_obs_unc = fits.getdata(path_obs + 'GPI/calibrated/hd191089_gpi_smooth_mJy_arcsec2_noisemap.fits')/1e3 #Turn it to Jy/arcsec^2
-        gpi_obs_unc[np.where(gpi_obs_unc <=0)] = np.nan
-        mask_gpi = fits.getdata(path_obs + 'GPI/calibrated/mask_gpi.fits')
+    if data_input_info is None:
+        data_input_info = data_input_hd191089(path_obs = path_obs, psfs = psfs, psf_cut_hw = psf_cut_hw, STIS = STIS,
+                                              NICMOS = NICMOS, GPI = GPI)
+    else:
+        data_input_info.check_instruments(STIS = STIS, NICMOS = NICMOS, GPI = GPI)
+    path_obs = data_input_info.path_obs
+    psfs = data_input_info.psfs
     
     resolution_stis = 0.05078 # arcsec/pixel
     resolution_gpi = 14.166e-3
@@ -105,31 +464,8 @@ def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw
             print('Please provide the hash string if you set hash_address = True!')
             return -np.inf     
         path_model = path_model[:-1] + hash_string + '/'
-    try:    
-        if psfs is None:
-            psfs = [None, None]
-            psf_stis_raw = fits.getdata(path_obs + 'STIS/calibrated/STIS_6440K_tinyTIM_oddSize.fits')
-            psf_stis = np.zeros(psf_stis_raw.shape)
-            psf_stis[148:167, 148:167] = psf_stis_raw[148:167, 148:167] #focus only on the 19x19 PSF region as done in calculating the STIS BAR5 contrast.
-            psf_nicmos_raw = fits.getdata(path_obs + 'NICMOS/calibrated/NICMOS_Era2_F110W_oddSize.fits')
-            psf_nicmos = np.zeros(psf_nicmos_raw.shape)
-            psf_nicmos[60:79, 60:79] = psf_nicmos_raw[60:79, 60:79] #focus only on the 19x19 PSF region as for the STIS data.
-        
-            psfs = [psf_stis, psf_nicmos]
-        
-            if psf_cut_hw is not None:
-                psfs[0] = dependencies.cutImage(psf_stis, psf_cut_hw)   # a 7*7 PSF would need psf_cut_hw = 3 (then 3*2+1 = 7).
-                psfs[1] = dependencies.cutImage(psf_nicmos, psf_cut_hw) # a 7*7 PSF would need psf_cut_hw = 3
-                psfs[0] /= np.nansum(psfs[0])
-                psfs[1] /= np.nansum(psfs[1])
-            else:
-                psfs[0] = psf_stis
-                psfs[1] = psf_nicmos
-                psfs[0] /= np.nansum(psfs[0])
-                psfs[1] /= np.nansum(psfs[1])
-    except:
-        pass        
     # convert the MCFOST units to Jy/arcsec^2, and calculate individual chi2
+    terms_scale = {}                    # terms for the analytic flux scale factor(s), only when `flux_scale` is not None
 
     if STIS:
         stis_model = fits.getdata(path_model + 'data_0.58/RT.fits.gz')[0, 0, 0]
@@ -137,31 +473,40 @@ def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw
             chi2_stis = -np.inf
         else:
             stis_model[int((stis_model.shape[0]-1)/2)-2:int((stis_model.shape[0]-1)/2)+3, int((stis_model.shape[1]-1)/2)-2:int((stis_model.shape[1]-1)/2)+3] = 0
-            stis_convolved = image_registration.fft_tools.convolve_nd.convolvend(stis_model, psfs[0])
-            stis_model = convertMCFOSTdataToJy(stis_convolved, wavelength = 0.58, spatialResolution = resolution_stis) #convert to Jansky/arscec^2
-            # mask_stis = dependencies.annulusMask(stis_model.shape[0], r_in = 0, r_out=30) #define your own mask here
-            mask_stis[np.isnan(stis_obs_unc)] = 0
-            chi2_stis = chi2(stis_obs, stis_obs_unc*mask_stis, stis_model, lnlike = True) #return loglikelihood value for STIS
+            stis_convolved = dependencies.psfConvolution(psfs[0]).apply(stis_model)
+            stis_model = convertMCFOSTdataToJy(stis_convolved*mass_scale, wavelength = 0.58, spatialResolution = resolution_stis) #convert to Jansky/arscec^2
+            if flux_scale is None:
+                chi2_stis = data_input_info.stis_likelihood.lnlike(stis_model) #return loglikelihood value for STIS
+            else:
+                chi2_stis = 0
+                terms_scale['STIS'] = data_input_info.stis_likelihood.scale_terms(stis_model)
     else:
         chi2_stis = 0
     if NICMOS:
-        nicmos_model_forwarded = fm_klip.klip_fm_main(path = path_model, path_obs = path_obs, angles= None, psf = psfs[1]) # already convolved
-        nicmos_model = convertMCFOSTdataToJy(nicmos_model_forwarded, wavelength = 1.12, spatialResolution = resolution_nicmos) #convert to Jansky/arscec^2
-        # mask_nicmos = dependencies.annulusMask(nicmos_model.shape[0], r_in = 0, r_out = 20) #define your own mask here
-        mask_nicmos[np.isnan(nicmos_obs_unc)] = 0
+        nicmos_model_forwarded = fm_klip.klip_fm_main(path = path_model, path_obs = path_obs, angles= None, psf = psfs[1],
+                                                      components = data_input_info.nicmos_components, mask = data_input_info.nicmos_mask_klip,
+                                                      fm_operator = getattr(data_input_info, 'nicmos_fm_operator', None)) # already convolved
+        nicmos_model = convertMCFOSTdataToJy(nicmos_model_forwarded*mass_scale, wavelength = 1.12, spatialResolution = resolution_nicmos) #convert to Jansky/arscec^2
         
-        chi2_nicmos = chi2(nicmos_obs, nicmos_obs_unc*mask_nicmos, nicmos_model, lnlike = True) #return loglikelihood value for NICMOS       
+        if flux_scale is None:
+            chi2_nicmos = data_input_info.nicmos_likelihood.lnlike(nicmos_model) #return loglikelihood value for NICMOS       
+        else:
+            chi2_nicmos = 0
+            terms_scale['NICMOS'] = data_input_info.nicmos_likelihood.scale_terms(nicmos_model)
     else:
         chi2_nicmos = 0
     if GPI:
         gpi_model = diskmodeling_Qr.diskmodeling_Qr_main(path = path_model, fwhm = 3.8)
-        # mask_gpi = dependencies.annulusMask(gpi_model.shape[0], r_in = 15, r_out = 85)   #define your own mask here
         if np.nansum(np.isnan(gpi_model)) != 0:
             chi2_gpi = -np.inf
         else:
             # FWHM = 3.8 for GPI, as provided in Tom Esposito's HD35841 paper (Section: MCMC Modeling Procedure)
-            gpi_model = convertMCFOSTdataToJy(gpi_model, wavelength = 1.65, spatialResolution = resolution_gpi) #convert to Jansky/arscec^2
-            chi2_gpi = chi2(gpi_obs*mask_gpi, gpi_obs_unc*mask_gpi, gpi_model, lnlike = True) #return loglikelihood value for GPI             #NOTE: Magic number of 5 to boost the SNR is used!
+            gpi_model = convertMCFOSTdataToJy(gpi_model*mass_scale, wavelength = 1.65, spatialResolution = resolution_gpi) #convert to Jansky/arscec^2
+            if flux_scale is None:
+                chi2_gpi = data_input_info.gpi_likelihood.lnlike(gpi_model) #return loglikelihood value for GPI             #NOTE: Magic number of 5 to boost the SNR is used!
+            else:
+                chi2_gpi = 0
+                terms_scale['GPI'] = data_input_info.gpi_likelihood.scale_terms(gpi_model)
     else:
         chi2_gpi = 0
 
@@ -171,40 +516,88 @@ def lnlike_hd191089(path_obs = None, path_model = None, psfs = None, psf_cut_hw
     
     lnlike_total = chi2_stis+chi2_nicmos+chi2_gpi
     
+    if flux_scale is not None and len(terms_scale) > 0:
+        if flux_scale_shared:
+            groups_scale = [list(terms_scale.keys())]
+        else:
+            groups_scale = [[instrument] for instrument in terms_scale]
+        alphas = {}
+        for group in groups_scale:
+            lnlike_group, alpha = lnlike_flux_scale([terms_scale[instrument] for instrument in group],
+                                                    method = flux_scale)
+            lnlike_total += lnlike_group
+            for instrument in group:
+                alphas[instrument] = alpha
+        if 'STIS' in alphas:
+            stis_model = stis_model*alphas['STIS']
+        if 'NICMOS' in alphas:
+            nicmos_model = nicmos_model*alphas['NICMOS']
+        if 'GPI' in alphas:
+            gpi_model = gpi_model*alphas['GPI']
+    
     if np.isfinite(lnlike_total):
         if return_model_only:
             if STIS and NICMOS and GPI:
-                return stis_model, nicmos_model, gpi_model*mask_gpi
+                return stis_model, nicmos_model, gpi_model*data_input_info.mask_gpi
             if STIS and NICMOS:
                 return stis_model, nicmos_model
             if GPI:
-                return gpi_model*mask_gpi
+                return gpi_model*data_input_info.mask_gpi
     
         return  lnlike_total #Returns the loglikelihood
     else:
         return -np.inf
 
 
-def lnlike_hr4796aH2spf(path_obs = None, path_model = None, hash_address = False, delete_model = True, hash_string = None, return_model_only = False):
+class data_input_hr4796aH2spf:
+    """Observed scattering phase function (SPF) of HR 4796 A for lnlike_hr4796aH2spf(), read from `path_obs` only once.
+    Input:  path_obs: the path to the observed data
+    Attributes:
+            spf_angles: observed scattering angles
+            spf_obs, spf_obs_unc: observed SPF and its uncertainty, normalized at 90 degree
+    """
+    def __init__(self, path_obs = None):
+        if path_obs is None:
+            path_obs = './data_spf/'
+        self._init_args = (path_obs, )
+        self.path_obs = path_obs
+        
+        data_spf = fits.getdata(path_obs + 'best_spf_sphereh2.fits')    
+        self.spf_angles = np.copy(data_spf[0])
+        self.spf_obs = np.copy(data_spf[1])
+        self.spf_obs_unc = np.copy(data_spf[2])
+        factor_norm = self.spf_obs[np.where(self.spf_angles == 90)] #normalization at 90 degree
+        self.spf_obs_unc /= factor_norm
+        self.spf_obs /= factor_norm
+        
+    def __reduce__(self):
+        return (load_data_input_hr4796aH2spf, self._init_args)
+
+def load_data_input_hr4796aH2spf(path_obs = None):
+    """Return a data_input_hr4796aH2spf object, the observations are read only once per process for the same input."""
+    key = ('hr4796aH2spf', path_obs)
+    if key not in _data_input_loaded:
+        _data_input_loaded[key] = data_input_hr4796aH2spf(path_obs = path_obs)
+    return _data_input_loaded[key]
+
+def lnlike_hr4796aH2spf(path_obs = None, path_model = None, hash_address = False, delete_model = True,
+                        hash_string = None, return_model_only = False, data_input_info = None):
     """Return the log-likelihood for observed data and modelled data.
     Input:  path_obs: the path to the observed data
             path_model: the path to the (forwarded) models
             hash_address: whether to hash the address based on the values, if True, then the address should be provided by `hash_string'
             delete_model: whether to delete the models. True by default.
             return_model_only: only return the forwarded models for debug/grid-modeling purpose
+            data_input_info: a data_input_hr4796aH2spf object containing the observations, if None, they are read from `path_obs'.
     Output: log-likelihood
             """
     ### Observations:
-    if path_obs is None:
-        path_obs = './data_spf/'
+    if data_input_info is None:
+        data_input_info = data_input_hr4796aH2spf(path_obs = path_obs)
     
-    data_spf = fits.getdata(path_obs + 'best_spf_sphereh2.fits')    
-    spf_angles = np.copy(data_spf[0])
-    spf_obs = np.copy(data_spf[1])
-    spf_obs_unc = np.copy(data_spf[2])
-    factor_norm = spf_obs[np.where(spf_angles == 90)] #normalization at 90 degree
-    spf_obs_unc /= factor_norm
-    spf_obs /= factor_norm
+    spf_angles = data_input_info.spf_angles
+    spf_obs = data_input_info.spf_obs
+    spf_obs_unc = np.copy(data_input_info.spf_obs_unc)
     
     ### (Forwarded) Models:
     if path_model is None:
@@ -227,73 +620,90 @@ def lnlike_hr4796aH2spf(path_obs = None, path_model = None, hash_address = False
     return  chi2_spf #Returns the loglikelihood
     
     
-def lnlike_pds70keck(path_obs = None, path_model = None, hash_address = False, delete_model = True, hash_string = None, return_model_only = False, data_input_info = None, writemodel = False):
+class data_input_pds70keck:
+    """Observations of the PDS 70 system (Keck/NIRC2 L') for lnlike_pds70keck() and lnlike_pds70keck_ADI(), read from `path_obs` only once.
+    This is designed to speed up the calculations by reading the observations for only once -- do it before calling the posterior function:
+        data_input_info = data_input_pds70keck(path_obs = './reduction-bren/')
+    Input:  path_obs: the path to the observed data
+            ADI: boolean, whether to load the raw cube, disk mask, and transmission map for the negative injection in lnlike_pds70keck_ADI().
+    Attributes:
+            data_obs, unc_obs: reduced observation and its uncertainty
+            components_klip: KLIP components of the observation (only when `ADI == False`)
+            likelihood: gaussian_likelihood object of the observation in `mask_calc` (only when `ADI == False`)
+            obs_raw, mask_disk, map_transmission: raw cube, disk mask, and NIRC2 transmission map (only when `ADI == True`)
+            pixels_obs, gram_obs: flattened indices of the pixels in `mask_obs`, and the covariance matrix of the raw cube on them 
+                                  for the incremental PCA in lnlike_pds70keck_ADI() (only when `ADI == True`)
+            mask_obs, mask_planet, mask_calc: masks, `mask_calc` is NaN outside the region for likelihood calculation
+            angles: parallactic angles
+            psf: normalized PSF
+    """
+    def __init__(self, path_obs = None, ADI = False):
+        if path_obs is None:
+            path_obs = './reduction-bren/'
+        self._init_args = (path_obs, ADI)
+        self.path_obs = path_obs
+        
+        self.data_obs = fits.getdata(path_obs + 'result_median_3components.fits')
+        self.unc_obs = fits.getdata(path_obs + 'result_std_3components.fits')
+        
+        self.mask_obs = fits.getdata(path_obs + 'mask_161x161_in16_out80.fits')
+        self.mask_planet = fits.getdata(path_obs + 'mask_161x161_in16_out80_plus_planets.fits')
+        self.mask_calc = np.copy(self.mask_planet)
+        if ADI:
+            self.obs_raw = fits.getdata(path_obs + 'data_cut.fits')
+            self.mask_disk = fits.getdata(path_obs + 'mask_disk.fits')
+            self.mask_calc *= self.mask_disk
+            self.map_transmission = fits.getdata(path_obs + 'NIRC2transmissionmap_161x161.fits')
+            self.pixels_obs = np.where(self.mask_obs.flatten() == 1)[0]
+            self.gram_obs = fm_klip.gram_centered(self.obs_raw.reshape(self.obs_raw.shape[0], -1)[:, self.pixels_obs])
+        else:
+            self.components_klip = fits.getdata(path_obs + 'components3_0to2.fits')
+        self.mask_calc[self.mask_calc < 1] = np.nan
+        if not ADI:
+            self.likelihood = gaussian_likelihood(self.data_obs*self.mask_calc, self.unc_obs)
+        
+        self.angles = fits.getdata(path_obs + 'pyklip_parangs.fits')
+        
+        self.psf = fits.getdata(path_obs + 'psf_noscale.fits')
+        if np.nansum(self.psf) > 1:
+            self.psf /= np.nansum(self.psf)
+        
+    def __reduce__(self):
+        return (load_data_input_pds70keck, self._init_args)
+
+def load_data_input_pds70keck(path_obs = None, ADI = False):
+    """Return a data_input_pds70keck object, the observations are read only once per process for the same input."""
+    key = ('pds70keck', path_obs, ADI)
+    if key not in _data_input_loaded:
+        _data_input_loaded[key] = data_input_pds70keck(path_obs = path_obs, ADI = ADI)
+    return _data_input_loaded[key]
+
+def lnlike_pds70keck(path_obs = None, path_model = None, hash_address = False, delete_model = True, hash_string = None,
+                     return_model_only = False, data_input_info = None, writemodel = False, flux_scale = None):
     """Return the log-likelihood for observed data and modelled data.
     Input:  path_obs: the path to the observed data
             path_model: the path to the (forwarded) models
             hash_address: whether to hash the address based on the values, if True, then the address should be provided by `hash_string'
             delete_model: whether to delete the models. True by default.
             return_model_only: only return the forwarded models for debug/grid-modeling purpose
-            data_input_info: a class object containign input data, uncertainty, mask, etc. See row 270 for a setup example. 
+            data_input_info: a data_input_pds70keck object containign input data, uncertainty, mask, etc. If None, they are read from `path_obs'.
             writemodel: write model in the model folder for easy comparison
+            flux_scale: None (default), 'profile', or 'marginalize'. If not None, the model is multiplied by a free non-negative scale factor, 
+                        which is profiled or marginalized analytically, see lnlike_flux_scale(). The forward modeling (rotation, convolution,
+                        KLIP, and median combination) commutes with a positive scale factor.
     Output: log-likelihood
             """
     ### Observations:
     if data_input_info is None: 
-        print("Reading the observation each time, this might be redundant. See the else sentences in this block...")
-        if path_obs is None:
-            path_obs = './reduction-bren/'
-        
-        data_obs = fits.getdata(path_obs + 'result_median_3components.fits')
-        unc_obs = fits.getdata(path_obs + 'result_std_3components.fits')
-        components_klip_obs = fits.getdata(path_obs + 'components3_0to2.fits')
-
-        mask_obs = fits.getdata(path_obs + 'mask_161x161_in16_out80.fits')
-
-        mask_planet = fits.getdata(path_obs + 'mask_161x161_in16_out80_plus_planets.fits')
-        mask_calc = np.copy(mask_planet)
-        mask_calc[mask_calc < 1] = np.nan
-
-        angles = fits.getdata(path_obs + 'pyklip_parangs.fits')
-
-        psf_keck = fits.getdata(path_obs + 'psf_noscale.fits')
-        if np.nansum(psf_keck) > 1:
-            psf_keck /= np.nansum(psf_keck)
-    else:
-        data_obs = np.copy(data_input_info.data_obs)
-        unc_obs = np.copy(data_input_info.unc_obs)
-        components_klip_obs = np.copy(data_input_info.components_klip)
-        mask_obs = np.copy(data_input_info.mask_obs)
-        mask_planet = np.copy(data_input_info.mask_planet)
-        mask_calc = np.copy(data_input_info.mask_calc)
-        angles = np.copy(data_input_info.angles)
-        psf_keck = np.copy(data_input_info.psf)
-        # See the following for a sample setup with the class object --- do it before calling the posterior function
-        # This is designed to speed up the calculations by reading the observations for only once.
-        # >>> code start 1
-        # class data_input:
-        #     def __init__(self, path_obs = None, data_obs = None, unc_obs = None, mask_obs = None, mask_planet = None,
-        #                 psf = None, components_klip = None, angles = None):
-        #         if path_obs is not None:
-        #             self.data_obs = fits.getdata(path_obs + 'result_median_3components.fits')
-        #             self.unc_obs = fits.getdata(path_obs + 'result_std_3components.fits')
-        #             self.components_klip = fits.getdata(path_obs + 'components3_0to2.fits')
-        #
-        #             self.mask_obs = fits.getdata(path_obs + 'mask_161x161_in16_out80.fits')
-        #
-        #             self.mask_planet = fits.getdata(path_obs + 'mask_161x161_in16_out80_plus_planets.fits')
-        #             self.mask_calc = np.copy(self.mask_planet)
-        #             self.mask_calc[np.where(self.mask_calc < 1)] = np.nan
-        #
-        #             self.angles = fits.getdata(path_obs + 'pyklip_parangs.fits')
-        #
-        #             self.psf = fits.getdata(path_obs + 'psf_noscale.fits')
-        #             self.psf /= np.nansum(self.psf)
-        # <<< code end 1
-        # Then set the object up as:
-        # >>> code start 2
-        # data_input_info = data_input(path_obs = './reduction-bren/')
-        # <<< code end 2
+        print("Reading the observation each time, this might be redundant. Pass a data_input_pds70keck object as `data_input_info' instead.")
+        data_input_info = data_input_pds70keck(path_obs = path_obs)
+    likelihood = getattr(data_input_info, 'likelihood', None)
+    if likelihood is None:      # e.g., a data_input_pds70keck object with `ADI = True`, or another object with the same attributes
+        likelihood = gaussian_likelihood(data_input_info.data_obs*data_input_info.mask_calc, data_input_info.unc_obs)
+    components_klip_obs = data_input_info.components_klip
+    mask_obs = np.copy(data_input_info.mask_obs)
+    angles = data_input_info.angles
+    psf_keck = data_input_info.psf
 
     ### (Forwarded) Models:
     if path_model is None:
@@ -311,13 +721,21 @@ def lnlike_pds70keck(path_obs = None, path_model = None, hash_address = False, d
 
     model_mcfost[(model_mcfost.shape[0] - 1)//2, (model_mcfost.shape[1] - 1)//2] = 0
 
-    cube = dependencies.rotateCube(model_mcfost, angle=-angles, mask = mask_obs, maskedNaN=True, outputMask=False)
-    cube_convoled = np.array([image_registration.fft_tools.convolve_nd.convolvend(cube[i], psf_keck) for i in range(cube.shape[0])])
-    cube_reduced = np.array([fm_klip.klip(cube_convoled[i], components_klip_obs, mask = mask_obs, cube=False) for i in range(cube.shape[0])])
-    reduced_derotated =  dependencies.rotateCube(cube_reduced, angle=angles, mask = mask_obs, maskedNaN=True, outputMask=False)
-    model_fm = np.nanmedian(reduced_derotated, axis = 0)
+    # The frames with the same angle are identical through the whole forward modeling: calculate each unique angle only once
+    angles_unique, angle_index = np.unique(angles, return_inverse = True)
+    cube = dependencies.rotateCube(model_mcfost, angle=-angles_unique, mask = mask_obs, maskedNaN=True, outputMask=False, method = 'sparse')
+    if len(cube.shape) == 2:
+        cube = cube[np.newaxis]
+    cube_convoled = dependencies.psfConvolution(psf_keck).apply(cube)
+    cube_reduced = fm_klip.klip_batch(cube_convoled, components_klip_obs, mask = mask_obs)
+    reduced_derotated =  dependencies.rotateCube(cube_reduced, angle=angles_unique, mask = mask_obs, maskedNaN=True, outputMask=False, method = 'sparse')
+    model_fm = np.nanmedian(reduced_derotated[angle_index], axis = 0)
         
-    lnlike_value = chi2(data_obs*mask_calc, unc_obs, model_fm, lnlike=True)
+    if flux_scale is None:
+        lnlike_value = likelihood.lnlike(model_fm)
+    else:
+        lnlike_value, alpha = lnlike_flux_scale([likelihood.scale_terms(model_fm)], method = flux_scale)
+        model_fm = model_fm*alpha
     
     if writemodel:
         fits.writeto(path_model + 'model_fm.fits', model_fm, overwrite = True)
@@ -327,80 +745,32 @@ def lnlike_pds70keck(path_obs = None, path_model = None, hash_address = False, d
     
     return  lnlike_value #Returns the loglikelihood
     
-def lnlike_pds70keck_ADI(path_obs = None, path_model = None, hash_address = False, delete_model = True, hash_string = None, return_model_only = False, data_input_info = None, writemodel = False):
+def lnlike_pds70keck_ADI(path_obs = None, path_model = None, hash_address = False, delete_model = True,
+                         hash_string = None, return_model_only = False, data_input_info = None, writemodel = False,
+                         incremental_pca = False):
     """Return the log-likelihood for observed data and modelled data.
     Input:  path_obs: the path to the observed data
             path_model: the path to the (forwarded) models
             hash_address: whether to hash the address based on the values, if True, then the address should be provided by `hash_string'
             delete_model: whether to delete the models. True by default.
             return_model_only: only return the forwarded models for debug/grid-modeling purpose
-            data_input_info: a class object containign input data, uncertainty, mask, etc. See row 270 for a setup example. 
+            data_input_info: a data_input_pds70keck object (with `ADI = True') containign input data, uncertainty, mask, etc. If None, they are read from `path_obs'.
             writemodel: write model in the model folder for easy comparison
+            incremental_pca: if True, the PCA of the negative injected cube is updated from the precomputed one of the raw cube 
+                            (`data_input_info.gram_obs`) for the model, instead of recalculated, see fm_klip.klip_model_subtracted().
+                            The KL modes are the same to rounding errors. False by default.
     Output: log-likelihood
             """
     ### Observations:
     if data_input_info is None: 
-        print("Reading the observation each time, this might be redundant. See the else sentences in this block...")
-        if path_obs is None:
-            path_obs = './reduction-bren/'
-        
-        data_obs = fits.getdata(path_obs + 'result_median_3components.fits')
-        unc_obs = fits.getdata(path_obs + 'result_std_3components.fits')
-        obs_raw = fits.getdata(path_obs + 'data_cut.fits')
-
-        mask_obs = fits.getdata(path_obs + 'mask_161x161_in16_out80.fits')
-
-        mask_planet = fits.getdata(path_obs + 'mask_161x161_in16_out80_plus_planets.fits')
-        mask_disk = fits.getdata(path_obs + 'mask_disk.fits')
-        mask_calc = np.copy(mask_planet)*mask_disk
-        mask_calc[mask_calc < 1] = np.nan
-
-        angles = fits.getdata(path_obs + 'pyklip_parangs.fits')
-
-        psf_keck = fits.getdata(path_obs + 'psf_noscale.fits')
-        if np.nansum(psf_keck) > 1:
-            psf_keck /= np.nansum(psf_keck)
-    else:
-        data_obs = np.copy(data_input_info.data_obs)
-        unc_obs = np.copy(data_input_info.unc_obs)
-        obs_raw = np.copy(data_input_info.obs_raw)
-        mask_obs = np.copy(data_input_info.mask_obs)
-        mask_planet = np.copy(data_input_info.mask_planet)
-        mask_calc = np.copy(data_input_info.mask_calc)
-        mask_calc[mask_calc < 1] = np.nan
-        angles = np.copy(data_input_info.angles)
-        psf_keck = np.copy(data_input_info.psf)
-        map_transmission = np.copy(data_input_info.map_transmission)
-        
-        # See the following for a sample setup with the class object --- do it before calling the posterior function
-        # This is designed to speed up the calculations by reading the observations for only once.
-        # >>> code start 1
-        # class data_input:
-        #     def __init__(self, path_obs = None, data_obs = None, unc_obs = None, mask_obs = None, mask_planet = None,
-        #                 psf = None, components_klip = None, angles = None):
-        #         if path_obs is not None:
-        #             self.data_obs = fits.getdata(path_obs + 'result_median_3components.fits')
-        #             self.unc_obs = fits.getdata(path_obs + 'result_std_3components.fits')
-        #             self.obs_raw = fits.getdata(path_obs + 'data_cut.fits')
-        #
-        #             self.mask_obs = fits.getdata(path_obs + 'mask_161x161_in16_out80.fits')
-        #
-        #             self.mask_planet = fits.getdata(path_obs + 'mask_161x161_in16_out80_plus_planets.fits')
-        #             self.mask_disk = fits.getdata(path_obs + 'mask_disk.fits')
-        #             self.mask_calc = np.copy(self.mask_planet) * mask_disk
-        #             self.mask_calc[np.where(self.mask_calc < 1)] = np.nan
-        #
-        #             self.map_transmission = fits.getdata(path_obs + 'NIRC2transmissionmap_161x161.fits')
-        #
-        #             self.angles = fits.getdata(path_obs + 'pyklip_parangs.fits')
-        #
-        #             self.psf = fits.getdata(path_obs + 'psf_noscale.fits')
-        #             self.psf /= np.nansum(self.psf)
-        # <<< code end 1
-        # Then set the object up as:
-        # >>> code start 2
-        # data_input_info = data_input(path_obs = './reduction-bren/')
-        # <<< code end 2
+        print("Reading the observation each time, this might be redundant. Pass a data_input_pds70keck object as `data_input_info' instead.")
+        data_input_info = data_input_pds70keck(path_obs = path_obs, ADI = True)
+    obs_raw = data_input_info.obs_raw
+    mask_obs = np.copy(data_input_info.mask_obs)
+    mask_calc = data_input_info.mask_calc
+    angles = data_input_info.angles
+    psf_keck = data_input_info.psf
+    map_transmission = data_input_info.map_transmission
 
     ### (Forwarded) Models:
     if path_model is None:
@@ -418,20 +788,25 @@ def lnlike_pds70keck_ADI(path_obs = None, path_model = None, hash_address = Fals
 
     model_mcfost[(model_mcfost.shape[0] - 1)//2, (model_mcfost.shape[1] - 1)//2] = 0
 
-    cube = dependencies.rotateCube(model_mcfost, angle=-angles, mask = mask_obs, maskedNaN=True, outputMask=False)
-    cube_convoled = np.array([image_registration.fft_tools.convolve_nd.convolvend(cube[i], psf_keck) for i in range(cube.shape[0])])
+    cube = dependencies.rotateCube(model_mcfost, angle=-angles, mask = mask_obs, maskedNaN=True, outputMask=False, method = 'sparse')
+    cube_convoled = dependencies.psfConvolution(psf_keck).apply(cube)
     
     cube_convoled *= map_transmission #multiply the transmission map
     
     #negative injection
     obs_neg_injected = obs_raw - cube_convoled
     # PCA for negative injected observation
-    components_neg_injected = fm_klip.pcaImageCube(obs_neg_injected, mask_obs, pcNum = 4)
-    klipped_neg_injected = np.zeros_like(obs_neg_injected)
-    for i in range(klipped_neg_injected.shape[0]):
-        klipped_neg_injected[i] = fm_klip.klip(obs_neg_injected[i], components_neg_injected, mask_obs, cube = False)
+    if incremental_pca:
+        pixels_obs = data_input_info.pixels_obs
+        klipped_neg_injected = np.zeros(obs_neg_injected.shape)
+        klipped_neg_injected.reshape(obs_raw.shape[0], -1)[:, pixels_obs] = fm_klip.klip_model_subtracted(obs_raw.reshape(obs_raw.shape[0], -1)[:, pixels_obs], 
+                                                                                    cube_convoled.reshape(obs_raw.shape[0], -1)[:, pixels_obs], 
+                                                                                    pcNum = 4, obs_gram = data_input_info.gram_obs)
+    else:
+        components_neg_injected = fm_klip.pcaImageCube(obs_neg_injected, mask_obs, pcNum = 4)
+        klipped_neg_injected = fm_klip.klip_batch(obs_neg_injected, components_neg_injected, mask_obs)
     
-    reduced_derotated =  dependencies.rotateCube(klipped_neg_injected, angle=angles, mask = mask_obs, maskedNaN=True, outputMask=False)
+    reduced_derotated =  dependencies.rotateCube(klipped_neg_injected, angle=angles, mask = mask_obs, maskedNaN=True, outputMask=False, method = 'sparse')
     
     result_neg_inj = np.nanmedian(reduced_derotated, axis = 0)
     unc_neg_inj = np.nanstd(reduced_derotated, axis = 0)/np.sqrt(48)
@@ -441,8 +816,9 @@ def lnlike_pds70keck_ADI(path_obs = None, path_model = None, hash_address = Fals
     if writemodel:
         fits.writeto(path_model + 'cube_minus_disk.fits', obs_neg_injected, overwrite = True)
         fits.writeto(path_model + 'model_fm.fits', result_neg_inj, overwrite = True)
-        fits.writeto(path_model + 'model_convolved.fits', image_registration.fft_tools.convolve_nd.convolvend(model_mcfost, psf_keck), overwrite = True)
-        fits.writeto(path_model + 'model_convolved_times_transmission.fits', image_registration.fft_tools.convolve_nd.convolvend(model_mcfost, psf_keck)*map_transmission, overwrite = True)
+        model_convolved = dependencies.psfConvolution(psf_keck).apply(model_mcfost)
+        fits.writeto(path_model + 'model_convolved.fits', model_convolved, overwrite = True)
+        fits.writeto(path_model + 'model_convolved_times_transmission.fits', model_convolved*map_transmission, overwrite = True)
         fits.writeto(path_model + 'model_fm_snr.fits', result_neg_inj/unc_neg_inj, overwrite = True)
         
         
@@ -4,7 +4,11 @@ from . import mcfostRun
 import numpy as np
 import shutil
 
-def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_model = None, calcSED = False, hash_address = True, STIS = True, NICMOS = True, GPI = True, Fe_composition = False, pit = False, pit_input = None):
+def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_model = None, calcSED = False,
+                    hash_address = True, STIS = True, NICMOS = True, GPI = True, Fe_composition = False, pit = False,
+                    pit_input = None, data_input_info = None, parallel_images = False, n_threads = None,
+                    cache_path = None, cache_max_size = None, pa_rotation = False, m_ref = None, tau_max = 1e-2,
+                    scratch_path = None, keep_artifacts = None, flux_scale = None, flux_scale_shared = False):
     """Returns the log-posterior probability (post = prior * likelihood, thus lnpost = lnprior + lnlike)
     for a given parameter combination.
     Input:  var_values: number array, values for var_names. Refer to mcfostRun() for details. 
@@ -22,6 +26,24 @@ def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_m
             pit: boolean, whether to use Probability Integral Transform (PIT) to sample from the posteriors from the previous MCMC run?
                 If True, then `pit_input` cannot be None
             pit_input: 2D array/matrix, input MCMC posterior from last run, if not None, only when `pit == True` will it be considered
+            data_input_info: a lnlike.data_input_hd191089 object holding the observations, build it once before the MCMC to avoid 
+                reading the observations for every evaluation. If None, the observations are read from `path_obs`.
+            parallel_images: boolean, whether to run the MCFOST image calculations of the instruments at the same time. Refer to mcfostRun.run_hd191089() for details.
+            n_threads: integer, number of OpenMP threads for each MCFOST image calculation. Refer to mcfostRun.run_hd191089() for details.
+            cache_path: string, folder of the MCFOST model cache, None to always run MCFOST. Refer to mcfostRun.run_hd191089() for details.
+            cache_max_size: float, maximum size of the MCFOST model cache in GB. Refer to mcfostRun.run_hd191089() for details.
+            pa_rotation: boolean, whether to run MCFOST at a fixed position angle and rotate the images. Refer to mcfostRun.run_hd191089() for details.
+            m_ref: float, reference dust mass (log scale). If not None and `m_disk` is varied, MCFOST is run at `m_ref` and the images 
+                are scaled by 10**(m_disk - m_ref) in lnlike.lnlike_hd191089(), i.e., the disk is assumed to be optically thin.
+            tau_max: float, if the scattered light is more than `tau_max` of the stellar flux after the scaling (see mcfostRun.scattered_fraction()),
+                the disk is not treated as optically thin, and MCFOST is run again at `m_disk`.
+            scratch_path: string, e.g., '$TMPDIR' or '/dev/shm/', if not None, the model folders are created there instead of in `path_model`.
+                Refer to mcfostRun.scratch_path_model() for details.
+            keep_artifacts: list of strings, glob patterns of the model outputs (e.g., ['*.para', 'data_0.58/RT.fits.gz']) to be copied
+                from `scratch_path` to `path_model` before the model folder is deleted. If None, nothing is kept.
+            flux_scale: None (default), 'profile', or 'marginalize'. If not None, the models are multiplied by a free (non-negative) scale factor
+                for each instrument, which is solved analytically. Refer to lnlike.lnlike_hd191089() and lnlike.lnlike_flux_scale() for details.
+            flux_scale_shared: boolean, if True, the instruments share the same scale factor. Refer to lnlike.lnlike_hd191089() for details.
     Output: log-posterior probability."""
     if pit:
         var_values_percentiles = np.copy(var_values)
@@ -30,20 +52,74 @@ def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_m
                 return -np.inf                  #only accept percentiles ranging from 2.5 to 97.5 (PIT requirement: ``p-value'' >= 0.05)
         for i, percentile in enumerate(var_values_percentiles):
             var_values[i] = np.nanpercentile(pit_input[:, i], percentile)
+    
+    if data_input_info is not None:     # a wrong input would otherwise give -inf for every sample
+        data_input_info.check_instruments(STIS = STIS, NICMOS = NICMOS, GPI = GPI)
+    
+    path_model_keep = path_model
+    path_model = mcfostRun.scratch_path_model(path_model, scratch_path)
         
     ln_prior = lnprior.lnprior_hd191089(var_names = var_names, var_values = var_values)
     
     if not np.isfinite(ln_prior):
         return -np.inf
+    
+    mass_scale = 1
+    if m_ref is not None and 'm_disk' in list(var_names):
+        mass_scale = 10**(var_values[list(var_names).index('m_disk')] - m_ref)
+    else:
+        m_ref = None
         
     run_flag = 1
     try:
         if hash_address:
-            run_flag, hash_string = mcfostRun.run_hd191089(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = True, hash_address = hash_address, STIS = STIS, NICMOS = NICMOS, GPI = GPI, Fe_composition = Fe_composition)
+            run_flag, hash_string = mcfostRun.run_hd191089(var_names = var_names, var_values = var_values,
+                                                           paraPath = path_model, calcSED = calcSED, calcImage = True,
+                                                           hash_address = hash_address, STIS = STIS, NICMOS = NICMOS,
+                                                           GPI = GPI, Fe_composition = Fe_composition,
+                                                           parallel_images = parallel_images, n_threads = n_threads,
+                                                           cache_path = cache_path, cache_max_size = cache_max_size,
+                                                           pa_rotation = pa_rotation, m_ref = m_ref)
         else:
-            run_flag = mcfostRun.run_hd191089(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = True, hash_address = hash_address, STIS = STIS, NICMOS = NICMOS, GPI = GPI, Fe_composition = Fe_composition)
+            run_flag = mcfostRun.run_hd191089(var_names = var_names, var_values = var_values, paraPath = path_model,
+                                              calcSED = calcSED, calcImage = True, hash_address = hash_address,
+                                              STIS = STIS, NICMOS = NICMOS, GPI = GPI, Fe_composition = Fe_composition,
+                                              parallel_images = parallel_images, n_threads = n_threads,
+                                              cache_path = cache_path, cache_max_size = cache_max_size,
+                                              pa_rotation = pa_rotation, m_ref = m_ref)
     except:
         pass
+    
+    if run_flag == 0 and m_ref is not None:     # check whether the scaled disk is still optically thin, otherwise run MCFOST at `m_disk`
+        try:
+            path_model_run = path_model
+            if hash_address:
+                path_model_run = path_model[:-1] + hash_string + '/'
+            wavelength = ['0.58', '1.12', '1.65'][[STIS, NICMOS, GPI].index(True)]
+            fraction = mcfostRun.scattered_fraction(path_model_run + 'data_' + wavelength + '/RT.fits.gz')
+            optically_thin = (fraction * mass_scale <= tau_max)
+        except:
+            optically_thin = False
+        if not optically_thin:
+            shutil.rmtree(path_model_run, ignore_errors = True)
+            return lnpost_hd191089(var_values = var_values, var_names = var_names, path_obs = path_obs,
+                                   path_model = path_model_keep, calcSED = calcSED, hash_address = hash_address,
+                                   STIS = STIS, NICMOS = NICMOS, GPI = GPI, Fe_composition = Fe_composition,
+                                   data_input_info = data_input_info, parallel_images = parallel_images,
+                                   n_threads = n_threads, cache_path = cache_path, cache_max_size = cache_max_size,
+                                   pa_rotation = pa_rotation, scratch_path = scratch_path,
+                                   keep_artifacts = keep_artifacts, flux_scale = flux_scale,
+                                   flux_scale_shared = flux_scale_shared)
+        
+    if keep_artifacts is not None and path_model != path_model_keep:
+        try:
+            if hash_address:
+                mcfostRun.copy_artifacts(path_model[:-1] + hash_string + '/', path_model_keep[:-1] + hash_string + '/',
+                                         keep_artifacts)
+            else:
+                mcfostRun.copy_artifacts(path_model, path_model_keep, keep_artifacts)
+        except:
+            print('The artifacts are not successfully copied.')
         
     if not (run_flag == 0):             # if run is not successful, remove the folders
         try:
@@ -56,9 +132,16 @@ def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_m
         return -np.inf
     try:                                # if run is successful, calculate the posterior
         if hash_address:
-            ln_likelihood = lnlike.lnlike_hd191089(path_obs = path_obs, path_model = path_model, hash_address = hash_address, hash_string = hash_string, STIS = STIS, NICMOS = NICMOS, GPI = GPI)
+            ln_likelihood = lnlike.lnlike_hd191089(path_obs = path_obs, path_model = path_model,
+                                                   hash_address = hash_address, hash_string = hash_string, STIS = STIS,
+                                                   NICMOS = NICMOS, GPI = GPI, data_input_info = data_input_info,
+                                                   mass_scale = mass_scale, flux_scale = flux_scale,
+                                                   flux_scale_shared = flux_scale_shared)
         else:
-            ln_likelihood = lnlike.lnlike_hd191089(path_obs = path_obs, path_model = path_model, hash_address = hash_address, STIS = STIS, NICMOS = NICMOS, GPI = GPI)
+            ln_likelihood = lnlike.lnlike_hd191089(path_obs = path_obs, path_model = path_model,
+                                                   hash_address = hash_address, STIS = STIS, NICMOS = NICMOS, GPI = GPI,
+                                                   data_input_info = data_input_info, mass_scale = mass_scale,
+                                                   flux_scale = flux_scale, flux_scale_shared = flux_scale_shared)
         
         return ln_prior + ln_likelihood
     except:
@@ -66,7 +149,10 @@ def lnpost_hd191089(var_values = None, var_names = None, path_obs = None, path_m
             shutil.rmtree(path_model[:-1] + hash_string + '/')
         return -np.inf                  #loglikelihood calculation is not sucessful
 
-def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, path_model = None, calcSED = False, hash_address = True, calcImage = False, calcSPF = True, Fe_composition = False, pit = False, pit_input = None):
+def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, path_model = None, calcSED = False,
+                        hash_address = True, calcImage = False, calcSPF = True, Fe_composition = False, pit = False,
+                        pit_input = None, data_input_info = None, cache_path = None, cache_max_size = None,
+                        pa_rotation = False, scratch_path = None, keep_artifacts = None):
     """Returns the log-posterior probability (post = prior * likelihood, thus lnpost = lnprior + lnlike)
     for a given parameter combination.
     Input:  var_values: number array, values for var_names. Refer to mcfostRun() for details. 
@@ -83,6 +169,13 @@ def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, pa
             pit: boolean, whether to use Probability Integral Transform (PIT) to sample from the posteriors from the previous MCMC run?
                 If True, then `pit_input` cannot be None
             pit_input: 2D array/matrix, input MCMC posterior from last run, if not None, only when `pit == True` will it be considered
+            data_input_info: a lnlike.data_input_hr4796aH2spf object holding the observed SPF. If None, it is read from `path_obs`.
+            cache_path, cache_max_size: the MCFOST model cache for the image. Refer to mcfostRun.run_hd191089() for details.
+            pa_rotation: boolean, whether to run MCFOST at a fixed position angle and rotate the image. Refer to mcfostRun.run_hd191089() for details.
+            scratch_path: string, e.g., '$TMPDIR' or '/dev/shm/', if not None, the model folders are created there instead of in `path_model`.
+                Refer to mcfostRun.scratch_path_model() for details.
+            keep_artifacts: list of strings, glob patterns of the model outputs (e.g., ['*.para', 'data_0.58/RT.fits.gz']) to be copied
+                from `scratch_path` to `path_model` before the model folder is deleted. If None, nothing is kept.
     Output: log-posterior probability."""
     if pit: # currently a placeholder in case more calculations are needed
         var_values_percentiles = np.copy(var_values)
@@ -91,6 +184,9 @@ def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, pa
                 return -np.inf                  #only accept percentiles ranging from 2.5 to 97.5 (PIT requirement: ``p-value'' >= 0.05)
         for i, percentile in enumerate(var_values_percentiles):
             var_values[i] = np.nanpercentile(pit_input[:, i], percentile)
+    
+    path_model_keep = path_model
+    path_model = mcfostRun.scratch_path_model(path_model, scratch_path)
         
     ln_prior = lnprior.lnprior_hr4796aH2spf(var_names = var_names, var_values = var_values)
     
@@ -100,12 +196,32 @@ def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, pa
     run_flag = 1
     try:
         if hash_address:
-            run_flag, hash_string = mcfostRun.run_hr4796aH2spf(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = calcImage, calcSPF = calcSPF, hash_address = hash_address, Fe_composition = Fe_composition)
+            run_flag, hash_string = mcfostRun.run_hr4796aH2spf(var_names = var_names, var_values = var_values,
+                                                               paraPath = path_model, calcSED = calcSED,
+                                                               calcImage = calcImage, calcSPF = calcSPF,
+                                                               hash_address = hash_address,
+                                                               Fe_composition = Fe_composition, cache_path = cache_path,
+                                                               cache_max_size = cache_max_size,
+                                                               pa_rotation = pa_rotation)
         else:
-            run_flag = mcfostRun.run_hr4796aH2spf(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = calcImage, calcSPF = calcSPF, hash_address = hash_address, Fe_composition = Fe_composition)
+            run_flag = mcfostRun.run_hr4796aH2spf(var_names = var_names, var_values = var_values, paraPath = path_model,
+                                                  calcSED = calcSED, calcImage = calcImage, calcSPF = calcSPF,
+                                                  hash_address = hash_address, Fe_composition = Fe_composition,
+                                                  cache_path = cache_path, cache_max_size = cache_max_size,
+                                                  pa_rotation = pa_rotation)
     except:
         pass
         
+    if keep_artifacts is not None and path_model != path_model_keep:
+        try:
+            if hash_address:
+                mcfostRun.copy_artifacts(path_model[:-1] + hash_string + '/', path_model_keep[:-1] + hash_string + '/',
+                                         keep_artifacts)
+            else:
+                mcfostRun.copy_artifacts(path_model, path_model_keep, keep_artifacts)
+        except:
+            print('The artifacts are not successfully copied.')
+        
     if not (run_flag == 0):             # if run is not successful, remove the folders
         try:
             if hash_address:
@@ -117,9 +233,12 @@ def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, pa
         return -np.inf
     try:                                # if run is successful, calculate the posterior
         if hash_address:
-            ln_likelihood = lnlike.lnlike_hr4796aH2spf(path_obs = path_obs, path_model = path_model, hash_address = hash_address, hash_string = hash_string)
+            ln_likelihood = lnlike.lnlike_hr4796aH2spf(path_obs = path_obs, path_model = path_model,
+                                                       hash_address = hash_address, hash_string = hash_string,
+                                                       data_input_info = data_input_info)
         else:
-            ln_likelihood = lnlike.lnlike_hr4796aH2spf(path_obs = path_obs, path_model = path_model, hash_address = hash_address)
+            ln_likelihood = lnlike.lnlike_hr4796aH2spf(path_obs = path_obs, path_model = path_model,
+                                                       hash_address = hash_address, data_input_info = data_input_info)
         
         return ln_prior + ln_likelihood
     except:
@@ -127,12 +246,17 @@ def lnpost_hr4796aH2spf(var_values = None, var_names = None, path_obs = None, pa
             shutil.rmtree(path_model[:-1] + hash_string + '/')
         return -np.inf                  #loglikelihood calculation is not sucessful
           
-def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None, path_obs = None, path_model = None, calcSED = False, hash_address = True, calcImage = False, Keck38 = True, pit = False, pit_input = None):
+def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None, path_obs = None, path_model = None,
+                     calcSED = False, hash_address = True, calcImage = False, Keck38 = True, pit = False,
+                     pit_input = None, cache_path = None, cache_max_size = None, pa_rotation = False,
+                     scratch_path = None, keep_artifacts = None, incremental_pca = False, flux_scale = None):
     """Returns the log-posterior probability (post = prior * likelihood, thus lnpost = lnprior + lnlike)
     for a given parameter combination.
     Input:  var_values: number array, values for var_names. Refer to mcfostRun() for details. 
                 'It is important that the first argument of the probability function is the position of a single walker (a N dimensional numpy array).' (http://dfm.io/emcee/current/user/quickstart/)
             var_names: string array, names of variables. Refer to mcfostRun() for details.
+            data_input_info: a lnlike.data_input_pds70keck object (with `ADI = True`, or `ADI = False` if `flux_scale` is not None) holding 
+                the observations, build it once before the MCMC.
             path_obs: string, address where the observed values are stored.
             path_model: string, address where you would like to store the MCFOST dust properties.
             calcSED: boolean, whether to calculate the SED of the system.
@@ -144,6 +268,17 @@ def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None
             pit: boolean, whether to use Probability Integral Transform (PIT) to sample from the posteriors from the previous MCMC run?
                 If True, then `pit_input` cannot be None
             pit_input: 2D array/matrix, input MCMC posterior from last run, if not None, only when `pit == True` will it be considered
+            cache_path, cache_max_size: the MCFOST model cache for the image. Refer to mcfostRun.run_hd191089() for details.
+            pa_rotation: boolean, whether to run MCFOST at a fixed position angle and rotate the image. Refer to mcfostRun.run_hd191089() for details.
+            scratch_path: string, e.g., '$TMPDIR' or '/dev/shm/', if not None, the model folders are created there instead of in `path_model`.
+                Refer to mcfostRun.scratch_path_model() for details.
+            keep_artifacts: list of strings, glob patterns of the model outputs (e.g., ['*.para', 'data_0.58/RT.fits.gz']) to be copied
+                from `scratch_path` to `path_model` before the model folder is deleted. If None, nothing is kept.
+            incremental_pca: boolean, whether to update the PCA of the negative injected cube instead of recalculating it. 
+                Refer to lnlike.lnlike_pds70keck_ADI() for details.
+            flux_scale: None (default), 'profile', or 'marginalize'. If not None, the model is multiplied by a free (non-negative) scale factor
+                solved analytically, with the KLIP forward modeling likelihood lnlike.lnlike_pds70keck() instead of the negative injection one 
+                (which has no analytic scale factor), then `data_input_info` should be a lnlike.data_input_pds70keck object with `ADI = False`.
     Output: log-posterior probability."""
     if pit: # currently a placeholder in case more calculations are needed
         var_values_percentiles = np.copy(var_values)
@@ -152,6 +287,9 @@ def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None
                 return -np.inf                  #only accept percentiles ranging from 2.5 to 97.5 (PIT requirement: ``p-value'' >= 0.05)
         for i, percentile in enumerate(var_values_percentiles):
             var_values[i] = np.nanpercentile(pit_input[:, i], percentile)
+    
+    path_model_keep = path_model
+    path_model = mcfostRun.scratch_path_model(path_model, scratch_path)
         
     ln_prior = lnprior.lnprior_pds70keck(var_names = var_names, var_values = var_values)
     
@@ -161,12 +299,29 @@ def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None
     run_flag = 1
     try:
         if hash_address:
-            run_flag, hash_string = mcfostRun.run_pds70keck(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = calcImage, hash_address = hash_address, Keck38 = Keck38)
+            run_flag, hash_string = mcfostRun.run_pds70keck(var_names = var_names, var_values = var_values,
+                                                            paraPath = path_model, calcSED = calcSED,
+                                                            calcImage = calcImage, hash_address = hash_address,
+                                                            Keck38 = Keck38, cache_path = cache_path,
+                                                            cache_max_size = cache_max_size, pa_rotation = pa_rotation)
         else:
-            run_flag = mcfostRun.run_pds70keck(var_names = var_names, var_values = var_values, paraPath = path_model, calcSED = calcSED, calcImage = calcImage, hash_address = hash_address, Keck38 = Keck38)
+            run_flag = mcfostRun.run_pds70keck(var_names = var_names, var_values = var_values, paraPath = path_model,
+                                               calcSED = calcSED, calcImage = calcImage, hash_address = hash_address,
+                                               Keck38 = Keck38, cache_path = cache_path,
+                                               cache_max_size = cache_max_size, pa_rotation = pa_rotation)
     except:
         pass
         
+    if keep_artifacts is not None and path_model != path_model_keep:
+        try:
+            if hash_address:
+                mcfostRun.copy_artifacts(path_model[:-1] + hash_string + '/', path_model_keep[:-1] + hash_string + '/',
+                                         keep_artifacts)
+            else:
+                mcfostRun.copy_artifacts(path_model, path_model_keep, keep_artifacts)
+        except:
+            print('The artifacts are not successfully copied.')
+        
     if not (run_flag == 0):             # if run is not successful, remove the folders
         try:
             if hash_address:
@@ -177,10 +332,24 @@ def lnpost_pds70keck(var_values = None, var_names = None, data_input_info = None
             print('This folder is not successfully removed.')
         return -np.inf
     try:                                # if run is successful, calculate the posterior
-        if hash_address:
-            ln_likelihood = lnlike.lnlike_pds70keck_ADI(path_obs = path_obs, path_model = path_model, hash_address = hash_address, hash_string = hash_string, data_input_info = data_input_info)
+        if flux_scale is not None:
+            if hash_address:
+                ln_likelihood = lnlike.lnlike_pds70keck(path_obs = path_obs, path_model = path_model,
+                                                        hash_address = hash_address, hash_string = hash_string,
+                                                        data_input_info = data_input_info, flux_scale = flux_scale)
+            else:
+                ln_likelihood = lnlike.lnlike_pds70keck(path_obs = path_obs, path_model = path_model,
+                                                        hash_address = hash_address, data_input_info = data_input_info,
+                                                        flux_scale = flux_scale)
+        elif hash_address:
+            ln_likelihood = lnlike.lnlike_pds70keck_ADI(path_obs = path_obs, path_model = path_model,
+                                                        hash_address = hash_address, hash_string = hash_string,
+                                                        data_input_info = data_input_info,
+                                                        incremental_pca = incremental_pca)
         else:
-            ln_likelihood = lnlike.lnlike_pds70keck_ADI(path_obs = path_obs, path_model = path_model, hash_address = hash_address, data_input_info = data_input_info)
+            ln_likelihood = lnlike.lnlike_pds70keck_ADI(path_obs = path_obs, path_model = path_model,
+                                                        hash_address = hash_address, data_input_info = data_input_info,
+                                                        incremental_pca = incremental_pca)
         
         return ln_prior + ln_likelihood
     except:
@@ -4,7 +4,7 @@ import matplotlib
 matplotlib.use('agg')
 import sys
 import debrisdiskfm                             # to import debrisdiskfm, make sure you setup the code in the DebrisDiskFM package using "python3 setup.py develop"
-from debrisdiskfm import lnpost_hd191089
+from debrisdiskfm import lnpost_hd191089, data_input_hd191089
 import numpy as np
 from schwimmbad import MPIPool
 import time
@@ -19,6 +19,7 @@ path_model='./mcfost_models/'                   # Where you'd like to store the
 var_names = np.array(['inc', 'PA', 'm_disk', 'Rc']) # Parameters of interest, the following commented line is all the parameters
 # var_names = np.array(['inc', 'PA', 'm_disk', 'Rc', 'R_in', 'alpha_in', 'alpha_out', 'porosity', 'fmass_0', 'fmass_1', 'a_min', 'Q_powerlaw'])
 var_values_init = np.array([59.7, 70, -7, 45.3])    # Initial guesses for the above parameters, the following line is for all the parameters
+data_input = data_input_hd191089(path_obs=path_obs)  # Read the observations only once (per worker), instead of in every evaluation
 # var_values_init = np.array([59.7, 70, -7, 45.3, 20, 3.5,  -3.5, 0.1, 0.05, 0.9, 1.0, 3.5])
 
 #lnpost_initial = lnpost_hd191089(var_values=var_values_init, var_names=var_names, path_obs=path_obs, path_model=path_model, calcSED=True, hash_address = False)# The above line calculates the SED to make sure MCMC can run in the "image-only" mode, as in the following line
@@ -44,12 +45,12 @@ with MPIPool() as pool:
         sys.exit(0)
     start = time.time()
     if not os.path.exists(filename):  #initial run, no backend file existed
-        sampler = emcee.EnsembleSampler(nwalkers = n_walkers, ndim = n_dim, log_prob_fn=lnpost_hd191089, args=[var_names, path_obs, path_model], pool = pool, backend=backend)
+        sampler = emcee.EnsembleSampler(nwalkers = n_walkers, ndim = n_dim, log_prob_fn=lnpost_hd191089, args=[var_names, path_obs, path_model], kwargs={'data_input_info': data_input}, pool = pool, backend=backend)
         values_ball = [var_values_init + 1e-1*np.random.randn(n_dim) for i in range(n_walkers)] # Initialize the walkers using different values 
                                                                                             # around the initial guess (var_values_init)
         sampler.run_mcmc(values_ball, step)
     else:    #load the data directly from the backend file
-        sampler = emcee.EnsembleSampler(nwalkers = n_walkers, ndim = n_dim, log_prob_fn = lnpost_hd191089, args = [var_names, path_obs, path_model], pool = pool, backend = backend)
+        sampler = emcee.EnsembleSampler(nwalkers = n_walkers, ndim = n_dim, log_prob_fn = lnpost_hd191089, args = [var_names, path_obs, path_model], kwargs = {'data_input_info': data_input}, pool = pool, backend = backend)
         sampler.run_mcmc(None, nsteps = step)
     end = time.time()
     serial_time = end - start
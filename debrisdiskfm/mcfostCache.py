@@ -0,0 +1,158 @@
+import copy
+import hashlib                      # digest of the parameter files
+import json
+import os
+import shutil
+import time
+import uuid
+
+# On-disk cache of MCFOST outputs, keyed by the content of the parameter file and the MCFOST options.
+# The parameters are rounded before they are written to the .para files, so different walker positions can give
+# byte-identical parameter files: their outputs are copied from the cache instead of running MCFOST again.
+#
+# Structure of the cache folder:
+#     cache_path/<digest>/data_<wavelength>/RT.fits.gz
+#     cache_path/th_<digest>/data_th/...      (thermal structure, see thermal_key())
+# The modification time of <digest> is updated when it is used, the least recently used ones are deleted first.
+# The entries used within the last `min_age` seconds are never deleted: a `th_` entry is linked (not copied) into the model
+# folders with cache_link(), and MCFOST reads it during the image runs.
+
+def cache_key(para_file, options = ''):
+    """Return the digest of a parameter file together with the MCFOST command line options.
+    Input:
+        para_file: string, path to the MCFOST parameter file.
+        options: string, the MCFOST options, e.g., '-img 0.58 -only_scatt'.
+    Output:
+        string, hexadecimal digest."""
+    digest = hashlib.sha1()
+    with open(para_file, 'rb') as f:
+        digest.update(f.read())
+    digest.update(' '.join(options.split()).encode())
+    return digest.hexdigest()
+
+# Entries of the parameter dictionary that do not change the temperature calculation: the maps (image size, inclination, 
+# distance, PA), the number of photon packages for the images, and the Stokes flag.
+thermal_irrelevant = [('#Maps', ), ('#Number of photon packages', 'row2'), ('#Wavelength', 'row3')]
+
+def thermal_key(para_dict):
+    """Return the digest of the parameters that affect the thermal structure (i.e., the `data_th` folder) of a model.
+    Input:
+        para_dict: a collections.OrderedDict type data structure, generated with mcfostParameterTemplate.generateMcfostTemplate().
+    Output:
+        string, hexadecimal digest, starting with 'th_'."""
+    para_thermal = copy.deepcopy(para_dict)
+    for entry in thermal_irrelevant:
+        block = para_thermal
+        for name in entry[:-1]:
+            block = block[name]
+        block.pop(entry[-1], None)
+    return 'th_' + hashlib.sha1(json.dumps(para_thermal, default = str).encode()).hexdigest()
+
+def cache_link(cache_path, key, destination):
+    """Link the cached outputs for `key` into the `destination` folder with symbolic links, without copying them.
+    The linked outputs are shared by all the models with the same key, and should only be read by MCFOST.
+    Input:
+        cache_path: string, the cache folder.
+        key: string, output of thermal_key() or cache_key().
+        destination: string, the folder where MCFOST looks for the outputs.
+    Output:
+        True if the outputs are found in the cache and linked, False otherwise."""
+    entry = os.path.abspath(os.path.join(cache_path, key))
+    if not os.path.isdir(entry):
+        return False
+    linked = []
+    try:
+        for folder in os.listdir(entry):
+            os.symlink(os.path.join(entry, folder), os.path.join(destination, folder))
+            linked.append(folder)
+        os.utime(entry)                                 # mark as recently used
+    except OSError:
+        for folder in linked:
+            os.remove(os.path.join(destination, folder))
+        return False
+    return True
+
+def cache_load(cache_path, key, destination):
+    """Copy the cached outputs for `key` to the `destination` folder.
+    Input:
+        cache_path: string, the cache folder.
+        key: string, output of cache_key().
+        destination: string, the folder where MCFOST would have saved the outputs.
+    Output:
+        True if the outputs are found in the cache and copied, False otherwise."""
+    entry = os.path.join(cache_path, key)
+    if not os.path.isdir(entry):
+        return False
+    copied = []
+    try:
+        for folder in os.listdir(entry):
+            shutil.copytree(os.path.join(entry, folder), os.path.join(destination, folder))
+            copied.append(folder)
+        os.utime(entry)                                 # mark as recently used
+    except OSError:                                     # e.g., removed by another process in the meantime
+        for folder in copied:
+            shutil.rmtree(os.path.join(destination, folder), ignore_errors = True)
+        return False
+    return True
+
+def cache_store(cache_path, key, source, folders, files = ('RT.fits.gz', ), max_size = None):
+    """Save the MCFOST outputs to the cache.
+    Input:
+        cache_path: string, the cache folder.
+        key: string, output of cache_key().
+        source: string, the folder where MCFOST saved the outputs.
+        folders: list of strings, the output folders to be saved, e.g., ['data_0.58'].
+        files: the files in the folders to be saved. If None, all the files in the folders are saved.
+        max_size: float, maximum size of the cache in GB. If not None, the least recently used entries are deleted beyond this size
+                  (except `key` and the entries used recently, see cache_evict()).
+    Output:
+        True if the outputs are saved, False otherwise."""
+    entry = os.path.join(cache_path, key)
+    if os.path.isdir(entry):
+        return True
+    os.makedirs(cache_path, exist_ok = True)
+    entry_temp = os.path.join(cache_path, '.tmp_' + key + '_' + uuid.uuid4().hex)
+    try:
+        for folder in folders:
+            if files is None:
+                shutil.copytree(os.path.join(source, folder), os.path.join(entry_temp, folder))
+                continue
+            os.makedirs(os.path.join(entry_temp, folder))
+            for filename in files:
+                shutil.copy2(os.path.join(source, folder, filename), os.path.join(entry_temp, folder, filename))
+        os.rename(entry_temp, entry)                     # atomic, other processes never see a partial entry
+    except OSError:
+        shutil.rmtree(entry_temp, ignore_errors = True) # e.g., missing output, or saved by another process in the meantime
+        return os.path.isdir(entry)
+    if max_size is not None:
+        cache_evict(cache_path, max_size, keep = key)
+    return True
+
+def cache_evict(cache_path, max_size, keep = None, min_age = 3600):
+    """Delete the least recently used entries until the cache is smaller than `max_size` (in GB).
+    Input:
+        cache_path: string, the cache folder.
+        max_size: float, maximum size of the cache in GB.
+        keep: string, a key that is never deleted, e.g., the one that has just been stored.
+        min_age: float, the entries used (stored, loaded, or linked) within the last `min_age` seconds are not deleted, 
+                since they can be in use by other processes (e.g., a linked thermal structure during an image run).
+                The cache can then stay larger than `max_size` for a while."""
+    entries = []
+    for key in os.listdir(cache_path):
+        entry = os.path.join(cache_path, key)
+        if key.startswith('.tmp_') or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(root, filename)) for root, dirs, filenames in os.walk(entry) for filename in filenames)
+            entries.append((os.path.getmtime(entry), size, key))
+        except OSError:
+            continue
+    total_size = sum(entry[1] for entry in entries)
+    time_limit = time.time() - min_age
+    for last_used, size, key in sorted(entries):
+        if total_size <= max_size * 1024**3:
+            break
+        if key == keep or last_used > time_limit:
+            continue
+        shutil.rmtree(os.path.join(cache_path, key), ignore_errors = True)
+        total_size -= size
@@ -97,7 +97,6 @@
 
 import collections
 import copy
-paramfile_dict = collections.OrderedDict()
 
 
 # # Create the (1) density structure (2) grain property (3) star property templates
@@ -238,6 +237,7 @@ def generateMcfostTemplate(n_zone = 1, n_species = [1], n_star = 1, n_component
     ###################################################################
     ############# Now the MCFOST input parameter template #############
     ###################################################################
+    paramfile_dict = collections.OrderedDict()    # a new one for each call, the runners modify it
 
     paramfile_dict['mcfost version'] = 3.0
 
@@ -368,206 +368,206 @@ def generateMcfostTemplate(n_zone = 1, n_species = [1], n_star = 1, n_component
 
     return paramfile_dict
 
-def print0_mcfost_version(sample_para_dict):
-    print(sample_para_dict['mcfost version'], '\t', 'mcfost version')
-    print()
+def print0_mcfost_version(sample_para_dict, file = None):
+    print(sample_para_dict['mcfost version'], '\t', 'mcfost version', file = file)
+    print(file = file)
     
-def print1_Number_of_photon_packages(sample_para_dict):
-    print('#Number of photon packages')
+def print1_Number_of_photon_packages(sample_para_dict, file = None):
+    print('#Number of photon packages', file = file)
     for row_name in sample_para_dict['#Number of photon packages']:
         for item in sample_para_dict['#Number of photon packages'][row_name]:
-            print(sample_para_dict['#Number of photon packages'][row_name][item], '\t', item)
-    print()
+            print(sample_para_dict['#Number of photon packages'][row_name][item], '\t', item, file = file)
+    print(file = file)
     
-def print2_Wavelength(sample_para_dict):
+def print2_Wavelength(sample_para_dict, file = None):
     block_name = '#Wavelength'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         for item in sample_para_dict[block_name][row_name]:
-            print(sample_para_dict[block_name][row_name][item], end = ' ')
-        print('\t', end = '')
+            print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+        print('\t', end = '', file = file)
         for item in sample_para_dict[block_name][row_name]:
-            print(item, end = ', ')
-        print()
-    print()
+            print(item, end = ', ', file = file)
+        print(file = file)
+    print(file = file)
         
-def print3_Grid_geometry_and_size(sample_para_dict):
+def print3_Grid_geometry_and_size(sample_para_dict, file = None):
     block_name = '#Grid geometry and size'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name], '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)', file = file)
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print()
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file)
 
-def print4_Maps(sample_para_dict):
+def print4_Maps(sample_para_dict, file = None):
     block_name = '#Maps'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name])#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], file = file)#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print()   
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file)   
     
-def print5_Scattering_method(sample_para_dict):
+def print5_Scattering_method(sample_para_dict, file = None):
     block_name = '#Scattering method'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name])#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], file = file)#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print() 
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file) 
     
-def print6_Symmetries(sample_para_dict):
+def print6_Symmetries(sample_para_dict, file = None):
     block_name = '#Symmetries'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name])#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], file = file)#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print()   
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file)   
     
-def print7_Disk_physics(sample_para_dict):
+def print7_Disk_physics(sample_para_dict, file = None):
     block_name = '#Disk physics'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name])#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], file = file)#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print()  
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file)  
     
-def print8_Number_of_zones(sample_para_dict):
+def print8_Number_of_zones(sample_para_dict, file = None):
     block_name = '#Number of zones'
-    print(block_name + ': 1 zone = 1 density structure + corresponding grain properties')
-    print(sample_para_dict[block_name])
-    print('')
+    print(block_name + ': 1 zone = 1 density structure + corresponding grain properties', file = file)
+    print(sample_para_dict[block_name], file = file)
+    print('', file = file)
     
-def print9_Density_structure(sample_para_dict):
+def print9_Density_structure(sample_para_dict, file = None):
     block_name = '#Density structure'
-    print(block_name)
+    print(block_name, file = file)
     for zone_id in range(sample_para_dict['#Number of zones']):
         block_zone = sample_para_dict[block_name]['zone' + str(zone_id)]
         for i, row_name in enumerate(block_zone):
             if type(block_zone[row_name]) != type(collections.OrderedDict()):
-                print(block_zone[row_name])
+                print(block_zone[row_name], file = file)
             else:
                 for item in block_zone[row_name]:
-                    print(block_zone[row_name][item], end = ' ')
-                print('\t', end = '')
+                    print(block_zone[row_name][item], end = ' ', file = file)
+                print('\t', end = '', file = file)
                 for j, item in enumerate(block_zone[row_name]):
                     if i == 0 and j == 0:
-                        print(item, end = ' : 1 = disk, 2 = tapered-edge disk, 3 = envelope, 4 = debris disk, 5 = wall')
+                        print(item, end = ' : 1 = disk, 2 = tapered-edge disk, 3 = envelope, 4 = debris disk, 5 = wall', file = file)
                     else:
-                        print(item, end = ', ')
-                print('')
-        print('')
+                        print(item, end = ', ', file = file)
+                print('', file = file)
+        print('', file = file)
         
-def print10_Grain_properties(sample_para_dict):
+def print10_Grain_properties(sample_para_dict, file = None):
     block_name = '#Grain properties'
-    print(block_name)
+    print(block_name, file = file)
     try:
         if sample_para_dict['#Grain properties']['row0']['N_components'] is not None:
             # not weighted average of different dust components, but they interact with each other
             # currently *ONLY* support 1 zone, 1 species, and N components
             block_zone = sample_para_dict[block_name]
-            print(1, 'Number of species')
+            print(1, 'Number of species', file = file)
             for row_name in block_zone:
                 if type(block_zone[row_name]) != type(collections.OrderedDict()):
-                    print(block_zone[row_name])
+                    print(block_zone[row_name], file = file)
                 else:
                     for item in block_zone[row_name]:
-                        print(block_zone[row_name][item], end = ' ')
-                    print('\t', end = '')
+                        print(block_zone[row_name][item], end = ' ', file = file)
+                    print('\t', end = '', file = file)
                     for item in block_zone[row_name]:
-                        print(item, end = ', ')
+                        print(item, end = ', ', file = file)
                         # print('')
-                    print('')
-            print('')
+                    print('', file = file)
+            print('', file = file)
     except:
         # weighted average of different dust species
         for zone_id in range(sample_para_dict['#Number of zones']):
             block_zone = sample_para_dict[block_name]['zone' + str(zone_id)]
             for category in block_zone:
                 if type(block_zone[category]) != type(collections.OrderedDict()):
-                    print(block_zone[category], '\t Number of species')
+                    print(block_zone[category], '\t Number of species', file = file)
                 else:
                     for row_name in block_zone[category]:
                         if type(block_zone[category][row_name]) != type(collections.OrderedDict()):
-                            print(block_zone[category][row_name])
+                            print(block_zone[category][row_name], file = file)
                         else:
                             for item in block_zone[category][row_name]:
-                                print(block_zone[category][row_name][item], end = ' ')
-                            print('\t', end = '')
+                                print(block_zone[category][row_name][item], end = ' ', file = file)
+                            print('\t', end = '', file = file)
                             for item in block_zone[category][row_name]:
-                                print(item, end = ', ')
-                            print('')
-                    print('')
+                                print(item, end = ', ', file = file)
+                            print('', file = file)
+                    print('', file = file)
 
 
             
-def print11_Molecular_RT_settings(sample_para_dict):
+def print11_Molecular_RT_settings(sample_para_dict, file = None):
     block_name = '#Molecular RT settings'
-    print(block_name)
+    print(block_name, file = file)
     for row_name in sample_para_dict[block_name]:
         if type(sample_para_dict[block_name][row_name]) != type(collections.OrderedDict()):
-            print(sample_para_dict[block_name][row_name])#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
+            print(sample_para_dict[block_name][row_name], file = file)#, '\t', '1 = cylindrical, 2 = spherical, 3 = Voronoi tesselation (this is in beta, please ask Christophe)')
         else:
             for item in sample_para_dict[block_name][row_name]:
-                print(sample_para_dict[block_name][row_name][item], end = ' ')
-            print('\t', end = '')
+                print(sample_para_dict[block_name][row_name][item], end = ' ', file = file)
+            print('\t', end = '', file = file)
             for item in sample_para_dict[block_name][row_name]:
-                print(item, end = ', ')
-            print('')
-    print()  
+                print(item, end = ', ', file = file)
+            print('', file = file)
+    print(file = file)  
     
     
-def print12_Star_properties(sample_para_dict):
+def print12_Star_properties(sample_para_dict, file = None):
     block_name = '#Star properties'
-    print(block_name)
-    print(sample_para_dict[block_name]['Number of stars'], '\tNumber of stars')
+    print(block_name, file = file)
+    print(sample_para_dict[block_name]['Number of stars'], '\tNumber of stars', file = file)
     for star_id in range(sample_para_dict[block_name]['Number of stars']):
         block_star = sample_para_dict[block_name]['star' + str(star_id)]
         for row_name in block_star:
             if type(block_star[row_name]) != type(collections.OrderedDict()):
-                print(block_star[row_name])
+                print(block_star[row_name], file = file)
             else:
                 for item in block_star[row_name]:
-                    print(block_star[row_name][item], end = ' ')
-                print('\t', end = '')
+                    print(block_star[row_name][item], end = ' ', file = file)
+                print('\t', end = '', file = file)
                 for item in block_star[row_name]:
-                    print(item, end = ', ')
-                print('')
-        print('')
+                    print(item, end = ', ', file = file)
+                print('', file = file)
+        print('', file = file)
 
 def display_file(para_dict, save_path = None):
     """Display the parameter file.
@@ -578,27 +578,29 @@ def display_file(para_dict, save_path = None):
         Output:
             Either a display on the screen (when save_path is None)
             Or save to a file (when save_path is an address, e.g., './template_mcfost_para.para')
+        Note: sys.stdout is not redirected, the lines are written to the file directly, so different threads can save their files at the same time.
     """
-    import sys
-    old = sys.stdout
-    
-    if save_path is not None:
-        sys.stdout = open(save_path, "w+")
-    print0_mcfost_version(para_dict)
-    print1_Number_of_photon_packages(para_dict)
-    print2_Wavelength(para_dict)
-    print3_Grid_geometry_and_size(para_dict)
-    print4_Maps(para_dict)
-    print5_Scattering_method(para_dict)
-    print6_Symmetries(para_dict)
-    print7_Disk_physics(para_dict)
-    print8_Number_of_zones(para_dict)
-    print9_Density_structure(para_dict)
-    print10_Grain_properties(para_dict)
-    print11_Molecular_RT_settings(para_dict)
-    print12_Star_properties(para_dict)
-
-    sys.stdout = old
+    if save_path is None:
+        file = None                     # the screen
+    else:
+        file = open(save_path, "w+")
+    try:
+        print0_mcfost_version(para_dict, file = file)
+        print1_Number_of_photon_packages(para_dict, file = file)
+        print2_Wavelength(para_dict, file = file)
+        print3_Grid_geometry_and_size(para_dict, file = file)
+        print4_Maps(para_dict, file = file)
+        print5_Scattering_method(para_dict, file = file)
+        print6_Symmetries(para_dict, file = file)
+        print7_Disk_physics(para_dict, file = file)
+        print8_Number_of_zones(para_dict, file = file)
+        print9_Density_structure(para_dict, file = file)
+        print10_Grain_properties(para_dict, file = file)
+        print11_Molecular_RT_settings(para_dict, file = file)
+        print12_Star_properties(para_dict, file = file)
+    finally:
+        if file is not None:
+            file.close()
 # n_zone = 2
 # n_species = [1, 1]#[3, 2]
 # n_star = 1#2
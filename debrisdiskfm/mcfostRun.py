@@ -1,14 +1,204 @@
 import copy                         # duplicate the parameter files
 import subprocess                   # run the parameter files
-import os                           # change directory
+import os
 import numpy as np
 import shutil
+import threading
+from astropy.io import fits
 
 
 from . import mcfostParameterTemplate      # create a tempalte parameter file
+from . import mcfostCache                  # reuse the MCFOST outputs of identical parameter files
+from . import dependencies                 # rotate the images for `pa_rotation`
+from . import diskmodeling_Qr
 from glob import glob
 
-def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED = True, calcImage = True, hash_address = True, STIS = True, NICMOS = True, GPI = True, paramfiles_only = False, Fe_composition = False):
+def available_cores():
+    """Number of cores this process is allowed to run on (e.g., the ones given to a Slurm task)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:                  # not available on macOS
+        return os.cpu_count()
+
+_launcher = threading.local()          # per thread, see set_launcher()
+
+def set_launcher(launcher = None):
+    """Let run_mcfost_jobs() in the current thread hand the MCFOST commands to `launcher` instead of running them itself,
+    e.g., asyncPool.async_pool.launch() runs them as asyncio subprocesses. If None, run_mcfost_jobs() runs them again.
+    Input:
+        launcher: a function with the same inputs and output as run_mcfost_jobs()."""
+    _launcher.run = launcher
+
+def run_mcfost_jobs(commands, logs, cwd = None, parallel = False, n_threads = None):
+    """Run MCFOST commands in the `cwd` folder, without changing the working directory of this process.
+    Input:
+        commands: list of lists of strings, the MCFOST commands, e.g., [['mcfost', 'hd191089_stis.para', '-img', '0.58', '-only_scatt']].
+        logs: list of strings, the files (in `cwd`) that the screen outputs of the commands are appended to.
+        cwd: string, the folder where MCFOST reads the parameter files and saves the outputs. If None, the current working directory.
+        parallel: boolean, if True, all the commands are started at the same time and then waited for; 
+                    otherwise they are run one after another.
+        n_threads: integer, number of OpenMP threads for each MCFOST process. If None, the MCFOST default is used when `parallel == False`,
+                    and the available cores are shared evenly among the commands when `parallel == True`.
+    Output:
+        list of the exit codes of the commands.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    launcher = getattr(_launcher, 'run', None)
+    if launcher is not None:
+        return launcher(commands, logs, cwd = cwd, parallel = parallel, n_threads = n_threads)
+    
+    if parallel and n_threads is None:
+        n_threads = max(1, available_cores() // max(1, len(commands)))
+    env = None
+    if n_threads is not None:
+        env = dict(os.environ, OMP_NUM_THREADS = str(int(n_threads)))
+    
+    if not parallel:
+        flags = []
+        for command, log in zip(commands, logs):
+            with open(os.path.join(cwd, log), 'a') as f:
+                flags.append(subprocess.call(command, cwd = cwd, stdout = f, env = env))
+        return flags
+    
+    files = [open(os.path.join(cwd, log), 'a') for log in logs]
+    try:
+        processes = [subprocess.Popen(command, cwd = cwd, stdout = f, env = env) for command, f in zip(commands, files)]
+        return [process.wait() for process in processes]
+    finally:
+        for f in files:
+            f.close()
+
+def scratch_path_model(path_model, scratch_path = None):
+    """Move the model folder(s) to a scratch folder, e.g., a node-local disk or memory, to avoid creating and deleting them on a shared file system.
+    Input:
+        path_model: string, the `paraPath` of the runners (i.e., `path_model` of the lnpost functions), e.g., './mcfost_models/'.
+        scratch_path: string, the scratch folder, environment variables are expanded, e.g., '$TMPDIR' or '/dev/shm/'. If None, `path_model` is returned.
+    Output:
+        string, the `paraPath` in the scratch folder, e.g., '/dev/shm/mcfost_models/'."""
+    if scratch_path is None:
+        return path_model
+    if path_model is None:
+        path_model = './mcfost_models/'
+    scratch_path = os.path.expanduser(os.path.expandvars(scratch_path))
+    os.makedirs(scratch_path, exist_ok = True)
+    return os.path.join(scratch_path, os.path.basename(os.path.normpath(path_model))) + '/'
+
+def copy_artifacts(source, destination, artifacts):
+    """Copy the requested outputs of a model folder, e.g., from the scratch folder to the persistent storage.
+    Input:
+        source: string, the model folder.
+        destination: string, the folder to copy to, created if it does not exist.
+        artifacts: list of strings, glob patterns relative to `source`, e.g., ['*.para', '*mcfostout.txt', 'data_0.58/RT.fits.gz'].
+    """
+    for pattern in artifacts:
+        for filename in glob(os.path.join(source, pattern)):
+            filename_destination = os.path.join(destination, os.path.relpath(filename, source))
+            if os.path.isdir(filename):
+                shutil.copytree(filename, filename_destination, dirs_exist_ok = True)
+            else:
+                os.makedirs(os.path.dirname(filename_destination), exist_ok = True)
+                shutil.copy2(filename, filename_destination)
+
+pa_canonical = 90       # position angle (our definition, i.e., MCFOST disk PA + 90) of the MCFOST images when `pa_rotation == True`
+
+def padded_width(width):
+    """Odd width of a map that still covers the central `width` x `width` pixels after any rotation about its center,
+    i.e., about sqrt(2) times `width`. The pixel size is not changed."""
+    width_padded = int(np.ceil(np.sqrt(2) * width))
+    return width_padded + 1 - width_padded % 2
+
+def star_region(shape, star_hw = 2):
+    """Slices of the central (2*star_hw + 1) x (2*star_hw + 1) region of an MCFOST image that contains the star, 
+    the same as the one removed in lnlike_hd191089()."""
+    y_cen, x_cen = int((shape[0] - 1)/2), int((shape[1] - 1)/2)
+    return (slice(y_cen - star_hw, y_cen + star_hw + 1), slice(x_cen - star_hw, x_cen + star_hw + 1))
+
+def rotate_model(path_image, angle, width, star_hw = 2):
+    """Rotate the MCFOST images from `pa_canonical` to the requested position angle, and crop them to the instrument size.
+    The rotated images overwrite the original file, so the likelihood functions read them as if MCFOST were run at that position angle.
+    Input:
+        path_image: string, the MCFOST output file, e.g., './data_0.58/RT.fits.gz'.
+        angle: float, position angle difference in degrees (requested - canonical), east of north.
+        width: integer, width of the output images.
+        star_hw: integer, half-width of the central region containing the star, see star_region().
+    Note: 
+        1. A positive `angle` rotates the image counterclockwise when displayed with the origin at lower left (north up, east left), 
+           i.e., `angle = -angle` for dependencies.rotateImage(), the same convention as the parallactic angles in lnlike_pds70keck().
+        2. For the Stokes parameters, Q and U are defined with respect to north, so they are converted to Qr and Ur with 
+           diskmodeling_Qr.radialStokes(), rotated, then converted back to Q and U on the output grid.
+        3. The star (a near-delta function) would ring in the spline interpolation and leak a few percent of its flux, which is much brighter 
+           than the disk, outside star_region(). Only the disk is rotated: the star region is taken out before the rotation, then put back 
+           at the center unchanged (the pixels of the disk in this region are then not rotated, they are removed in the likelihoods).
+        4. The scattered_fraction() of the image before the rotation is saved in the header (SCATFRAC), since the rotated image is cropped.
+    """
+    with fits.open(path_image) as hdul:
+        data = hdul[0].data
+        header = hdul[0].header
+    width_mcfost = data.shape[-1]
+    start = (width_mcfost - width) // 2
+    stokes = (data.shape[0] == 4)
+    
+    images = data.reshape((data.shape[0], -1, width_mcfost, width_mcfost))
+    results = np.zeros((data.shape[0], images.shape[1], width, width))
+    fraction = scattered_fraction_image(images[0, 0], star_hw = star_hw)
+    region = star_region((width_mcfost, width_mcfost), star_hw = star_hw)
+    region_output = tuple(slice(region_i.start - start, region_i.stop - start) for region_i in region)
+    for j in range(images.shape[1]):
+        planes = images[:, j].astype(float)
+        stars = np.copy(planes[:, region[0], region[1]])
+        planes[:, region[0], region[1]] = 0
+        if stokes:
+            planes[1], planes[2] = diskmodeling_Qr.radialStokes(mcfostGenerated = False, q = planes[1], u = planes[2])
+        for i in range(planes.shape[0]):
+            rotated = dependencies.rotateImage(planes[i], angle = -angle, outputMask = False)
+            results[i, j] = rotated[start:start + width, start:start + width]
+        if stokes:                                  # back to Q and U, inverse of diskmodeling_Qr.radialStokes()
+            x_cen = y_cen = (width - 1)/2.0
+            y, x = np.mgrid[0:width, 0:width]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                phi = np.arctan((y - y_cen)*1.0/(x - x_cen))
+            qr, ur = np.copy(results[1, j]), np.copy(results[2, j])
+            results[1, j] = qr * np.cos(2 * phi) - ur * np.sin(2 * phi)
+            results[2, j] = qr * np.sin(2 * phi) + ur * np.cos(2 * phi)
+            results[1:3, j][np.isnan(results[1:3, j])] = 0
+        results[:, j, region_output[0], region_output[1]] = stars
+    
+    results = results.reshape(data.shape[:-2] + (width, width)).astype(data.dtype)
+    if 'CRPIX1' in header:
+        header['CRPIX1'] = (width + 1)/2.0
+        header['CRPIX2'] = (width + 1)/2.0
+    if np.isfinite(fraction):
+        header['SCATFRAC'] = (fraction, 'scattered/stellar flux before rotate_model()')
+        header['STAR_HW'] = (star_hw, 'half-width of the star region for SCATFRAC')
+    fits.writeto(path_image, results, header, overwrite = True)
+
+def scattered_fraction(path_image, star_hw = 2):
+    """Ratio between the scattered light and the stellar flux in an MCFOST image, a proxy of the optical depth of the disk.
+    Input:
+        path_image: string, the MCFOST output file, e.g., './data_0.58/RT.fits.gz'.
+        star_hw: integer, half-width of the central region containing the star (size = 2*star_hw + 1), the same as the one removed in lnlike_hd191089().
+    Output:
+        float, np.inf if the star is not in the image.
+    Note: for the images rotated with rotate_model(), the ratio before the rotation is returned."""
+    with fits.open(path_image) as hdul:
+        header = hdul[0].header
+        if 'SCATFRAC' in header and header.get('STAR_HW') == star_hw:
+            return float(header['SCATFRAC'])
+        image = hdul[0].data[0, 0, 0]
+    return scattered_fraction_image(image, star_hw = star_hw)
+
+def scattered_fraction_image(image, star_hw = 2):
+    """scattered_fraction() for a 2D image."""
+    flux_star = np.nansum(image[star_region(image.shape, star_hw = star_hw)])
+    if not flux_star > 0:
+        return np.inf
+    return (np.nansum(image) - flux_star)/flux_star
+
+def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED = True, calcImage = True,
+                 hash_address = True, STIS = True, NICMOS = True, GPI = True, paramfiles_only = False,
+                 Fe_composition = False, parallel_images = False, n_threads = None, cache_path = None,
+                 cache_max_size = None, pa_rotation = False, m_ref = None):
     """This code generates and saves the MCFOST disk(s) to `paraPath` with given input parameters. 
     The MCFOST parameters are modified from the template generated by mcfostParameterTemplate().
     
@@ -37,6 +227,20 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     9. `GPI`: whether to generate the GPI image. The default values for 7, 8, and 9 are True.  You can turn individual ones on to focus on them only.
     10. `paramfiles_only`: whether to only generate the parameter files.
     11. `Fe_composition`: wheter to use Fe as a composition, if True, the compositions will be amorphous Silicates, amorphous Carbon, and Fe-Posch (default is False: Fe-Posch will be H2O Ice).
+    12. `parallel_images`: whether to run the STIS, NICMOS, and GPI image calculations at the same time. They only share the read-only
+        parameter and SED files, so the run time is then that of the slowest instrument.
+    13. `n_threads`: number of OpenMP threads for each MCFOST image calculation. If None and `parallel_images == True`, the cores available
+        to this process are shared evenly by the image calculations.
+    14. `cache_path`: folder of the MCFOST model cache (see mcfostCache.py). If not None, the images of a parameter file that has been run 
+        before are copied from there instead of running MCFOST, and the new ones are saved there. The folder can be shared by the processes.
+        When `calcSED = True`, the thermal structure (`data_th`) is also cached, keyed by the temperature-relevant parameters only, and is
+        linked into the model folder before the image calculations.
+    15. `cache_max_size`: maximum size of the cache in GB, the least recently used models are deleted beyond it. If None, there is no limit.
+    16. `pa_rotation`: whether to run MCFOST at `pa_canonical` with padded maps (same pixel size, see padded_width()), then rotate the images
+        to the requested position angle with rotate_model(). The parameter files are then independent of the position angle, so models that 
+        only differ in PA are loaded from the cache (`cache_path`) and rotated instead of running MCFOST.
+    17. `m_ref`: if not None, the dust mass is set to 10**`m_ref` instead of `m_disk`. For optically thin disks, the images are then scaled
+        to `m_disk` in lnlike_hd191089() with `mass_scale`, and the parameter files (and the cache) are independent of the dust mass.
     """
     
     param_hd191089 = mcfostParameterTemplate.generateMcfostTemplate(1, [3], 1)
@@ -215,6 +419,12 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
                 param_hd191089['#Grain properties']['zone0']['species0']['row0']['Vmax'] = round(theta_all[var_name], 3)
                 param_hd191089['#Grain properties']['zone0']['species1']['row0']['Vmax'] = round(theta_all[var_name], 3)
                 param_hd191089['#Grain properties']['zone0']['species2']['row0']['Vmax'] = round(theta_all[var_name], 3)
+    pa_offset = 0
+    if pa_rotation:         # MCFOST is run at `pa_canonical`, and the images are rotated to the requested PA afterwards
+        pa_offset = param_hd191089['#Maps']['row4']['disk PA'] + 90 - pa_canonical
+        param_hd191089['#Maps']['row4']['disk PA'] = pa_canonical - 90
+    if m_ref is not None:   # MCFOST is run at the reference mass, and the images are scaled to the requested mass in lnlike_hd191089()
+        param_hd191089['#Density structure']['zone0']['row1']['dust mass'] = format(10**m_ref, '.3e')
     ###############################################################################################
     ########################### Section 3: Parameter File for HD191089 ############################
     ######################### Instrument-specific adjusts for the system. #########################
@@ -222,25 +432,28 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     if STIS:
         param_hd191089_stis = copy.deepcopy(param_hd191089)
         stis_width = 315
+        stis_width_map = padded_width(stis_width) if pa_rotation else stis_width
         param_hd191089_stis['#Wavelength']['row3']['stokes parameters?'] = 'F'
-        param_hd191089_stis['#Maps']['row0']['nx'] = stis_width
-        param_hd191089_stis['#Maps']['row0']['ny'] = stis_width
-        param_hd191089_stis['#Maps']['row0']['size'] = dist * stis_width * resolution_stis
+        param_hd191089_stis['#Maps']['row0']['nx'] = stis_width_map
+        param_hd191089_stis['#Maps']['row0']['ny'] = stis_width_map
+        param_hd191089_stis['#Maps']['row0']['size'] = dist * stis_width_map * resolution_stis
     if NICMOS:
         param_hd191089_nicmos = copy.deepcopy(param_hd191089)
         nicmos_width = 139
+        nicmos_width_map = padded_width(nicmos_width) if pa_rotation else nicmos_width
         param_hd191089_nicmos['#Wavelength']['row3']['stokes parameters?'] = 'F'
-        param_hd191089_nicmos['#Maps']['row0']['nx'] = nicmos_width
-        param_hd191089_nicmos['#Maps']['row0']['ny'] = nicmos_width
-        param_hd191089_nicmos['#Maps']['row0']['size'] = dist * nicmos_width * resolution_nicmos
+        param_hd191089_nicmos['#Maps']['row0']['nx'] = nicmos_width_map
+        param_hd191089_nicmos['#Maps']['row0']['ny'] = nicmos_width_map
+        param_hd191089_nicmos['#Maps']['row0']['size'] = dist * nicmos_width_map * resolution_nicmos
 
     if GPI:
         param_hd191089_gpi = copy.deepcopy(param_hd191089)
         gpi_width = 281
+        gpi_width_map = padded_width(gpi_width) if pa_rotation else gpi_width
         param_hd191089_gpi['#Wavelength']['row3']['stokes parameters?'] = 'T'
-        param_hd191089_gpi['#Maps']['row0']['nx'] = gpi_width
-        param_hd191089_gpi['#Maps']['row0']['ny'] = gpi_width
-        param_hd191089_gpi['#Maps']['row0']['size'] = dist * gpi_width * resolution_gpi
+        param_hd191089_gpi['#Maps']['row0']['nx'] = gpi_width_map
+        param_hd191089_gpi['#Maps']['row0']['ny'] = gpi_width_map
+        param_hd191089_gpi['#Maps']['row0']['size'] = dist * gpi_width_map * resolution_gpi
 
     if paraPath is None:
         paraPath = './mcfost_models/'
@@ -252,8 +465,6 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     else:
         os.mkdir(paraPath)              # Create the folder if it does not exist.
         
-    currentDirectory = os.getcwd()          # Get current working directory, and jump back at the end
-    
     if hash_address:
         paraPath_hash = paraPath[:-1] + hash_string + '/'
 
@@ -262,25 +473,24 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
             
         os.mkdir(paraPath_hash)
         
-        os.chdir(paraPath_hash) 
+        path_run = os.path.abspath(paraPath_hash) + '/'
     else:
-        os.chdir(paraPath)                      # Now everthing is stored in the `paraPath` folder.
+        path_run = os.path.abspath(paraPath) + '/'       # Now everthing is stored in the `paraPath` folder.
         
     flag_STIS = 0
     if STIS:
-        mcfostParameterTemplate.display_file(param_hd191089_stis, 'hd191089_stis.para')
+        mcfostParameterTemplate.display_file(param_hd191089_stis, path_run + 'hd191089_stis.para')
         flag_STIS = 1
     flag_NICMOS = 0
     if NICMOS:
-        mcfostParameterTemplate.display_file(param_hd191089_nicmos, 'hd191089_nicmos.para')
+        mcfostParameterTemplate.display_file(param_hd191089_nicmos, path_run + 'hd191089_nicmos.para')
         flag_NICMOS = 1
     flag_GPI = 0
     if GPI:
-        mcfostParameterTemplate.display_file(param_hd191089_gpi, 'hd191089_gpi.para')
+        mcfostParameterTemplate.display_file(param_hd191089_gpi, path_run + 'hd191089_gpi.para')
         flag_GPI = 1
     if paramfiles_only:
         print('Only paramter files are saved! MCFOST is not run!')
-        os.chdir('../') 
         return 0
     ###############################################################################################
     ####################################### Section 4: Run ########################################
@@ -289,16 +499,29 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     flag_run = 0
     if calcSED:
         try:
-            if os.path.exists('./data_th/'):
-                shutil.rmtree('./data_th/')
+            if os.path.exists(path_run + 'data_th/'):
+                shutil.rmtree(path_run + 'data_th/')
             if STIS:
                 instrument = 'stis'
+                param_sed = param_hd191089_stis
             elif NICMOS:
                 instrument = 'nicmos'
+                param_sed = param_hd191089_nicmos
             elif GPI:
                 instrument = 'gpi'
-                
-            flag_sed = subprocess.call('mcfost hd191089_' + instrument + '.para >> sedmcfostout.txt', shell = True)
+                param_sed = param_hd191089_gpi
+            
+            key_sed = None
+            if cache_path is not None:                  # the thermal structure is shared by the models with the same temperature-relevant parameters
+                key_sed = mcfostCache.thermal_key(param_sed)
+            if key_sed is not None and mcfostCache.cache_link(cache_path, key_sed, path_run):
+                flag_sed = 0
+            else:
+                flag_sed = run_mcfost_jobs([['mcfost', 'hd191089_' + instrument + '.para']], ['sedmcfostout.txt'],
+                                           cwd = path_run)[0]
+                if key_sed is not None and flag_sed == 0:
+                    mcfostCache.cache_store(cache_path, key_sed, path_run, ['data_th'], files = None,
+                                            max_size = cache_max_size)
 
             if flag_sed == 1:
                 print('SED calculation is not performed, please check conflicting folder name.')
@@ -311,12 +534,31 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     if calcImage:
         try:
             flags_image = [flag_STIS, flag_NICMOS, flag_GPI]
-            if STIS:
-                flags_image[0] = subprocess.call('mcfost hd191089_stis.para -img 0.58 -only_scatt >> imagemcfostout_STIS.txt', shell = True)
-            if NICMOS:
-                flags_image[1] = subprocess.call('mcfost hd191089_nicmos.para -img 1.12 -only_scatt >> imagemcfostout_NICMOS.txt', shell = True)
-            if GPI:
-                flags_image[2] = subprocess.call('mcfost hd191089_gpi.para -img 1.65 -only_scatt >> imagemcfostout_GPI_H.txt', shell = True)
+            jobs_image = [('hd191089_stis.para', '0.58', 'imagemcfostout_STIS.txt'),
+                          ('hd191089_nicmos.para', '1.12', 'imagemcfostout_NICMOS.txt'),
+                          ('hd191089_gpi.para', '1.65', 'imagemcfostout_GPI_H.txt')]
+            index_run = [i for i, flag in enumerate(flags_image) if flag]
+            keys_cache = {}
+            if cache_path is not None:
+                for i in list(index_run):
+                    keys_cache[i] = mcfostCache.cache_key(path_run + jobs_image[i][0],
+                                                          '-img ' + jobs_image[i][1] + ' -only_scatt')
+                    if mcfostCache.cache_load(cache_path, keys_cache[i], path_run):
+                        flags_image[i] = 0
+                        index_run.remove(i)
+            commands_image = [['mcfost', jobs_image[i][0], '-img', jobs_image[i][1], '-only_scatt'] for i in index_run]
+            flags_run = run_mcfost_jobs(commands_image, [jobs_image[i][2] for i in index_run], cwd = path_run,
+                                        parallel = parallel_images, n_threads = n_threads)
+            for i, flag in zip(index_run, flags_run):
+                flags_image[i] = flag
+                if cache_path is not None and flag == 0:
+                    mcfostCache.cache_store(cache_path, keys_cache[i], path_run, ['data_' + jobs_image[i][1]],
+                                            max_size = cache_max_size)
+            if pa_rotation:
+                widths_image = [stis_width if STIS else None, nicmos_width if NICMOS else None, gpi_width if GPI else None]
+                for i in range(len(jobs_image)):
+                    if widths_image[i] is not None and flags_image[i] == 0:
+                        rotate_model(path_run + 'data_' + jobs_image[i][1] + '/RT.fits.gz', pa_offset, widths_image[i])
 
             if sum(flags_image) > 0:
                 print('Image calculation is not performed for all the three wavelengths, please check conflicting folder name(s) or non-existing SED file.')
@@ -327,7 +569,6 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
             flag_run += flags_image
             pass
             
-    os.chdir(currentDirectory)              # Go back to the top working directory
 
     if hash_address:
         return flag_run, hash_string
@@ -335,7 +576,9 @@ def run_hd191089(var_names = None, var_values = None, paraPath = None, calcSED =
     return flag_run
     # return 0 if everything is performed.
     
-def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcSED = False, calcImage = False, calcSPF = True, hash_address = True, paramfiles_only = False, Fe_composition = True):
+def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcSED = False, calcImage = False,
+                     calcSPF = True, hash_address = True, paramfiles_only = False, Fe_composition = True,
+                     cache_path = None, cache_max_size = None, pa_rotation = False):
     """This code generates and saves the MCFOST SPF(s) to `paraPath` with given input parameters. 
     The MCFOST parameters are modified from the template generated by mcfostParameterTemplate().
     
@@ -362,6 +605,9 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
     7. `hash_address`: whether to hash the path/address to enable parallel evaluation of different parameters by saving at different addresses.
     8. `paramfiles_only`: whether to only generate the parameter files.
     9. `Fe_composition`: wheter to use Fe as a composition, if True, the compositions will be amorphous Silicates, amorphous Carbon, and Fe-Posch (default is False: Fe-Posch will be H2O Ice).
+    10. `cache_path`, `cache_max_size`: the MCFOST model cache for the image, refer to run_hd191089() for details.
+    11. `pa_rotation`: whether to run MCFOST at `pa_canonical` and rotate the image to the requested position angle, refer to run_hd191089() for details.
+        The phase function is not affected by the position angle.
     """
     
     param_hr4796aH2spf = mcfostParameterTemplate.generateMcfostTemplate(1, [1], 1, 3)
@@ -532,12 +778,18 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
     ######################### Instrument-specific adjusts for the system. #########################
     ###############################################################################################
 
+    pa_offset = 0
+    if pa_rotation:         # MCFOST is run at `pa_canonical`, and the image is rotated to the requested PA afterwards
+        pa_offset = param_hr4796aH2spf['#Maps']['row4']['disk PA'] + 90 - pa_canonical
+        param_hr4796aH2spf['#Maps']['row4']['disk PA'] = pa_canonical - 90
+
     param_hr4796aH2spf = copy.deepcopy(param_hr4796aH2spf)
     sphere_width = 201
+    sphere_width_map = padded_width(sphere_width) if pa_rotation else sphere_width
     param_hr4796aH2spf['#Wavelength']['row3']['stokes parameters?'] = 'F'
-    param_hr4796aH2spf['#Maps']['row0']['nx'] = sphere_width
-    param_hr4796aH2spf['#Maps']['row0']['ny'] = sphere_width
-    param_hr4796aH2spf['#Maps']['row0']['size'] = np.round(dist * sphere_width * resolution_sphere, 3)
+    param_hr4796aH2spf['#Maps']['row0']['nx'] = sphere_width_map
+    param_hr4796aH2spf['#Maps']['row0']['ny'] = sphere_width_map
+    param_hr4796aH2spf['#Maps']['row0']['size'] = np.round(dist * sphere_width_map * resolution_sphere, 3)
 
     if paraPath is None:
         paraPath = './mcfost_models/'
@@ -549,8 +801,6 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
     else:
         os.mkdir(paraPath)              # Create the folder if it does not exist.
         
-    currentDirectory = os.getcwd()          # Get current working directory, and jump back at the end
-    
     if hash_address:
         paraPath_hash = paraPath[:-1] + hash_string + '/'
 
@@ -559,18 +809,17 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
             
         os.mkdir(paraPath_hash)
         
-        os.chdir(paraPath_hash) 
+        path_run = os.path.abspath(paraPath_hash) + '/'
     else:
-        os.chdir(paraPath)                      # Now everthing is stored in the `paraPath` folder.
+        path_run = os.path.abspath(paraPath) + '/'       # Now everthing is stored in the `paraPath` folder.
         
     flag_SPHERE = 0
 
-    mcfostParameterTemplate.display_file(param_hr4796aH2spf, 'hr4796a_sphere.para')
+    mcfostParameterTemplate.display_file(param_hr4796aH2spf, path_run + 'hr4796a_sphere.para')
     flag_SPHERE = 1
 
     if paramfiles_only:
         print('Only paramter files are saved! MCFOST is not run!')
-        os.chdir('../') 
         return 0
     ###############################################################################################
     ####################################### Section 4: Run ########################################
@@ -579,10 +828,10 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
     flag_run = 0
     if calcSED:
         try:
-            if os.path.exists('./data_th/'):
-                shutil.rmtree('./data_th/')
+            if os.path.exists(path_run + 'data_th/'):
+                shutil.rmtree(path_run + 'data_th/')
                 
-            flag_sed = subprocess.call('mcfost hr4796a_sphere.para >> sedmcfostout.txt', shell = True)
+            flag_sed = run_mcfost_jobs([['mcfost', 'hr4796a_sphere.para']], ['sedmcfostout.txt'], cwd = path_run)[0]
 
             if flag_sed == 1:
                 print('SED calculation is not performed, please check conflicting folder name.')
@@ -594,7 +843,18 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
             pass
     if calcImage:
         try:
-            flag_image = subprocess.call('mcfost hr4796a_sphere.para -img 1.593 -only_scatt >> imagemcfostout.txt', shell = True)
+            key_image = None
+            if cache_path is not None:
+                key_image = mcfostCache.cache_key(path_run + 'hr4796a_sphere.para', '-img 1.593 -only_scatt')
+            if key_image is not None and mcfostCache.cache_load(cache_path, key_image, path_run):
+                flag_image = 0
+            else:
+                flag_image = run_mcfost_jobs([['mcfost', 'hr4796a_sphere.para', '-img', '1.593', '-only_scatt']],
+                                             ['imagemcfostout.txt'], cwd = path_run)[0]
+                if key_image is not None and flag_image == 0:
+                    mcfostCache.cache_store(cache_path, key_image, path_run, ['data_1.593'], max_size = cache_max_size)
+            if pa_rotation and flag_image == 0:
+                rotate_model(path_run + 'data_1.593/RT.fits.gz', pa_offset, sphere_width)
 
             if flag_image > 0:
                 print('Image calculation is not performed, please check conflicting folder name(s) or non-existing SED file.')
@@ -606,7 +866,8 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
             pass
     if calcSPF:
         try:
-            flag_spf = subprocess.call('mcfost hr4796a_sphere.para -dust_prop -op 1.593 >> dustpropmcfostout.txt', shell = True)
+            flag_spf = run_mcfost_jobs([['mcfost', 'hr4796a_sphere.para', '-dust_prop', '-op', '1.593']],
+                                       ['dustpropmcfostout.txt'], cwd = path_run)[0]
             flag_spf = 0 #   '1 is probably a wrong exit code in MCFOST. The files are there.'
 
             if flag_spf > 0:
@@ -618,7 +879,6 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
             flag_run += flag_spf
             pass
             
-    os.chdir(currentDirectory)              # Go back to the top working directory
 
     if hash_address:
         return flag_run, hash_string
@@ -626,7 +886,9 @@ def run_hr4796aH2spf(var_names = None, var_values = None, paraPath = None, calcS
     return flag_run
     # return 0 if everything is performed.
 
-def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED = False, calcImage = True, hash_address = True, Keck38 = True, paramfiles_only = False):
+def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED = False, calcImage = True,
+                  hash_address = True, Keck38 = True, paramfiles_only = False, cache_path = None, cache_max_size = None,
+                  pa_rotation = False):
     """This code generates and saves the MCFOST disk(s) to `paraPath` with given input parameters. 
     The MCFOST parameters are modified from the template generated by mcfostParameterTemplate().
     
@@ -651,6 +913,8 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
     6. `hash_address`: whether to hash the path/address to enable parallel evaluation of different parameters by saving at different addresses.
     7. `Keck38`: whether to generate the Keck image at 3.8 micron
     8. `paramfiles_only`: whether to only generate the parameter files.
+    9. `cache_path`, `cache_max_size`: the MCFOST model cache for the image, refer to run_hd191089() for details.
+    10. `pa_rotation`: whether to run MCFOST at `pa_canonical` and rotate the image to the requested position angle, refer to run_hd191089() for details.
     """
     
     param_PDS70 = mcfostParameterTemplate.generateMcfostTemplate(1, [3], 1)
@@ -836,11 +1100,16 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
     ########################### Section 3: Parameter File for PDS70 ############################
     ######################### Instrument-specific adjusts for the system. #########################
     ###############################################################################################
+    pa_offset = 0
+    if pa_rotation:         # MCFOST is run at `pa_canonical`, and the image is rotated to the requested PA afterwards
+        pa_offset = param_PDS70['#Maps']['row4']['disk PA'] + 90 - pa_canonical
+        param_PDS70['#Maps']['row4']['disk PA'] = pa_canonical - 90
     nirc2_width = 161
+    nirc2_width_map = padded_width(nirc2_width) if pa_rotation else nirc2_width
     param_PDS70['#Wavelength']['row3']['stokes parameters?'] = 'F'
-    param_PDS70['#Maps']['row0']['nx'] = nirc2_width
-    param_PDS70['#Maps']['row0']['ny'] = nirc2_width
-    param_PDS70['#Maps']['row0']['size'] = dist * nirc2_width * resolution_kecknirc2
+    param_PDS70['#Maps']['row0']['nx'] = nirc2_width_map
+    param_PDS70['#Maps']['row0']['ny'] = nirc2_width_map
+    param_PDS70['#Maps']['row0']['size'] = dist * nirc2_width_map * resolution_kecknirc2
 
     if paraPath is None:
         paraPath = './mcfost_models/'
@@ -852,8 +1121,6 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
     else:
         os.mkdir(paraPath)              # Create the folder if it does not exist.
         
-    currentDirectory = os.getcwd()          # Get current working directory, and jump back at the end
-    
     if hash_address:
         paraPath_hash = paraPath[:-1] + hash_string + '/'
 
@@ -862,16 +1129,15 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
             
         os.mkdir(paraPath_hash)
         
-        os.chdir(paraPath_hash) 
+        path_run = os.path.abspath(paraPath_hash) + '/'
     else:
-        os.chdir(paraPath)                      # Now everthing is stored in the `paraPath` folder.
+        path_run = os.path.abspath(paraPath) + '/'       # Now everthing is stored in the `paraPath` folder.
         
-    mcfostParameterTemplate.display_file(param_PDS70, 'PDS70_nirc2lp.para')
+    mcfostParameterTemplate.display_file(param_PDS70, path_run + 'PDS70_nirc2lp.para')
 
     
     if paramfiles_only:
         print('Only paramter files are saved! MCFOST is not run!')
-        os.chdir('../') 
         return 0
     ###############################################################################################
     ####################################### Section 4: Run ########################################
@@ -880,10 +1146,10 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
     flag_run = 0
     if calcSED:
         try:
-            if os.path.exists('./data_th/'):
-                shutil.rmtree('./data_th/')
+            if os.path.exists(path_run + 'data_th/'):
+                shutil.rmtree(path_run + 'data_th/')
                 
-            flag_sed = subprocess.call('mcfost PDS70_nirc2lp.para >> sedmcfostout.txt', shell = True)
+            flag_sed = run_mcfost_jobs([['mcfost', 'PDS70_nirc2lp.para']], ['sedmcfostout.txt'], cwd = path_run)[0]
 
             if flag_sed == 1:
                 print('SED calculation is not performed, please check conflicting folder name.')
@@ -895,18 +1161,28 @@ def run_pds70keck(var_names = None, var_values = None, paraPath = None, calcSED
             pass
     if calcImage:
         try:
-            flag_image = subprocess.call('mcfost PDS70_nirc2lp.para -img 3.8 -only_scatt >> imagemcfostout_KeckNIRC2Lp.txt', shell = True)
+            key_image = None
+            if cache_path is not None:
+                key_image = mcfostCache.cache_key(path_run + 'PDS70_nirc2lp.para', '-img 3.8 -only_scatt')
+            if key_image is not None and mcfostCache.cache_load(cache_path, key_image, path_run):
+                flag_image = 0
+            else:
+                flag_image = run_mcfost_jobs([['mcfost', 'PDS70_nirc2lp.para', '-img', '3.8', '-only_scatt']],
+                                             ['imagemcfostout_KeckNIRC2Lp.txt'], cwd = path_run)[0]
+                if key_image is not None and flag_image == 0:
+                    mcfostCache.cache_store(cache_path, key_image, path_run, ['data_3.8'], max_size = cache_max_size)
+            if pa_rotation and flag_image == 0:
+                rotate_model(path_run + 'data_3.8/RT.fits.gz', pa_offset, nirc2_width)
 
             if flag_image > 0:
                 print('Image calculation is not performed, please check conflicting folder name(s) or non-existing SED file.')
-                flag_run += sum(flags_image)
+                flag_run += flag_image
         except:
             flag_image = 1
             print('Image calculation is not performed, something went wrong, but not the conflicting folders.')
             flag_run += flag_image
             pass
             
-    os.chdir(currentDirectory)              # Go back to the top working directory
 
     if hash_address:
         return flag_run, hash_string
@@ -0,0 +1,106 @@
+import numpy as np
+from numba import njit, prange
+from scipy import special
+from scipy.ndimage import spline_filter1d
+
+# Compiled rotation of image cubes, for dependencies.rotateImage() and dependencies.rotateCube() with method = 'numba'.
+# The frames are rotated in parallel threads (numba.prange) with the same interpolation as scipy.ndimage.rotate(reshape = False),
+# and the mask is rotated with the same weights, thresholded, NaN masked and (for GPI) flipped in the same pass.
+# The number of threads is set by numba, e.g., with the NUMBA_NUM_THREADS environment variable.
+
+@njit(cache = True)
+def _bspline_weights(t, order):
+    """Weights of the 2 (order = 1) or 4 (order = 3) neighboring coefficients for the fractional coordinate t."""
+    weights = np.zeros(4)
+    if order == 1:
+        weights[0] = 1 - t
+        weights[1] = t
+    else:
+        weights[0] = (1 - t)**3/6.0
+        weights[1] = (3*t**3 - 6*t**2 + 4)/6.0
+        weights[2] = (-3*t**3 + 3*t**2 + 3*t + 1)/6.0
+        weights[3] = t**3/6.0
+    return weights
+
+@njit(cache = True)
+def _mirror(index, n):
+    """Mirror an index outside [0, n-1] back into it, the same as for the spline coefficients in scipy.ndimage."""
+    if n == 1:
+        return 0
+    period = 2*(n - 1)
+    index = abs(index) % period
+    if index > n - 1:
+        index = period - index
+    return index
+
+@njit(parallel = True, cache = True)
+def _rotate_kernel(coefficients, coefficients_mask, sources, cos, sin, order, thresh, masked_nan, flip):
+    n_frames = cos.shape[0]
+    height = coefficients.shape[1]
+    width = coefficients.shape[2]
+    cen_y = (height - 1)/2.0
+    cen_x = (width - 1)/2.0
+    results = np.zeros((n_frames, height, width))
+    rotated_masks = np.zeros((n_frames, height, width))
+    for k in prange(n_frames*height):
+        frame = k // height
+        i = k % height
+        source = sources[frame]
+        for j in range(width):
+            y = cos[frame]*(i - cen_y) + sin[frame]*(j - cen_x) + cen_y
+            x = -sin[frame]*(i - cen_y) + cos[frame]*(j - cen_x) + cen_x
+            value = 0.0
+            value_mask = 0.0
+            if y >= 0 and y <= height - 1 and x >= 0 and x <= width - 1:   # no interpolation beyond the edges, as mode = 'constant'
+                y_floor = int(np.floor(y))
+                x_floor = int(np.floor(x))
+                weights_y = _bspline_weights(y - y_floor, order)
+                weights_x = _bspline_weights(x - x_floor, order)
+                start = 0 if order == 1 else -1
+                for a in range(order + 1):
+                    if weights_y[a] == 0:
+                        continue
+                    row = _mirror(y_floor + start + a, height)
+                    for b in range(order + 1):
+                        if weights_x[b] == 0:
+                            continue
+                        column = _mirror(x_floor + start + b, width)
+                        value += weights_y[a]*weights_x[b]*coefficients[source, row, column]
+                        value_mask += weights_y[a]*weights_x[b]*coefficients_mask[source, row, column]
+            j_out = width - 1 - j if flip else j
+            if value_mask >= thresh:
+                rotated_masks[frame, i, j_out] = 1
+                results[frame, i, j_out] = value
+            elif masked_nan:
+                results[frame, i, j_out] = np.nan
+    return results, rotated_masks
+
+def rotateStack(cubes, masks, angles, order = 3, thresh = 0.9, maskedNaN = False, instrument = None):
+    """Rotate image(s) and mask(s) by the angles, the same as step 2 of dependencies.rotateImage() for each angle.
+    Input:
+        cubes, masks: images without NaN's and binary masks (i.e., outputs of dependencies._prepareRotation()), 
+            either 3D (one for each angle), or 2D (the same image and mask for all the angles);
+        angles: 1D array of the angles in degrees;
+        order: 1 (bilinear) or 3 (bicubic spline, the default of scipy.ndimage.rotate());
+        thresh, maskedNaN, instrument: refer to dependencies.rotateImage().
+    Output:
+        results, rotatedMasks: 3D arrays, one for each angle."""
+    if order not in (1, 3):
+        raise ValueError('Only order = 1 or 3 is supported for the numba rotation!')
+    angles = np.asarray(angles, dtype = 'float64')
+    if instrument == "GPI":
+        angles = angles - 66.5 #IFS rotation
+    cubes = np.asarray(cubes, dtype = 'float64')
+    masks = np.asarray(masks, dtype = 'float64')
+    if len(cubes.shape) == 2:
+        cubes = cubes[np.newaxis]
+        masks = masks[np.newaxis]
+        sources = np.zeros(angles.shape[0], dtype = 'int64')
+    else:
+        sources = np.arange(angles.shape[0], dtype = 'int64')
+    if order == 3:  # the same spline prefilter as scipy.ndimage.rotate() in its default 'constant' mode
+        stack = np.concatenate([cubes, masks])
+        stack = spline_filter1d(spline_filter1d(stack, order = 3, axis = 1, mode = 'constant'), order = 3, axis = 2, mode = 'constant')
+        cubes, masks = stack[:cubes.shape[0]], stack[cubes.shape[0]:]
+    return _rotate_kernel(np.ascontiguousarray(cubes), np.ascontiguousarray(masks), sources, special.cosdg(angles), special.sindg(angles), 
+                          order, thresh, maskedNaN, instrument == "GPI")